@@ -58,6 +58,7 @@ spec_square_rs_tmax = config_main['plot_config']['tab_FSview_base']['spec_square
 spec_square_rs_fmax = config_main['plot_config']['tab_FSview_base']['spec_square_rs_fmax']
 spec_image_rs_ratio = config_main['plot_config']['tab_FSview_base']['spec_image_rs_ratio']
 tidx_prev = None
+tab2_panel3_exportjob = None
 
 # do_spec_regrid = False
 
@@ -506,8 +507,32 @@ def tab3_slider_ANLYS_idx_update(attrname, old, new):
         tab3_Div_Tb.text = """<p><b>Warning: Animate is OFF!!!</b></p>"""
 
 
+def tab2_panel3_savimgs_progress():
+    job = tab2_panel3_exportjob
+    if job.running:
+        tab3_Div_Tb.text = """<p>{}</p><p>{:.1f} frames/s</p>""".format(
+            DButil.ProgressBar(job.ndone, job.ntask, suffix='Output', decimals=0, length=30, empfill='=', fill='#'),
+            job.rate)
+        return
+    curdoc().remove_periodic_callback(tab2_panel3_savimgs_progress)
+    tab2_panel3_BUT_savimgs.label = 'Save images'
+    tab2_panel3_BUT_savimgs.button_type = 'primary'
+    if job.status == 'cancelled':
+        tab3_Div_Tb.text = '<p>export cancelled. {} of {} images saved to <b>{}</b>.</p>'.format(
+            job.ndone - len(job.errors), job.ntask, outimgdir)
+    else:
+        tab3_Div_Tb.text = '<p>images saved to <b>{}</b>.</p>'.format(outimgdir)
+    if job.errors:
+        tab3_Div_Tb.text += '<p>{} images failed: {}</p>'.format(len(job.errors), job.errors.values()[0])
+    print job.info()
+
+
 def tab2_panel3_savimgs_handler():
-    global outimgdir
+    global outimgdir, tab2_panel3_exportjob
+    if tab2_panel3_exportjob is not None and tab2_panel3_exportjob.running:
+        tab2_panel3_exportjob.cancel()
+        tab3_Div_Tb.text = """<p>cancelling the export...</p>"""
+        return
     tab3_Div_Tb.text = """"""
     dspecDF0POLsub = dspecDF0POL[dspecDF0POL['time'] >= tab3_p_dspec_vector.x_range.start][
         dspecDF0POL['time'] <= tab3_p_dspec_vector.x_range.end][
@@ -550,13 +575,21 @@ def tab2_panel3_savimgs_handler():
             outdir = ''
         if outdir:
             outimgdir = outdir
-        nfiles = len(timseq)
-        centroids = {}
-        centroids['ColorMapper'] = {'crange': [tab3_p_dspec_vector.y_range.start, tab3_p_dspec_vector.y_range.end],
-                                    'title': 'Frequency [GHz]'}
-        for sidx, ll in enumerate(timseq):
+        common = {'x_range': [tab3_p_aia_submap.x_range.start, tab3_p_aia_submap.x_range.end],
+                  'y_range': [tab3_p_aia_submap.y_range.start, tab3_p_aia_submap.y_range.end],
+                  'zorder': 1, 'figdpi': Select_Figdpi.value, 'figsize': figsize, 'alpha': alpha}
+        if Select_addplot.value == 'Vertical stack':
+            dspecdata['stack'] = 'Vstack'
+            common['dspecdata'] = dspecdata
+        elif Select_addplot.value == 'Horizontal stack':
+            dspecdata['stack'] = 'Hstack'
+            common['dspecdata'] = dspecdata
+        tasks = []
+        for ll in timseq:
             timstr = dspecDF0POLsub[dspecDF0POLsub['time'] == ll]['timestr'].iloc[0]
             maponly = True
+            centroids = {'ColorMapper': {'crange': [tab3_p_dspec_vector.y_range.start, tab3_p_dspec_vector.y_range.end],
+                                         'title': 'Frequency [GHz]'}}
             centroids['t'] = ll + timestart - tab2_dt / 2.0
             if ll in timselseq:
                 dftmp = dspecDF_selectsub[dspecDF_selectsub.time == ll][subset_label]
@@ -566,37 +599,17 @@ def tab2_panel3_savimgs_handler():
                 centroids['y'] = dftmp['shape_latitude'].as_matrix()
                 centroids['s'] = dftmp['peak'].as_matrix()
                 maponly = False
-            if Select_addplot.value == 'None':
-                ctplot.plotmap(centroids, aiamap_submap,
-                               outfile=outimgdir + timstr.replace(':', '') + '.{}'.format(Select_Figfmt.value),
-                               label='VLA {} '.format(tab2_Select_vla_pol.value) + timstr,
-                               x_range=[tab3_p_aia_submap.x_range.start, tab3_p_aia_submap.x_range.end],
-                               y_range=[tab3_p_aia_submap.y_range.start, tab3_p_aia_submap.y_range.end],
-                               maponly=maponly,
-                               zorder=1, figdpi=Select_Figdpi.value, figsize=figsize, alpha=alpha)
-            elif Select_addplot.value == 'Vertical stack':
-                dspecdata['stack'] = 'Vstack'
-                ctplot.plotmap(centroids, aiamap_submap,
-                               outfile=outimgdir + timstr.replace(':', '') + '.{}'.format(Select_Figfmt.value),
-                               label='VLA {} '.format(tab2_Select_vla_pol.value) + timstr,
-                               x_range=[tab3_p_aia_submap.x_range.start, tab3_p_aia_submap.x_range.end],
-                               y_range=[tab3_p_aia_submap.y_range.start, tab3_p_aia_submap.y_range.end],
-                               maponly=maponly,
-                               zorder=1, figdpi=Select_Figdpi.value, figsize=figsize, alpha=alpha,
-                               dspecdata=dspecdata)
-            elif Select_addplot.value == 'Horizontal stack':
-                dspecdata['stack'] = 'Hstack'
-                ctplot.plotmap(centroids, aiamap_submap,
-                               outfile=outimgdir + timstr.replace(':', '') + '.{}'.format(Select_Figfmt.value),
-                               label='VLA {} '.format(tab2_Select_vla_pol.value) + timstr,
-                               x_range=[tab3_p_aia_submap.x_range.start, tab3_p_aia_submap.x_range.end],
-                               y_range=[tab3_p_aia_submap.y_range.start, tab3_p_aia_submap.y_range.end],
-                               maponly=maponly,
-                               zorder=1, figdpi=Select_Figdpi.value, figsize=figsize, alpha=alpha,
-                               dspecdata=dspecdata)
-            tab3_Div_Tb.text = """<p>{}</p>""".format(
-                DButil.ProgressBar(sidx + 1, nfiles, suffix='Output', decimals=0, length=30, empfill='=', fill='#'))
-        tab3_Div_Tb.text = '<p>images saved to <b>{}</b>.</p>'.format(outimgdir)
+            tasks.append(((centroids,),
+                          {'outfile': outimgdir + timstr.replace(':', '') + '.{}'.format(Select_Figfmt.value),
+                           'label': 'VLA {} '.format(tab2_Select_vla_pol.value) + timstr, 'maponly': maponly}))
+        # the frames are rendered by a pool of worker processes in the background. The progress is polled by a
+        # periodic callback, so the server stays responsive during the export.
+        tab2_panel3_exportjob = DButil.ExportJob(ctplot.plotmap, tasks, args=(aiamap_submap,), common=common,
+                                                 ncpu=config_main['plot_config']['tab_FSview_base'].get(
+                                                     'export_ncpu', None)).start()
+        tab2_panel3_BUT_savimgs.label = 'Cancel export'
+        tab2_panel3_BUT_savimgs.button_type = 'danger'
+        curdoc().add_periodic_callback(tab2_panel3_savimgs_progress, 500)
     elif Output_radiogroup.active == 1:
         timstr = dspecDF0POLsub['timestr'].iloc[0]
         # fout = tkFileDialog.asksaveasfilename(initialdir=outimgdir,
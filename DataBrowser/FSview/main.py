@@ -2,6 +2,8 @@ import json
 import os, sys
 import pickle
 import time
+import threading
+import warnings
 from collections import OrderedDict
 import astropy.units as u
 from astropy.coordinates import SkyCoord
@@ -113,6 +115,110 @@ def make_spec_plt(spec_plt_R, spec_plt_L):
     return {'spec': spec_pol, 'max': spec_max_pol, 'min': spec_min_pol}
 
 
+def fits_freqidx(hdu):
+    '''
+    index of the reference frequency of a FITS image in the frequency axis of the dynamic spectrum
+    '''
+    freq_ref = '{:.3f}'.format(hdu.header['CRVAL3'] / 1e9)
+    freq = ['{:.3f}'.format(fq) for fq in tab2_freq]
+    try:
+        idxfreq = freq.index(freq_ref)
+    except:
+        idxfreq = (float(freq_ref) - float(freq[0])) / float('{:.3f}'.format(tab2_df))
+        idxfreq = int(np.round(idxfreq))
+    return idxfreq
+
+
+def vdspec_index_build():
+    '''
+    build the vector dynamic spectrum index, a memory-mapped brightness cube in [npol,nfreq,ntim,ny,nx]
+    over all the FITS images of the CleanID, so that the vector dynamic spectrum of any region is a single
+    reduction over the cube. The index is reused in later sessions as long as the FITS files are unchanged.
+    Other sessions of the same CleanID may have the index memory-mapped, so a new index is written to a
+    temporary file and renamed into place, and its JSON sidecar is written last. An index is only trusted when
+    its sidecar matches the FITS files and the size of the index file.
+    :return:
+    '''
+    global vdspec_index
+    start_timestamp = time.time()
+    hdufiles = [fits_LOCL_dir + dspecDF0.loc[ll, :]['fits_local'] for ll in xrange(tab2_ntim)]
+    mtimes = [os.path.getmtime(ll) if os.path.exists(ll) else None for ll in hdufiles]
+    indexfile = CleanID_dir + 'vdspec_index.npy'
+    infofile = CleanID_dir + 'vdspec_index.json'
+    if os.path.exists(indexfile) and os.path.exists(infofile):
+        try:
+            info = DButil.loadjsonfile(infofile)
+        except ValueError:
+            info = {}
+        if info.get('files') == hdufiles and info.get('mtimes') == mtimes and info.get(
+                'nbytes') == os.path.getsize(indexfile):
+            cube = np.load(indexfile, mmap_mode='r')
+            if list(cube.shape) == info['shape']:
+                vdspec_index = {'cube': cube, 'binpix': info['binpix']}
+                print('vdspec index loaded from {}'.format(indexfile))
+                return
+    hdu0 = read_fits(vlafile[0])
+    npol = hdu0.header['NAXIS4']
+    ny, nx = hdu0.header['NAXIS2'], hdu0.header['NAXIS1']
+    maxbytes = config_main['plot_config']['tab_FSview_base'].get('vdspec_index_maxGB', 8) * 1024 ** 3
+    binpix = 1
+    while npol * tab2_nfreq * tab2_ntim * (ny // binpix) * (nx // binpix) * 4 > maxbytes and binpix < min(ny, nx):
+        binpix *= 2
+    nyb, nxb = ny // binpix, nx // binpix
+    tmpfile = '{}.{}.tmp'.format(indexfile, os.getpid())
+    cube = np.lib.format.open_memmap(tmpfile, mode='w+', dtype=np.float32,
+                                     shape=(npol, tab2_nfreq, tab2_ntim, nyb, nxb))
+    cube[:] = np.nan
+    for ll, hdufile in enumerate(hdufiles):
+        if mtimes[ll] is None:
+            continue
+        hdu = read_fits(hdufile)
+        hdu_goodchan = goodchan(hdu)
+        idxfreq = fits_freqidx(hdu)
+        data = hdu.data[:npol, hdu_goodchan[0]:hdu_goodchan[-1] + 1, :nyb * binpix, :nxb * binpix]
+        if binpix > 1:
+            data = np.nanmean(data.reshape(data.shape[:2] + (nyb, binpix, nxb, binpix)), axis=(-1, -3))
+        if idxfreq < 0:
+            data = data[:, -idxfreq:]
+            idxfreq = 0
+        data = data[:, :tab2_nfreq - idxfreq]
+        cube[:, idxfreq:idxfreq + data.shape[1], ll] = data
+    cube.flush()
+    shape = list(cube.shape)
+    del cube
+    if os.path.exists(infofile):
+        os.remove(infofile)
+    os.rename(tmpfile, indexfile)
+    tmpinfofile = '{}.{}.tmp'.format(infofile, os.getpid())
+    DButil.updatejsonfile(tmpinfofile, {'files': hdufiles, 'mtimes': mtimes, 'binpix': binpix, 'shape': shape,
+                                        'nbytes': os.path.getsize(indexfile)})
+    os.rename(tmpinfofile, infofile)
+    vdspec_index = {'cube': np.load(indexfile, mmap_mode='r'), 'binpix': binpix}
+    print("---vdspec index built in %s seconds ---" % (time.time() - start_timestamp))
+
+
+def vdspec_from_index(x0pix, x1pix, y0pix, y1pix):
+    '''
+    vector dynamic spectrum of a region from the vdspec index
+    :return: [npol, nfreq, ntim] array
+    '''
+    binpix = vdspec_index['binpix']
+    cube = vdspec_index['cube']
+    y0b, y1b = y0pix // binpix, min(y1pix // binpix, cube.shape[-2] - 1)
+    x0b, x1b = x0pix // binpix, min(x1pix // binpix, cube.shape[-1] - 1)
+    region = np.array(cube[..., y0b:y1b + 1, x0b:x1b + 1])
+    region = region.reshape(region.shape[:3] + (-1,))
+    vdspec = np.mean(region, axis=-1)
+    # nanmean is much slower, so only use it where the region contains blanked pixels
+    bad = np.isnan(vdspec)
+    if np.any(bad):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            vdspec[bad] = np.nanmean(region[bad], axis=-1)
+    vdspec[np.isnan(vdspec)] = 0
+    return vdspec
+
+
 def tab2_vdspec_update():
     global tab2_Select_pol_opt, spec_pol_dict
     select_pol = tab2_Select_pol.value
@@ -123,59 +229,71 @@ def tab2_vdspec_update():
             tab2_BUT_vdspec.label = "Dyn Spec"
             spec_plt_R = np.zeros((tab2_nfreq, tab2_ntim))
             spec_plt_L = np.zeros((tab2_nfreq, tab2_ntim))
-            if len(pols) > 1:
-                for ll in xrange(tab2_ntim):
-                    hdufile = fits_LOCL_dir + dspecDF0.loc[ll, :]['fits_local']
-                    if os.path.exists(hdufile):
-                        hdu = read_fits(hdufile)
-                        hdu_goodchan = goodchan(hdu)
-                        nfreq_hdu = hdu_goodchan[-1] - hdu_goodchan[0] + 1
-                        freq_ref = '{:.3f}'.format(hdu.header['CRVAL3'] / 1e9)
-                        freq = ['{:.3f}'.format(fq) for fq in tab2_freq]
-                        try:
-                            idxfreq = freq.index(freq_ref)
-                        except:
-                            idxfreq = (float(freq_ref) - float(freq[0])) / float('{:.3f}'.format(tab2_df))
-                            idxfreq = int(np.round(idxfreq))
-                        vla_l = hdu.data[0, :, y0pix:y1pix + 1, x0pix:x1pix + 1]
-                        vla_r = hdu.data[1, :, y0pix:y1pix + 1, x0pix:x1pix + 1]
-                        if idxfreq >= 0:
-                            spec_plt_R[idxfreq:idxfreq + nfreq_hdu, ll] = \
-                                np.nanmean(vla_l, axis=(-1, -2))[hdu_goodchan[0]:hdu_goodchan[-1] + 1]
-                            spec_plt_L[idxfreq:idxfreq + nfreq_hdu, ll] = \
-                                np.nanmean(vla_r, axis=(-1, -2))[hdu_goodchan[0]:hdu_goodchan[-1] + 1]
-                        else:
-                            spec_plt_R[0:idxfreq + nfreq_hdu, ll] = \
-                                np.nanmean(vla_l, axis=(-1, -2))[hdu_goodchan[0] - idxfreq:hdu_goodchan[-1] + 1]
-                            spec_plt_L[0:idxfreq + nfreq_hdu, ll] = \
-                                np.nanmean(vla_r, axis=(-1, -2))[hdu_goodchan[0] - idxfreq:hdu_goodchan[-1] + 1]
+            if vdspec_index:
+                start_timestamp = time.time()
+                vdspec = vdspec_from_index(x0pix, x1pix, y0pix, y1pix)
+                vdspec[vdspec < 0] = 0
+                spec_plt_R = vdspec[0]
+                if len(pols) > 1:
+                    spec_plt_L = vdspec[1]
+                else:
+                    spec_plt_L = spec_plt_R
+                print("---vdspec from index -- %s seconds ---" % (time.time() - start_timestamp))
+            else:
+                # the index is still being built in the background, read the FITS files one by one
+                if len(pols) > 1:
+                    for ll in xrange(tab2_ntim):
+                        hdufile = fits_LOCL_dir + dspecDF0.loc[ll, :]['fits_local']
+                        if os.path.exists(hdufile):
+                            hdu = read_fits(hdufile)
+                            hdu_goodchan = goodchan(hdu)
+                            nfreq_hdu = hdu_goodchan[-1] - hdu_goodchan[0] + 1
+                            freq_ref = '{:.3f}'.format(hdu.header['CRVAL3'] / 1e9)
+                            freq = ['{:.3f}'.format(fq) for fq in tab2_freq]
+                            try:
+                                idxfreq = freq.index(freq_ref)
+                            except:
+                                idxfreq = (float(freq_ref) - float(freq[0])) / float('{:.3f}'.format(tab2_df))
+                                idxfreq = int(np.round(idxfreq))
+                            vla_l = hdu.data[0, :, y0pix:y1pix + 1, x0pix:x1pix + 1]
+                            vla_r = hdu.data[1, :, y0pix:y1pix + 1, x0pix:x1pix + 1]
+                            if idxfreq >= 0:
+                                spec_plt_R[idxfreq:idxfreq + nfreq_hdu, ll] = \
+                                    np.nanmean(vla_l, axis=(-1, -2))[hdu_goodchan[0]:hdu_goodchan[-1] + 1]
+                                spec_plt_L[idxfreq:idxfreq + nfreq_hdu, ll] = \
+                                    np.nanmean(vla_r, axis=(-1, -2))[hdu_goodchan[0]:hdu_goodchan[-1] + 1]
+                            else:
+                                spec_plt_R[0:idxfreq + nfreq_hdu, ll] = \
+                                    np.nanmean(vla_l, axis=(-1, -2))[hdu_goodchan[0] - idxfreq:hdu_goodchan[-1] + 1]
+                                spec_plt_L[0:idxfreq + nfreq_hdu, ll] = \
+                                    np.nanmean(vla_r, axis=(-1, -2))[hdu_goodchan[0] - idxfreq:hdu_goodchan[-1] + 1]
+                        tab2_Div_LinkImg_plot.text = """<p><b>Vec Dspec in calculating...</b></p><p>{}</p>""".format(
+                            DButil.ProgressBar(ll + 1, tab2_ntim + 1, decimals=0, length=16, empfill='=', fill='#'))
+                    spec_plt_R[spec_plt_R < 0] = 0
+                    spec_plt_L[spec_plt_L < 0] = 0
                     tab2_Div_LinkImg_plot.text = """<p><b>Vec Dspec in calculating...</b></p><p>{}</p>""".format(
-                        DButil.ProgressBar(ll + 1, tab2_ntim + 1, decimals=0, length=16, empfill='=', fill='#'))
-                spec_plt_R[spec_plt_R < 0] = 0
-                spec_plt_L[spec_plt_L < 0] = 0
-                tab2_Div_LinkImg_plot.text = """<p><b>Vec Dspec in calculating...</b></p><p>{}</p>""".format(
-                    DButil.ProgressBar(tab2_ntim + 1, tab2_ntim + 1, decimals=0, length=16, empfill='=',
-                                       fill='#'))
-            elif len(pols) == 1:
-                for ll in xrange(tab2_ntim):
-                    hdufile = fits_LOCL_dir + dspecDF0.loc[ll, :]['fits_local']
-                    if os.path.exists(hdufile):
-                        hdu = read_fits(hdufile)
-                        hdu_goodchan = goodchan(hdu)
-                        nfreq_hdu = hdu_goodchan[-1] - hdu_goodchan[0] + 1
-                        freq_ref = '{:.3f}'.format(hdu.header['CRVAL3'] / 1e9)
-                        freq = ['{:.3f}'.format(fq) for fq in tab2_freq]
-                        idxfreq = freq.index(freq_ref)
-                        vladata = hdu.data[0, :, y0pix:y1pix + 1, x0pix:x1pix + 1]
-                        vlaflux = np.nanmean(vladata, axis=(-1, -2))[hdu_goodchan[0]:hdu_goodchan[-1] + 1]
-                        spec_plt_R[idxfreq:idxfreq + nfreq_hdu, ll] = vlaflux
+                        DButil.ProgressBar(tab2_ntim + 1, tab2_ntim + 1, decimals=0, length=16, empfill='=',
+                                           fill='#'))
+                elif len(pols) == 1:
+                    for ll in xrange(tab2_ntim):
+                        hdufile = fits_LOCL_dir + dspecDF0.loc[ll, :]['fits_local']
+                        if os.path.exists(hdufile):
+                            hdu = read_fits(hdufile)
+                            hdu_goodchan = goodchan(hdu)
+                            nfreq_hdu = hdu_goodchan[-1] - hdu_goodchan[0] + 1
+                            freq_ref = '{:.3f}'.format(hdu.header['CRVAL3'] / 1e9)
+                            freq = ['{:.3f}'.format(fq) for fq in tab2_freq]
+                            idxfreq = freq.index(freq_ref)
+                            vladata = hdu.data[0, :, y0pix:y1pix + 1, x0pix:x1pix + 1]
+                            vlaflux = np.nanmean(vladata, axis=(-1, -2))[hdu_goodchan[0]:hdu_goodchan[-1] + 1]
+                            spec_plt_R[idxfreq:idxfreq + nfreq_hdu, ll] = vlaflux
+                        tab2_Div_LinkImg_plot.text = """<p><b>Vec Dspec in calculating...</b></p><p>{}</p>""".format(
+                            DButil.ProgressBar(ll + 1, tab2_ntim + 1, decimals=0, length=16, empfill='=', fill='#'))
+                    spec_plt_R[spec_plt_R < 0] = 0
+                    spec_plt_L = spec_plt_R
                     tab2_Div_LinkImg_plot.text = """<p><b>Vec Dspec in calculating...</b></p><p>{}</p>""".format(
-                        DButil.ProgressBar(ll + 1, tab2_ntim + 1, decimals=0, length=16, empfill='=', fill='#'))
-                spec_plt_R[spec_plt_R < 0] = 0
-                spec_plt_L = spec_plt_R
-                tab2_Div_LinkImg_plot.text = """<p><b>Vec Dspec in calculating...</b></p><p>{}</p>""".format(
-                    DButil.ProgressBar(tab2_ntim + 1, tab2_ntim + 1, decimals=0, length=16, empfill='=',
-                                       fill='#'))
+                        DButil.ProgressBar(tab2_ntim + 1, tab2_ntim + 1, decimals=0, length=16, empfill='=',
+                                           fill='#'))
             tab2_Div_LinkImg_plot.text = '<p><b>Vec Dspec calculated.</b></p>'
             spec_pol_dict = make_spec_plt(spec_plt_R, spec_plt_L)
             tab2_bl_pol_cls_change(None, select_pol)
@@ -221,7 +339,8 @@ def tab2_panel_XCorr_update():
         dspecSel = tab2_r_dspec.data_source.data['image'][0][freqidx0:(freqidx1 + 1), timeidx0:(timeidx1 + 1)]
         freqSel = tab2_freq[freqidx0:(freqidx1 + 1)]
         timSel = tab2_tim[timeidx0:(timeidx1 + 1)]
-        CC_dict = DButil.XCorrMap(dspecSel, timSel, freqSel)
+        CC_dict = DButil.XCorrMap(dspecSel, timSel, freqSel,
+                                  ncpu=config_main['plot_config']['tab_FSview_base'].get('xcorr_ncpu', None))
         CC_save = struct_dir + 'CC_save.npz'
         np.savez(CC_save, spec=dspecSel, specfit=CC_dict['zfit'], ccmax=CC_dict['ccmax'], ccpeak=CC_dict['ccpeak'],
                  tim=CC_dict['x'], ntim=CC_dict['nx'], timfit=CC_dict['xfit'], ntimfit=CC_dict['nxfit'],
@@ -276,8 +395,27 @@ def tab2_bl_pol_cls_change(bl_index, select_pol):
     tab2_p_dspec_yPro.x_range.end = spec_pol_dict['max'][select_pol]
 
 
+def load_LinkImg_frame(tidx):
+    '''
+    load the FITS image of a time step into memory for the frame cache
+    :return: a tuple of (fitsfile, hdu, hdu_goodchan). hdu is None if the file is not found
+    '''
+    if not 0 <= tidx < len(tab2_LinkImg_fitsfile):
+        return None
+    fitsfile = tab2_LinkImg_fitsfile[tidx]
+    hdufile = fits_LOCL_dir + fitsfile
+    if not os.path.exists(hdufile):
+        return (fitsfile, None, None)
+    hdulist = fits.open(hdufile, memmap=False)
+    hdu = hdulist[0]
+    hdu.data
+    hdulist.close()
+    return (fitsfile, hdu, goodchan(hdu))
+
+
 def slider_LinkImg_update(polonly=False):
     global hdu, select_vla_pol, dspecDF0, tidx_prev
+    start_timestamp = time.time()
     select_vla_pol = tab2_Select_vla_pol.value
     tab2_Slider_time_LinkImg.start = next(
         i for i in xrange(tab2_ntim) if tab2_dtim[i] >= tab2_p_dspec.x_range.start)
@@ -295,22 +433,10 @@ def slider_LinkImg_update(polonly=False):
     tab2_r_dspec_line_y.data_source.data = ColumnDataSource(
         pd.DataFrame({'time': [tab2_dtim[0], tab2_dtim[-1]],
                       'freq': [tab2_freq[fidx], tab2_freq[fidx]]})).data
-    timeidxs = np.unique(dspecDF0['time'])
-    fitsfile = dspecDF0[dspecDF0.time == timeidxs[tidx]].iloc[0]['fits_local']
-    hdufile = fits_LOCL_dir + fitsfile
-    print hdufile
-    if os.path.exists(hdufile):
-        if tidx != tidx_prev:
-            if not polonly or not 'hdu' in globals():
-                hdu = read_fits(hdufile)
-        hdu_goodchan = goodchan(hdu)
-        freq_ref = '{:.3f}'.format(hdu.header['CRVAL3'] / 1e9)
-        freq = ['{:.3f}'.format(fq) for fq in tab2_freq]
-        try:
-            idxfreq = freq.index(freq_ref)
-        except:
-            idxfreq = (float(freq_ref) - float(freq[0])) / float('{:.3f}'.format(tab2_df))
-            idxfreq = int(np.round(idxfreq))
+    fitsfile, hdu_frame, hdu_goodchan = tab2_LinkImg_frames.get(tidx)
+    if hdu_frame is not None:
+        hdu = hdu_frame
+        idxfreq = fits_freqidx(hdu)
         fidx_hdu = fidx - idxfreq
         print 'tidx,tidx_prev,fidx:', tidx, tidx_prev, fidx_hdu
         if hdu_goodchan[0] <= fidx_hdu <= hdu_goodchan[-1]:
@@ -335,6 +461,8 @@ def slider_LinkImg_update(polonly=False):
     else:
         tab2_Div_LinkImg_plot.text = '<p><b>{}</b> not found.</p>'.format(fitsfile)
     tidx_prev = tidx
+    print("---slider_LinkImg_update -- tidx {} -- {:.3f} seconds -- frame cache {} ---".format(
+        tidx, time.time() - start_timestamp, tab2_LinkImg_frames.cache.info()))
 
 
 def tab3_slider_LinkImg_update(attrname, old, new):
@@ -431,13 +559,12 @@ def tab2_update_MapRES(attrname, old, new):
     aia_resampled_pfmap = PuffinMap(smap=aia_resampled_map,
                                     plot_height=config_main['plot_config']['tab_FSview_base']['aia_hght'],
                                     plot_width=config_main['plot_config']['tab_FSview_base']['aia_wdth'])
-    tab2_r_aia.data_source.data['image'] = aia_resampled_pfmap.ImageSource()['data']
+    aia_resampled_pfmap.UpdateTiles(tab2_p_aia, tab2_r_aia)
     hmi_resampled_map = hmimap.resample(dimensions)
     hmi_resampled_pfmap = PuffinMap(smap=hmi_resampled_map,
                                     plot_height=config_main['plot_config']['tab_FSview_base']['vla_hght'],
                                     plot_width=config_main['plot_config']['tab_FSview_base']['vla_wdth'])
-    # SRC_HMI = hmi_resampled_pfmap.ImageSource()
-    tab2_r_hmi.data_source.data['image'] = hmi_resampled_pfmap.ImageSource()['data']
+    hmi_resampled_pfmap.UpdateTiles(tab2_p_hmi, tab2_r_hmi)
     print("---tab2_update_MapRES -- %s seconds ---" % (time.time() - start_timestamp))
 
 
@@ -963,7 +1090,8 @@ if os.path.exists(FS_dspecDF):
                                         plot_height=config_main['plot_config']['tab_FSview_base']['aia_hght'],
                                         plot_width=config_main['plot_config']['tab_FSview_base']['aia_wdth'])
 
-        tab2_p_aia, tab2_r_aia = aia_resampled_pfmap.PlotMap(DrawLimb=True, DrawGrid=True, grid_spacing=20 * u.deg)
+        tab2_p_aia, tab2_r_aia = aia_resampled_pfmap.PlotMap(DrawLimb=True, DrawGrid=True, grid_spacing=20 * u.deg,
+                                                             tiled=True)
         tab2_p_aia.multi_line(xs='xs', ys='ys', line_color='line_color', source=tab2_SRC_vlamap_contour, alpha=0.7,
                               line_width=2)
         tab2_p_aia.title.text_font_size = '6pt'
@@ -995,7 +1123,7 @@ if os.path.exists(FS_dspecDF):
         tab2_p_hmi, tab2_r_hmi = hmi_resampled_pfmap.PlotMap(DrawLimb=True, DrawGrid=True, grid_spacing=20 * u.deg,
                                                              x_range=tab2_p_aia.x_range,
                                                              y_range=tab2_p_aia.y_range,
-                                                             palette=bokehpalette_sdohmimag)
+                                                             palette=bokehpalette_sdohmimag, tiled=True)
         tab2_p_hmi.multi_line(xs='xs', ys='ys', line_color='line_color', source=tab2_SRC_vlamap_contour, alpha=0.7,
                               line_width=2)
         tab2_p_hmi.yaxis.visible = False
@@ -1095,9 +1223,20 @@ if os.path.exists(FS_dspecDF):
         if hdu.header['NAXIS4'] == 4 and len(SXY.intersection(Spol)) == 4:
             pols = pols + ['I', 'V']
 
+        vdspec_index = None
+        vdspec_index_thread = threading.Thread(target=vdspec_index_build)
+        vdspec_index_thread.daemon = True
+        vdspec_index_thread.start()
+
         tab2_Select_vla_pol = Select(title="Polarization:", value=pols[0], options=pols,
                                      width=config_main['plot_config']['tab_FSview_base']['widgetbox_wdth'])
 
+        # the FITS images of the time steps are cached and the neighbouring steps are prefetched
+        tab2_LinkImg_fitsfile = list(dspecDF0.groupby('time')['fits_local'].first())
+        tab2_LinkImg_frames = DButil.FramePrefetcher(load_LinkImg_frame, maxbytes=config_main['plot_config'][
+                                                         'tab_FSview_base'].get('LinkImg_cache_MB', 1024) * 1024 ** 2,
+                                                     sizeof=lambda frame: frame[1].data.nbytes if frame[1] else 0)
+
         tab2_CTRLs_LinkImg = [tab2_Slider_time_LinkImg, tab2_Slider_freq_LinkImg, tab2_Select_vla_pol]
         for ctrl in tab2_CTRLs_LinkImg:
             ctrl.on_change('value', tab3_slider_LinkImg_update)
@@ -3,6 +3,7 @@ from bokeh.models import (
     ColumnDataSource)
 import pandas as pd
 import suncasa.utils.jdutil as jdutil
+import suncasa.utils.QLook_util as QLook_util
 import os
 from astropy.io import fits
 import sunpy.map
@@ -213,40 +214,12 @@ if prep_posmaxfit:
         fits_local.append(structure_id + '_' + timestr + '_' + freqstr + '.slfcal.image.cutout.fits')
         fits_global.append(structure_id + '_' + timestr + '_' + freqstr + '.slfcal.image.fits')
 
-    Gauss_params = []
-    start_timestamp = time.time()
-
-
-    def func(vla_local_fitspath=None, iterable=None):
-        if os.path.exists(vla_local_fitspath + iterable):
-            hdulist = fits.open(vla_local_fitspath + iterable)
-            hdu = hdulist[0]
-            vlamap = sunpy.map.Map((hdu.data[0, 0, :, :], hdu.header))
-            gauss_params = maxfit(vlamap, plot=False)
-            fexist = True
-        else:
-            gauss_params = np.empty((7))
-            gauss_params[:] = np.nan
-            fexist = False
-        return [gauss_params, fexist]
-
-
-    func_partial = partial(func, vla_local_fitspath)
-    iterable = fits_local
     import multiprocessing as mp
 
-    ncpu = mp.cpu_count() / 2
-    pool = mp.Pool(processes=ncpu)
-    result = []
-    # dummpy = pool.map_async(func_partial,iterable)
-    for iterable in fits_local:
-        result.append(pool.apply_async(func_partial, (iterable,)))
-    pool.close()
-    pool.join()
-
-    print("--- %s seconds ---" % (time.time() - start_timestamp))
-    for res in result:
-        Gauss_params.append((res.get()))
+    # fits of consecutive times of each frequency are seeded with the previous solution
+    fitres = QLook_util.gaussfit_files(vla_local_fitspath, fits_local, rowlen=int(ntim), batchsize=64,
+                                       ncpu=max(mp.cpu_count() / 2, 1))
+    Gauss_params = [[params, fexist] for params, fexist in zip(fitres['params'], fitres['fexist'])]
 
     dspecDF = pd.DataFrame({'time': xx - xx[0],
                             'freq': yy,
@@ -264,7 +237,10 @@ if prep_posmaxfit:
                             'y_width': [ll[0][4] for ll in Gauss_params],
                             'amp_gaus': [ll[0][0] for ll in Gauss_params],
                             'theta': [ll[0][5] for ll in Gauss_params],
-                            'amp_offset': [ll[0][6] for ll in Gauss_params]})
+                            'amp_offset': [ll[0][6] for ll in Gauss_params],
+                            'fit_status': fitres['status'],
+                            'fit_nfev': fitres['nfev'],
+                            'fit_rate': fitres['fitrate']})
 
     with open('dspecDF-save', 'wb') as f:
         pickle.dump(dspecDF, f)
@@ -274,43 +250,19 @@ else:
 
 # prep the thumbnails of the vla images
 if prep_thumbnail:
-    start_timestamp = time.time()
-    plt.ioff()
+    import multiprocessing as mp
+
+    fitsfiles, thumbfiles, params = [], [], []
     for ll in range(len(dspecDF)):
-        # for ll in range(408,409):
-        # for ll in range(7812,7813):
-        if not os.path.exists(vla_local_thumbnailpath + dspecDF.loc[ll]['fits_local'][0:-4] + 'small.jpg'):
-            if not np.isnan(dspecDF.loc[ll]['x_pos']) and dspecDF.loc[ll]['amp_gaus'] > 0:
-                hdulist = fits.open(vla_local_fitspath + dspecDF.loc[ll]['fits_local'])
-                hdu = hdulist[0]
-                vlamap = sunpy.map.Map((hdu.data[0, 0, :, :], hdu.header))
-                nx, ny = vlamap.data.shape
-                dx, dy = vlamap.scale.x.value, vlamap.scale.y.value
-                xc, yc = vlamap.center.x.value, vlamap.center.y.value
-                mapx, mapy = (np.linspace(0, nx - 1, nx) - vlamap.reference_pixel.x.value + 1 + 0.5) * dx + xc, (
-                np.linspace(0, ny - 1, ny) - vlamap.reference_pixel.y.value + 1 + 0.5) * dy + yc
-                mapx, mapy = np.meshgrid(mapx, mapy)
-                fig = plt.figure(figsize=(4, 4))
-                ax1 = plt.subplot(111, projection=vlamap)
-                im = vlamap.plot()
-                # plt.colorbar()
-                ax1.set_autoscale_on(False)
-                popt = [dspecDF.loc[ll, :]['amp_gaus'],
-                        dspecDF.loc[ll, :]['x_pos'],
-                        dspecDF.loc[ll, :]['y_pos'],
-                        dspecDF.loc[ll, :]['x_width'],
-                        dspecDF.loc[ll, :]['y_width'],
-                        dspecDF.loc[ll, :]['theta'],
-                        dspecDF.loc[ll, :]['amp_offset']]
-                data_fitted = twoD_Gaussian((mapx, mapy), *popt).reshape(nx, ny)
-                plt.plot((popt[1] * u.arcsec).to(u.deg), (popt[2] * u.arcsec).to(u.deg), 'o',
-                    transform=ax1.get_transform('world'), markersize=3)
-                print np.amax(data_fitted), ll
-                if popt[0] + popt[6] > 0:
-                    plt.contour((mapx * u.arcsec).to(u.deg), (mapy * u.arcsec).to(u.deg), data_fitted,
-                        levels=(np.arange(5, 10, 2) / 10.0 * (popt[0] + popt[6])).tolist(),
-                        transform=ax1.get_transform('world'))
-                fig.tight_layout()
-                fig.savefig(vla_local_thumbnailpath + dspecDF.loc[ll]['fits_local'][0:-4] + 'small.jpg')
-                plt.close(fig)
-    print("--- %s seconds ---" % (time.time() - start_timestamp))
+        if not np.isnan(dspecDF.loc[ll]['x_pos']) and dspecDF.loc[ll]['amp_gaus'] > 0:
+            fitsfiles.append(vla_local_fitspath + dspecDF.loc[ll]['fits_local'])
+            thumbfiles.append(vla_local_thumbnailpath + dspecDF.loc[ll]['fits_local'][0:-4] + 'small.jpg')
+            params.append([dspecDF.loc[ll, :]['amp_gaus'],
+                           dspecDF.loc[ll, :]['x_pos'],
+                           dspecDF.loc[ll, :]['y_pos'],
+                           dspecDF.loc[ll, :]['x_width'],
+                           dspecDF.loc[ll, :]['y_width'],
+                           dspecDF.loc[ll, :]['theta'],
+                           dspecDF.loc[ll, :]['amp_offset']])
+    QLook_util.make_thumbnails(fitsfiles, thumbfiles, params=params, cmap='jet', size=256,
+                               ncpu=max(mp.cpu_count() / 2, 1))
@@ -118,7 +118,8 @@ def tab2_panel_XCorr_update():
         dspecSel = tab2_r_dspec.data_source.data['image'][0][freqidx0:(freqidx1 + 1), timeidx0:(timeidx1 + 1)]
         freqSel = tab2_freq[freqidx0:(freqidx1 + 1)]
         timSel = tab2_tim[timeidx0:(timeidx1 + 1)]
-        CC_dict = DButil.XCorrMap(dspecSel, timSel, freqSel)
+        CC_dict = DButil.XCorrMap(dspecSel, timSel, freqSel,
+                                  ncpu=config_main['plot_config']['tab_ToClean'].get('xcorr_ncpu', None))
         CC_save = struct_dir + 'CC_save.npz'
         np.savez(CC_save, spec=dspecSel, specfit=CC_dict['zfit'], ccmax=CC_dict['ccmax'], ccpeak=CC_dict['ccpeak'],
                  tim=CC_dict['x'], ntim=CC_dict['nx'], timfit=CC_dict['xfit'], ntimfit=CC_dict['nxfit'],
@@ -1,4 +1,5 @@
 import os
+import copy
 import astropy.units as u
 import bokeh.palettes as bp
 import pickle
@@ -25,8 +26,7 @@ __email__ = "sijie.yu@njit.edu"
 def update_sdosubmp_image(fileidx):
     global sdomap, sdosubmp
     if not sdosubmpdict:
-        sdomap = sunpy.map.Map(sdofile[fileidx])
-        sdomap = DButil.normalize_aiamap(sdomap)
+        sdomap = loadsdomap(sdofile[fileidx])
         sdosubmp = sdomap.submap(u.Quantity([x0 * u.arcsec, x1 * u.arcsec]),
                                  u.Quantity([y0 * u.arcsec, y1 * u.arcsec]))
     else:
@@ -54,35 +54,31 @@ def aiamap_wavelength_selection(attrname, old, new):
 
 def Running_diff_img(sdompdict, ratio=False):
     global datastep
-    datastep = Slider_datadt.value / AIAcadence
-    maps = sdosubmpdict['submc'].maps
+    datastep = int(Slider_datadt.value / AIAcadence)
+    maps = sdompdict['submc'].maps
+    datacube = DButil.mkdiffcube([smap.data for smap in maps], mode='rratio' if ratio else 'rdiff', lag=datastep)
     for sidx, smap in enumerate(maps):
         if sidx < datastep:
             sdompdict['mask'][sidx] = False
         else:
             sdompdict['mask'][sidx] = True
-            if ratio:
-                sdompdict['submc'].maps[sidx].data = smap.data / maps[sidx - datastep].data
-            else:
-                sdompdict['submc'].maps[sidx].data = smap.data - maps[sidx - datastep].data
-        Div_info.text = """<p>{}</p>""".format(
-            DButil.ProgressBar(sidx + 1, nsdofile, suffix='Update', decimals=0, length=14, empfill='=', fill='#'))
+            smap.data = datacube[sidx]
+    Div_info.text = """<p>{}</p>""".format(
+        DButil.ProgressBar(nsdofile, nsdofile, suffix='Update', decimals=0, length=14, empfill='=', fill='#'))
     return sdompdict
 
 
 def Base_diff_img(sdompdict, ratio=False):
-    maps = sdosubmpdict['submc'].maps
+    maps = sdompdict['submc'].maps
+    datacube = DButil.mkdiffcube([smap.data for smap in maps], mode='bratio' if ratio else 'bdiff')
     for sidx, smap in enumerate(maps):
         if sidx == 0:
             sdompdict['mask'][sidx] = False
         else:
             sdompdict['mask'][sidx] = True
-            if ratio:
-                sdompdict['submc'].maps[sidx].data = smap.data / maps[0].data
-            else:
-                sdompdict['submc'].maps[sidx].data = smap.data - maps[0].data
-        Div_info.text = """<p>{}</p>""".format(
-            DButil.ProgressBar(sidx + 1, nsdofile, suffix='Update', decimals=0, length=14, empfill='=', fill='#'))
+            smap.data = datacube[sidx]
+    Div_info.text = """<p>{}</p>""".format(
+        DButil.ProgressBar(nsdofile, nsdofile, suffix='Update', decimals=0, length=14, empfill='=', fill='#'))
     return sdompdict
 
 
@@ -201,13 +197,47 @@ def ImgOption_checkbox_handler(new):
     LoadChunk_handler()
 
 
+def loadsdomap(sfile):
+    '''
+    decoded and normalized full-disk map of a sdo file, from the chunk cache if available
+    '''
+    key = ('map', sfile)
+    smap = chunkcache.get(key)
+    if smap is None:
+        smap = DButil.normalize_aiamap(sunpy.map.Map(sfile))
+        chunkcache.put(key, smap, arrays=[smap.data])
+    return smap
+
+
+def loadsdosubmap(sfile, fov):
+    '''
+    submap of a sdo file in the FOV [x0, y0, x1, y1], from the chunk cache if available.
+    Only the submaps are cached here. The full-disk maps of a whole chunk would not fit in the cache
+    '''
+    key = ('submap', sfile, tuple(fov))
+    submap = chunkcache.get(key)
+    if submap is None:
+        if ('map', sfile) in chunkcache:
+            smap = chunkcache.get(('map', sfile))
+        else:
+            smap = DButil.normalize_aiamap(sunpy.map.Map(sfile))
+        submap = smap.submap(u.Quantity([fov[0] * u.arcsec, fov[2] * u.arcsec]),
+                             u.Quantity([fov[1] * u.arcsec, fov[3] * u.arcsec]))
+        # submap may return a view of the full-disk data, which would keep the full-disk frame alive
+        submap.data = submap.data.copy()
+        chunkcache.put(key, submap, arrays=[submap.data])
+    return submap
+
+
+def chunkcacheinfo():
+    return '<p>chunk cache: {}</p>'.format(chunkcache.info())
+
+
 def LoadChunk():
     sdosubmplist = []
     timestamps = []
     for sidx, sfile in enumerate(sdofile):
-        sdomaptmp = DButil.normalize_aiamap(sunpy.map.Map(sfile))
-        sdosubmptmp = sdomaptmp.submap(u.Quantity([x0 * u.arcsec, x1 * u.arcsec]),
-                                       u.Quantity([y0 * u.arcsec, y1 * u.arcsec]))
+        sdosubmptmp = loadsdosubmap(sfile, [x0, y0, x1, y1])
         sdosubmplist.append(sdosubmptmp)
         timestamps.append(Time(sdosubmptmp.meta['date-obs'].replace('T', ' '), format='iso', scale='utc').jd)
         Div_info.text = """<p>{}</p>""".format(
@@ -219,11 +249,25 @@ def LoadChunk():
                           sdompdict['time'] <= trange.jd[0] + Slider_trange.range[1] / 24. / 3600)
     sdompdict['mask'] = mask
     Div_info.text = """<p>{}</p>""".format(
-        DButil.ProgressBar(nsdofile + 1, nsdofile + 1, suffix='Load', decimals=0, length=16, empfill='=', fill='#'))
+        DButil.ProgressBar(nsdofile + 1, nsdofile + 1, suffix='Load', decimals=0, length=16, empfill='=',
+                           fill='#')) + chunkcacheinfo()
     return sdompdict
 
 
 def LoadSubChunk(sdompdict):
+    key = ('submc', tuple(sdofile), tuple(sdompdict['FOV']), x0, y0, x1, y1, tuple(ImgOption_checkbox.active))
+    submc = chunkcache.get(key)
+    if submc is None:
+        submc = MkSubChunk(sdompdict)
+        # the maps of submc are views of the cached submaps unless they have been filtered or derotated
+        chunkcache.put(key, submc, arrays=[smap.data for smap in submc.maps])
+    else:
+        Div_info.text = chunkcacheinfo()
+    # the diff images replace the data of the maps, so the cached maps are not handed out directly
+    return sunpy.map.Map([copy.copy(smap) for smap in submc.maps], cube=True)
+
+
+def MkSubChunk(sdompdict):
     sdosubmplist = []
     for sidx, smap in enumerate(sdompdict['mc'].maps):
         sdosubmptmp = smap.submap(u.Quantity([x0 * u.arcsec, x1 * u.arcsec]),
@@ -231,6 +275,8 @@ def LoadSubChunk(sdompdict):
         if ImgOption_checkbox.active == [1]:
             if sidx == 0:
                 grid = DButil.smapmeshgrid2(sdosubmptmp)
+            # the data are shared with the cached submap of the file, which the radial filter would modify in place
+            sdosubmptmp = sunpy.map.Map(sdosubmptmp.data.copy(), sdosubmptmp.meta)
             sdosubmptmp = DButil.smapradialfilter(sdosubmptmp, grid=grid)
         sdosubmplist.append(sdosubmptmp)
         Div_info.text = """<p>{}</p>""".format(
@@ -242,7 +288,8 @@ def LoadSubChunk(sdompdict):
     # if imagetype != 'image':
     #     DiffImg_update()
     Div_info.text = """<p>{}</p>""".format(
-        DButil.ProgressBar(nsdofile + 1, nsdofile + 1, suffix='Update', decimals=0, length=14, empfill='=', fill='#'))
+        DButil.ProgressBar(nsdofile + 1, nsdofile + 1, suffix='Update', decimals=0, length=14, empfill='=',
+                           fill='#')) + chunkcacheinfo()
     return submc
 
 
@@ -296,7 +343,8 @@ def LoadChunkfromfile(fin):
 def DumpChunk(fout):
     if sdosubmpdict:
         with open(fout, 'wb') as fp:
-            pickle.dump({'chunk': sdosubmpdict, 'x0': x0, 'x1': x1, 'y0': y0, 'y1': y1}, fp)
+            pickle.dump({'chunk': sdosubmpdict, 'x0': x0, 'x1': x1, 'y0': y0, 'y1': y1}, fp,
+                        pickle.HIGHEST_PROTOCOL)
         Div_info.text = """<p><b>Chunk dumped </b> to {}.</p>""".format(fout)
     else:
         Div_info.text = """<p>load the <b>chunk</b> first!!!</p>"""
@@ -515,24 +563,26 @@ def ClearDraw():
     Div_submapcoord.text=""""""
 
 
+def getctslit(cutslit):
+    ctslit = cutslit.copy()
+    for key in ctslit.keys():
+        if not key in ['posangs', 'posangs2']:
+            if 'x' in key:
+                ctslit[key] = ctslit[key] * Canvas_scaleX
+            elif 'y' in key:
+                ctslit[key] = ctslit[key] * Canvas_scaleY
+            else:
+                ctslit[key] = ctslit[key] * Canvas_scale
+    return ctslit
+
+
 def getimprofile(smap, cutslit, plot=True):
     global ctslit
     num = len(cutslit['xcen'])
     if num > 1:
-        ctslit = cutslit.copy()
-        for key in ctslit.keys():
-            if not key in ['posangs', 'posangs2']:
-                if 'x' in key:
-                    ctslit[key] = ctslit[key] * Canvas_scaleX
-                elif 'y' in key:
-                    ctslit[key] = ctslit[key] * Canvas_scaleY
-                else:
-                    ctslit[key] = ctslit[key] * Canvas_scale
-        intens = np.zeros(num)
-        for ll in xrange(num):
-            inten = DButil.improfile(smap.data, [ctslit['xs0'][ll], ctslit['xs1'][ll]],
-                                     [ctslit['ys0'][ll], ctslit['ys1'][ll]], interp='nearest')
-            intens[ll] = np.mean(inten)
+        ctslit = getctslit(cutslit)
+        slitidx = DButil.improfileidx(ctslit['xs0'], ctslit['ys0'], ctslit['xs1'], ctslit['ys1'], smap.data.shape)
+        intens = DButil.improfilecube([smap.data], slitidx)[0]
         intens = intens / smap.exposure_time.value
         intensdist = {'x': ctslit['dist'] * np.mean([smap.scale[0].value, smap.scale[1].value]), 'y': intens}
         if plot:
@@ -619,15 +669,18 @@ def MkStackplt():
     global stackpltdict
     if sdosubmpdict:
         if len(cutslitplt['xcen']) > 0:
-            stackplt = []
-            for sidx, smap in enumerate(sdosubmpdict['submc'].maps):
-                if sdosubmpdict['mask'][sidx]:
-                    intens = getimprofile(smap, cutslitplt, plot=False)
-                    stackplt.append(intens['y'])
-            if len(stackplt) > 1:
-                stackplt = np.vstack(stackplt)
+            smaps = [smap for sidx, smap in enumerate(sdosubmpdict['submc'].maps) if sdosubmpdict['mask'][sidx]]
+            if len(smaps) > 1:
+                smap = smaps[0]
+                ctslit = getctslit(cutslitplt)
+                # the slit coordinates are computed once and all the selected frames are sampled in one pass
+                slitidx = DButil.improfileidx(ctslit['xs0'], ctslit['ys0'], ctslit['xs1'], ctslit['ys1'],
+                                              smap.data.shape)
+                stackplt = DButil.improfilecube([ll.data for ll in smaps], slitidx, verbose=True)
+                stackplt = stackplt / np.array([ll.exposure_time.value for ll in smaps])[:, None]
                 stackplt = stackplt.transpose()
-                stackpltdict = {'zz': stackplt, 'x': sdosubmpdict['time'][sdosubmpdict['mask']], 'y': intens['x'],
+                stackpltdict = {'zz': stackplt, 'x': sdosubmpdict['time'][sdosubmpdict['mask']],
+                                'y': ctslit['dist'] * np.mean([smap.scale[0].value, smap.scale[1].value]),
                                 'wavelength': '{:.0f}'.format(smap.wavelength.value), 'observatory': smap.observatory,
                                 'instrument': smap.instrument[0:3]}
                 Div_info.text = """<p>click <b>Stackplt</b> to view the stack plot</p>"""
@@ -774,12 +827,13 @@ slitfile = database_dir + 'cutslit-' + PlotID
 chunkfile = database_dir + 'chunk-{}-'.format(MkPlot_args_dict['wavelength']) + PlotID
 cutslitplt = {}
 sdosubmpdict = {}
+chunkcache = DButil.LRUCache(
+    maxbytes=config_main['plot_config']['tab_MkPlot'].get('chunkcache_MB', 2048) * 1024 ** 2)
 AIAcadence = config_main['plot_config']['tab_MkPlot']['AIA_cadence'][MkPlot_args_dict['wavelength']]
 datastep = 1
 sdosubmp_quadselround = 0
 sdo_RSPmap_quadselround = 0
-sdomap = sunpy.map.Map(sdofile[sdofileidx])
-sdomap = DButil.normalize_aiamap(sdomap)
+sdomap = loadsdomap(sdofile[sdofileidx])
 MapRES = config_main['plot_config']['tab_MkPlot']['aia_RSPmap_RES']
 dimensions = u.Quantity([MapRES, MapRES], u.pixel)
 sdo_RSPmap = sdomap.resample(dimensions)
@@ -787,7 +841,7 @@ sdo_RSP_pfmap = PuffinMap(smap=sdo_RSPmap,
                           plot_height=config_main['plot_config']['tab_MkPlot']['aia_RSPmap_hght'],
                           plot_width=config_main['plot_config']['tab_MkPlot']['aia_RSPmap_wdth'])
 p_sdomap, r_sdomap = sdo_RSP_pfmap.PlotMap(DrawLimb=True, DrawGrid=True, grid_spacing=20 * u.deg,
-                                           tools='crosshair,pan,wheel_zoom,reset,save')
+                                           tools='crosshair,pan,wheel_zoom,reset,save', tiled=True)
 mapx_sdo_RSPmap, mapy_sdo_RSPmap = sdo_RSP_pfmap.meshgrid(rescale=1.0)
 mapx_sdo_RSPmap, mapy_sdo_RSPmap = mapx_sdo_RSPmap.value, mapy_sdo_RSPmap.value
 ndy, ndx = mapx_sdo_RSPmap.shape
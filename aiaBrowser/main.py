@@ -19,6 +19,8 @@ import drms
 from sunpy.lightcurve import GOESLightCurve
 from sunpy.time import TimeRange
 from suncasa.utils import DButil
+from suncasa.utils import sdocatalog
+from suncasa.utils import jsocdownload
 
 __author__ = ["Sijie Yu"]
 __email__ = "sijie.yu@njit.edu"
@@ -388,18 +390,21 @@ def DownloadData():
                                                                        isexists=True))
                 if len(idx2download) > 0:
                     Div_JSOC_info.text = Div_JSOC_info.text + """<p><b>Downloading</b>....</p>"""
-                    r.download(SDOdir, index=idx2download)
+                    # concurrent and resumable transfers. The files are placed into the YYYY/MM/DD tree
+                    # only after they are complete.
+                    downloader = jsocdownload.DownloadManager(SDOdir,
+                                                              nthreads=config_main['core'].get('JSOC_nthreads', 4))
+                    filename = downloader.download(list(r.urls['url'].iloc[idx2download]),
+                                                   list(r.urls['filename'].iloc[idx2download]))
+                    Div_JSOC_info.text = Div_JSOC_info.text + """<p>{}</p>""".format(downloader.info())
+                    if downloader.failed:
+                        Div_JSOC_info.text = Div_JSOC_info.text + """<p>Failed: {}. """.format(
+                            ', '.join(sorted(downloader.failed.keys()))) + """Download again to resume.</p>"""
+                    if len(filename) > 0:
+                        sdocatalog.SDOCatalog(SDOdir).add_files(filename)
                 else:
                     Div_JSOC_info.text = Div_JSOC_info.text + """<p>Target file(s) existed.</p>"""
 
-                filename = glob.glob(SDOdir + '*.fits')
-                if len(filename) > 0:
-                    dirs = DButil.getsdodir(filename)
-                    for ll, dd in enumerate(dirs['dir']):
-                        if not os.path.exists(SDOdir + dd):
-                            os.makedirs(SDOdir + dd)
-                        os.system('mv {}/*{}*.fits {}{}'.format(SDOdir, dirs['timstr'][ll], SDOdir, dd))
-
                 Div_JSOC_info.text = Div_JSOC_info.text + """<p>Download <b>finished</b>.</p>"""
                 Div_JSOC_info.text = Div_JSOC_info.text + """<p>file(s) downloaded to <b>{}</b></p>""".format(
                     os.path.abspath(SDOdir))
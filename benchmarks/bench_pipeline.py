@@ -0,0 +1,284 @@
+'''
+Throughput benchmarks of the imaging pipeline on synthetic EOVSA-like data, with no network access.
+
+    casa --nologger -c benchmarks/bench_pipeline.py --size small
+    python benchmarks/bench_pipeline.py --cases jdutil
+    casa --nologger -c benchmarks/bench_pipeline.py --cases jy2tb --size large --set nchan=50
+
+Cases that need CASA (import, ptclean, imreg, jy2tb, pmaxfit) are recorded as skipped when they run outside CASA.
+The import case has not been validated in CASA yet; treat its first 'failed' record as a bug of the
+synthetic UDB file rather than of importeovsa.
+Every run appends one JSON line per case to the history file, and is compared with the previous run of the
+same case and size.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+__author__ = ["Sijie Yu"]
+__email__ = "sijie.yu@njit.edu"
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+if benchdir not in sys.path:
+    sys.path.insert(0, benchdir)
+import synthdata
+
+sizes = {'small': {'nant': 6, 'ntime': 20, 'nchan': 8, 'npix': 128, 'nimg': 10, 'njd': 10 ** 5},
+         'medium': {'nant': 13, 'ntime': 60, 'nchan': 30, 'npix': 256, 'nimg': 40, 'njd': 10 ** 6},
+         'large': {'nant': 13, 'ntime': 300, 'nchan': 30, 'npix': 512, 'nimg': 200, 'njd': 10 ** 7}}
+
+cases = OrderedDict()
+
+
+class Skip(Exception):
+    pass
+
+
+def benchmark(name, unit):
+    '''
+    register a benchmark case. The case is called as func(workdir, size, ncpu) and returns the number of units
+    it has processed in the timed part, and the seconds it took.
+    '''
+
+    def decorator(func):
+        cases[name] = (func, unit)
+        return func
+
+    return decorator
+
+
+def requirecasa():
+    try:
+        import taskinit
+    except ImportError:
+        raise Skip('CASA is not available')
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.time()
+    res = func(*args, **kwargs)
+    return res, time.time() - t0
+
+
+def getms(workdir, size):
+    msname = os.path.join(workdir, 'synth.ms')
+    if not os.path.exists(msname):
+        synthdata.mk_ms(msname, nant=size['nant'], ntime=size['ntime'], nchan=size['nchan'])
+    return msname
+
+
+@benchmark('import', 'rows/s')
+def bench_import(workdir, size, ncpu):
+    requirecasa()
+    try:
+        import aipy
+    except ImportError:
+        raise Skip('aipy is not available')
+    from suncasa.tasks import task_importeovsa as timporteovsa
+    # importeovsa only handles the full 16 antenna EOVSA array
+    nant = 16
+    udb = synthdata.mk_udb(os.path.join(workdir, 'UDB20170715200000'), nant=nant, ntime=size['ntime'],
+                           nchan=size['nchan'])
+    msdir = os.path.join(workdir, 'import') + '/'
+    os.makedirs(msdir)
+    res, tdur = timeit(timporteovsa.importeovsa, idbfiles=[udb], ncpu=1, timebin="0s", width=1, visprefix=msdir,
+                       nocreatms=False, doconcat=False, modelms="", doscaling=False, keep_nsclms=False, udb_corr=False)
+    return size['ntime'] * nant * (nant + 1) / 2, tdur
+
+
+@benchmark('ptclean', 'slices/s')
+def bench_ptclean(workdir, size, ncpu):
+    requirecasa()
+    from ptclean_cli import ptclean_cli as ptclean
+    msname = getms(workdir, size)
+    imdir = os.path.join(workdir, 'ptclean') + '/'
+    os.makedirs(imdir)
+    res, tdur = timeit(ptclean, vis=msname, imageprefix=imdir, imagesuffix='.synth', twidth=1, ncpu=ncpu, niter=50,
+                       gain=0.05, imsize=[size['npix'], size['npix']], cell=['5arcsec'], stokes='XX', doreg=False,
+                       usephacenter=False, overwrite=True, toTb=False)
+    json.dump(res, open(os.path.join(imdir, 'res.json'), 'w'))
+    return sum(res['Succeeded']), tdur
+
+
+@benchmark('imreg', 'images/s')
+def bench_imreg(workdir, size, ncpu):
+    requirecasa()
+    from suncasa.utils import helioimage2fits as hf
+    msname = getms(workdir, size)
+    resfile = os.path.join(workdir, 'ptclean', 'res.json')
+    if not os.path.exists(resfile):
+        raise Skip('needs the images of the ptclean case')
+    res = json.load(open(resfile))
+    images = [ll for ll, ok in zip(res['ImageName'], res['Succeeded']) if ok][:size['nimg']]
+    idx = [res['ImageName'].index(ll) for ll in images]
+    # CASA time ranges from the fits time stamps of ptclean
+    timerange = ['{}~{}'.format(res['BeginTime'][ll].replace('-', '/').replace('T', '/'),
+                                res['EndTime'][ll].replace('-', '/').replace('T', '/')) for ll in idx]
+    # a fixed ephemeris of the sun instead of a JPL Horizons query
+    mjd0 = 57949.833333
+    ephem = {'time': [mjd0, mjd0 + 1], 'ra': [synthdata.sun_ra] * 2, 'dec': [synthdata.sun_dec] * 2,
+             'p0': [-2.] * 2, 'delta': [1.0163] * 2}
+    msinfo = hf.read_msinfo(msname)
+    fitsfiles = [ll + '.fits' for ll in images]
+    res, tdur = timeit(hf.imreg, vis=msname, ephem=ephem, msinfo=msinfo, imagefile=images, timerange=timerange,
+                       fitsfile=fitsfiles, usephacenter=False)
+    return sum([os.path.exists(ll) for ll in fitsfiles]), tdur
+
+
+@benchmark('jy2tb', 'planes/s')
+def bench_jy2tb(workdir, size, ncpu):
+    requirecasa()
+    import numpy as np
+    from astropy.io import fits
+    from suncasa.utils import helioimage2fits as hf
+    nchan, npix = size['nchan'], size['npix']
+    hdr = fits.Header()
+    hdr['NAXIS1'], hdr['NAXIS2'], hdr['NAXIS3'], hdr['NAXIS4'] = npix, npix, nchan, 1
+    hdr['CTYPE3'], hdr['CUNIT3'], hdr['CRVAL3'], hdr['CDELT3'], hdr['CRPIX3'] = 'FREQ', 'Hz', 3.4e9, 2.5e8, 1.
+    hdr['CTYPE4'] = 'STOKES'
+    bmaj = np.linspace(60., 10., nchan)
+    cube = synthdata.gaussian_planes(nchan, npix).reshape(1, nchan, npix, npix)
+    tdur = 0.
+    for n in range(size['nimg']):
+        data = cube.copy()
+        hdr['BUNIT'] = 'Jy/beam'
+        res, t = timeit(hf.imjy2tb, data, hdr, bmaj, bmaj * 0.7, beamunit='arcsec')
+        tdur += t
+    return size['nimg'] * nchan, tdur
+
+
+@benchmark('pmaxfit', 'planes/s')
+def bench_pmaxfit(workdir, size, ncpu):
+    requirecasa()
+    from suncasa.tasks.task_pmaxfit import pmaxfit
+    nchan, npol = 4, 1
+    files = synthdata.mk_fits_images(os.path.join(workdir, 'fits'), nimg=size['nimg'], npix=size['npix'],
+                                     nchan=nchan, npol=npol)
+    res, tdur = timeit(pmaxfit, files, ncpu, '', 5)
+    return len(files) * nchan * npol, tdur
+
+
+@benchmark('jdutil', 'timestamps/s')
+def bench_jdutil(workdir, size, ncpu):
+    import numpy as np
+    from suncasa.utils import jdutil
+    jd = 2451545. + np.random.RandomState(0).uniform(-20000, 20000, size['njd'])
+    res, tdur = timeit(jdutil.jd_to_datetime64, jd)
+    return size['njd'], tdur
+
+
+def gitcommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=benchdir,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def readhistory(historyfile):
+    history = []
+    if os.path.exists(historyfile):
+        with open(historyfile) as fp:
+            for line in fp:
+                if line.strip():
+                    history.append(json.loads(line))
+    return history
+
+
+def run(casenames=None, size='small', ncpu=1, historyfile=None, workdir=None, keep=False, tolerance=0.1,
+        overrides=None):
+    '''
+    run the benchmark cases, append the results to the history file and compare them with the previous run
+    :param casenames: list of the cases to run. Default is all
+    :param size: name of the size preset
+    :param ncpu: number of processes of the parallel tasks
+    :param historyfile: JSON lines file of the results. Default is benchmarks/history.jsonl
+    :param workdir: directory of the synthetic data. Default is a temporary directory
+    :param keep: if True, keep the synthetic data
+    :param tolerance: fractional drop of the rate reported as a regression
+    :param overrides: dict to override the size parameters
+    :return: list of the result records
+    '''
+    if historyfile is None:
+        historyfile = os.path.join(benchdir, 'history.jsonl')
+    params = dict(sizes[size])
+    if overrides:
+        params.update(overrides)
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='suncasa_bench_')
+    elif not os.path.exists(workdir):
+        os.makedirs(workdir)
+    history = readhistory(historyfile)
+    info = {'commit': gitcommit(), 'host': socket.gethostname(), 'python': platform.python_version(),
+            'tstamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'size': size, 'params': params, 'ncpu': ncpu}
+    records = []
+    try:
+        for name in (casenames or cases.keys()):
+            func, unit = cases[name]
+            record = dict(info, case=name, unit=unit)
+            try:
+                nunits, tdur = func(workdir, params, ncpu)
+                record.update(status='ok', nunits=nunits, seconds=tdur, rate=nunits / max(tdur, 1e-9))
+            except Skip as err:
+                record.update(status='skipped', reason=str(err))
+            except Exception as err:
+                record.update(status='failed', reason='{}: {}'.format(type(err).__name__, err))
+            records.append(record)
+            report(record, history, tolerance)
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(historyfile, 'a') as fp:
+        for record in records:
+            fp.write(json.dumps(record, sort_keys=True) + '\n')
+    return records
+
+
+def report(record, history, tolerance=0.1):
+    if record['status'] != 'ok':
+        print '{:10s} {}: {}'.format(record['case'], record['status'], record.get('reason', ''))
+        return
+    line = '{:10s} {:12.1f} {:14s} ({} in {:.2f} s)'.format(record['case'], record['rate'], record['unit'],
+                                                            record['nunits'], record['seconds'])
+    prev = [ll for ll in history if ll['case'] == record['case'] and ll['status'] == 'ok' and
+            ll['params'] == record['params'] and ll['ncpu'] == record['ncpu']]
+    if prev:
+        ratio = record['rate'] / prev[-1]['rate']
+        line += ' {:.2f}x of {}'.format(ratio, prev[-1]['commit'] or prev[-1]['tstamp'])
+        if ratio < 1 - tolerance:
+            line += ' REGRESSION'
+    print line
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='benchmarks of the imaging pipeline on synthetic data')
+    parser.add_argument('--cases', default='', help='comma separated cases: ' + ','.join(cases.keys()))
+    parser.add_argument('--size', default='small', choices=sorted(sizes.keys()))
+    parser.add_argument('--ncpu', type=int, default=1)
+    parser.add_argument('--history', default=None, help='JSON lines history file')
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic data')
+    parser.add_argument('--set', default=[], action='append', metavar='KEY=VALUE',
+                        help='override a size parameter, e.g., --set ntime=120')
+    args = parser.parse_args(argv)
+    overrides = dict([(ll.split('=')[0], int(ll.split('=')[1])) for ll in args.set])
+    casenames = [ll for ll in args.cases.split(',') if ll] or None
+    run(casenames, size=args.size, ncpu=args.ncpu, historyfile=args.history, workdir=args.workdir, keep=args.keep,
+        overrides=overrides)
+
+
+if __name__ == '__main__':
+    # under "casa -c", sys.argv also carries the arguments of casa itself
+    argv = sys.argv[1:]
+    for ll, arg in enumerate(sys.argv):
+        if arg.endswith('bench_pipeline.py'):
+            argv = sys.argv[ll + 1:]
+    main(argv)
@@ -0,0 +1,185 @@
+'''
+Generators of synthetic EOVSA-like inputs for the benchmarks. Nothing here needs network access.
+The MS and CASA image generators must run inside CASA, and the UDB generator needs aipy.
+'''
+import os
+import numpy as np
+
+__author__ = ["Sijie Yu"]
+__email__ = "sijie.yu@njit.edu"
+
+# EOVSA site and a compact layout of 2.1 m dishes in local east/north/up coordinates (meters)
+eovsa_lon, eovsa_lat, eovsa_alt = '-118.286952deg', '37.233889deg', '1207m'
+reftime = '2017/07/15/20:00:00'
+sun_ra, sun_dec = 1.3919, 0.3753  # rad, the sun on 2017 Jul 15
+
+
+def antenna_layout(nant, maxbl=1100., seed=0):
+    '''
+    :return: east, north, up offsets of the antennas in meters
+    '''
+    rs = np.random.RandomState(seed)
+    r = maxbl / 2. * np.sqrt(rs.uniform(0.02, 1, nant))
+    phi = rs.uniform(0, 2 * np.pi, nant)
+    return r * np.cos(phi), r * np.sin(phi), np.zeros(nant)
+
+
+def gaussian_planes(nplane, npix, seed=0):
+    '''
+    images of elliptical Gaussian sources at random positions, one per plane
+    :return: array of shape (nplane, npix, npix)
+    '''
+    rs = np.random.RandomState(seed)
+    y, x = np.mgrid[0:npix, 0:npix]
+    planes = np.empty((nplane, npix, npix), dtype=np.float32)
+    for ll in range(nplane):
+        x0, y0 = rs.uniform(0.3, 0.7, 2) * npix
+        sx, sy = rs.uniform(0.02, 0.06, 2) * npix
+        planes[ll] = 1e6 * np.exp(-((x - x0) / sx) ** 2 / 2. - ((y - y0) / sy) ** 2 / 2.) + rs.normal(0, 1e3, (
+            npix, npix))
+    return planes
+
+
+def mk_fits_images(outdir, nimg=10, npix=256, nchan=4, npol=1, cell=5.):
+    '''
+    write EOVSA-like registered FITS images, with axes [stokes, freq, y, x] and helioprojective coordinates
+    :param outdir:
+    :param nimg: number of images (time steps)
+    :param npix: image size
+    :param nchan: number of frequency planes per image
+    :param npol: number of polarizations
+    :param cell: pixel size in arcsec
+    :return: list of the FITS files
+    '''
+    from astropy.io import fits
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    files = []
+    for n in range(nimg):
+        data = gaussian_planes(npol * nchan, npix, seed=n).reshape(npol, nchan, npix, npix)
+        hdu = fits.PrimaryHDU(data)
+        hdr = hdu.header
+        hdr['CTYPE1'], hdr['CUNIT1'], hdr['CRVAL1'], hdr['CDELT1'], hdr['CRPIX1'] = 'HPLN-TAN', 'arcsec', 0., cell, (
+                npix + 1) / 2.
+        hdr['CTYPE2'], hdr['CUNIT2'], hdr['CRVAL2'], hdr['CDELT2'], hdr['CRPIX2'] = 'HPLT-TAN', 'arcsec', 0., cell, (
+                npix + 1) / 2.
+        hdr['CTYPE3'], hdr['CUNIT3'], hdr['CRVAL3'], hdr['CDELT3'], hdr['CRPIX3'] = 'FREQ', 'Hz', 3.4e9, 2.5e9, 1.
+        hdr['CTYPE4'], hdr['CRVAL4'], hdr['CDELT4'], hdr['CRPIX4'] = 'STOKES', -5., -1., 1.
+        hdr['DATE-OBS'] = '2017-07-15T20:{:02d}:{:02d}.000'.format(n / 60 % 60, n % 60)
+        hdr['EXPTIME'] = 1.
+        hdr['TELESCOP'] = 'EOVSA'
+        hdr['BUNIT'] = 'K'
+        hdr['RSUN_OBS'] = 944.
+        hdr['DSUN_OBS'] = 1.52e11
+        hdr['HGLT_OBS'] = 4.6
+        hdr['HGLN_OBS'] = 0.
+        fname = os.path.join(outdir, 'eovsa_synth_{:04d}.fits'.format(n))
+        hdu.writeto(fname, overwrite=True)
+        files.append(fname)
+    return files
+
+
+def mk_ms(msname, nant=13, ntime=60, nchan=30, inttime=1., flux=1e4):
+    '''
+    simulate an EOVSA-like MS of a point source at the sun center with the CASA simulator
+    :param msname:
+    :param nant: number of antennas
+    :param ntime: number of integrations
+    :param nchan: number of 500 MHz wide channels starting at 2.9 GHz, in one spw
+    :param inttime: integration time in seconds
+    :param flux: flux density of the source in Jy
+    :return: msname
+    '''
+    from taskinit import smtool, metool, cltool
+    if os.path.exists(msname):
+        os.system('rm -rf {}'.format(msname))
+    sm, me, cl = smtool(), metool(), cltool()
+    east, north, up = antenna_layout(nant)
+    refloc = me.position('wgs84', eovsa_lon, eovsa_lat, eovsa_alt)
+    sm.open(msname)
+    sm.setconfig(telescopename='EOVSA', x=east, y=north, z=up, dishdiameter=[2.1] * nant, mount=['alt-az'] * nant,
+                 antname=['eo{:02d}'.format(ll + 1) for ll in range(nant)], padname=['pad'] * nant,
+                 coordsystem='local', referencelocation=refloc)
+    sm.setspwindow(spwname='band', freq='2.9GHz', deltafreq='0.5GHz', freqresolution='0.5GHz', nchannels=nchan,
+                   stokes='XX YY')
+    sm.setfeed(mode='perfect X Y')
+    srcdir = me.direction('J2000', '{}rad'.format(sun_ra), '{}rad'.format(sun_dec))
+    sm.setfield(sourcename='Sun', sourcedirection=srcdir)
+    sm.settimes(integrationtime='{}s'.format(inttime), usehourangle=False, referencetime=me.epoch('utc', reftime))
+    sm.observe('Sun', 'band', starttime='0s', stoptime='{}s'.format(ntime * inttime))
+    cllist = msname + '.cl'
+    os.system('rm -rf {}'.format(cllist))
+    cl.addcomponent(dir=srcdir, flux=flux, fluxunit='Jy', freq='2.9GHz', shape='point')
+    cl.rename(cllist)
+    cl.close()
+    sm.setdata()
+    sm.predict(complist=cllist)
+    sm.setnoise(mode='simplenoise', simplenoise='{}Jy'.format(flux / 100.))
+    sm.corrupt()
+    sm.close()
+    return msname
+
+
+def mk_udb(udbname, nant=13, ntime=60, nchan=30, npol=4, inttime=1.):
+    '''
+    write an EOVSA-like MIRIAD UDB file with aipy. It carries the variables that importeovsa and
+    impteovsa.creatms read (antlist, sfreq, sdf, npol, nants, source, proj, ra, dec, obsra, obsdec, antpos,
+    telescop, pol) and all the auto and cross correlations. creatms reshapes antpos to 16 antennas and
+    configures the 27 m dishes and equatorial mounts by antenna index, so importeovsa needs nant=16.
+    antpos is padded with zeros to 16 antennas for smaller arrays.
+    :return: udbname
+    '''
+    import aipy
+    if os.path.exists(udbname):
+        os.system('rm -rf {}'.format(udbname))
+    uv = aipy.miriad.UV(udbname, status='new')
+    uv._wrhd('obstype', 'crosscorrelation')
+    uv._wrhd('history', 'synthetic EOVSA data for benchmarks\n')
+    for var, vtype in [('antlist', 'a'), ('source', 'a'), ('proj', 'a'), ('telescop', 'a'), ('operator', 'a'),
+                       ('version', 'a'), ('antpos', 'd'),
+                       ('nants', 'i'), ('npol', 'i'), ('nchan', 'i'), ('nspect', 'i'), ('pol', 'i'),
+                       ('sfreq', 'd'), ('sdf', 'd'), ('freq', 'd'), ('inttime', 'r'), ('ra', 'd'), ('dec', 'd'),
+                       ('obsra', 'd'), ('obsdec', 'd'), ('lst', 'd'), ('epoch', 'r'), ('longitu', 'd'),
+                       ('latitud', 'd'), ('ischan', 'i'), ('nschan', 'i')]:
+        uv.add_var(var, vtype)
+    uv['antlist'] = ' '.join([str(ll + 1) for ll in range(nant)])
+    uv['source'] = 'Sun'
+    uv['proj'] = 'NormalObserving'
+    uv['telescop'] = 'EOVSA'
+    uv['operator'] = 'benchmark'
+    uv['version'] = '0.1'
+    uv['nants'] = nant
+    uv['npol'] = npol
+    uv['nchan'] = nchan
+    uv['nspect'] = nchan
+    sfreq = 2.9 + 0.5 * np.arange(nchan)
+    uv['sfreq'] = sfreq
+    uv['sdf'] = np.ones(nchan) * 0.5
+    uv['freq'] = sfreq[0]
+    uv['ischan'] = np.arange(1, nchan + 1, dtype=np.int32)
+    uv['nschan'] = np.ones(nchan, dtype=np.int32)
+    uv['inttime'] = inttime
+    uv['ra'] = uv['obsra'] = sun_ra
+    uv['dec'] = uv['obsdec'] = sun_dec
+    uv['epoch'] = 2000.
+    uv['longitu'] = np.radians(-118.286952)
+    uv['latitud'] = np.radians(37.233889)
+    east, north, up = antenna_layout(nant)
+    # antenna positions in ns, as [antenna, (east, north, up)]
+    antpos = np.zeros((max(nant, 16), 3))
+    antpos[:nant] = np.array([east, north, up]).T / 0.299792458
+    uv['antpos'] = antpos.flatten()
+    rs = np.random.RandomState(0)
+    jd0 = 2457950.333333  # 2017-07-15 20:00 UT
+    for t in range(ntime):
+        jd = jd0 + t * inttime / 86400.
+        uv['lst'] = 0.
+        for i in range(nant):
+            for j in range(i, nant):
+                uvw = np.array([east[j] - east[i], north[j] - north[i], up[j] - up[i]]) / 0.299792458
+                for k in range(npol):
+                    uv['pol'] = -5 - k
+                    data = (1e4 * (1 + 0.01 * rs.normal(size=nchan)) + 0j).astype(np.complex64)
+                    uv.write((uvw, jd, (i, j)), np.ma.array(data, mask=np.zeros(nchan, dtype=bool)))
+    del uv
+    return udbname
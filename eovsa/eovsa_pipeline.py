@@ -289,7 +289,136 @@ def mk_qlook_image(trange, doimport=False, docalib=False, ncpu=10, twidth=12, st
 
     return imres
 
-def plt_qlook_image(imres,figdir=None,verbose=True): 
+def _qlook_limb_grid(plttime):
+    '''
+    :return: the radius of the solar limb in arcsec and the x, y of the heliographic grid at plttime, with the
+            grid lines joined into one path separated by nans
+    '''
+    from sunpy import sun
+    import sunpy.wcs as wcs
+    rsun = sun.solar_semidiameter_angular_size(plttime).value
+    b0 = sun.heliographic_solar_center(plttime)[1].value
+    dsun = sun.sunearth_distance(plttime).to(u.meter).value
+    # all the grid lines are joined into one path separated by nans, so it is drawn as a single artist
+    gridx, gridy = [], []
+    for lat in np.arange(-90, 90, 15):
+        x, y = wcs.convert_hg_hpc(np.linspace(-180, 180, num=361), lat * np.ones(361), b0_deg=b0, l0_deg=0.,
+                                  dsun_meters=dsun, occultation=True)
+        gridx += [x, [np.nan]]
+        gridy += [y, [np.nan]]
+    for lon in np.arange(-180, 180, 15):
+        x, y = wcs.convert_hg_hpc(lon * np.ones(181), np.linspace(-90, 90, num=181), b0_deg=b0, l0_deg=0.,
+                                  dsun_meters=dsun, occultation=True)
+        gridx += [x, [np.nan]]
+        gridy += [y, [np.nan]]
+    return rsun, np.hstack(gridx), np.hstack(gridy)
+
+
+def _qlook_fig_template(plttime, spws, figsize=(8, 8)):
+    '''
+    build the figure template of the quick look images: one axes per spw with an image artist, the solar limb,
+    the heliographic grid and the labels. The dynamic artists are animated, so they are left out of the
+    background and drawn on top of it (blitted) for each frame.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib import colors, cm
+    from matplotlib.patches import Circle
+    nspw = len(spws)
+    fig = Figure(figsize=figsize)
+    canvas = FigureCanvasAgg(fig)
+    fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
+    rsun, gridx, gridy = _qlook_limb_grid(plttime)
+    axes = []
+    for n, spwran in enumerate(spws):
+        ax = fig.add_subplot(nspw / 2, 2, n + 1)
+        im = ax.imshow(np.zeros((2, 2)), cmap=cm.get_cmap('jet'), norm=colors.Normalize(vmin=-1e5, vmax=1e6),
+                       origin='lower', interpolation='nearest', extent=[-1280, 1280, -1280, 1280], animated=True)
+        artists = [im, ax.add_patch(Circle((0, 0), rsun, fill=False, color='w', animated=True))]
+        artists += ax.plot(gridx, gridy, color='w', linestyle='dotted', linewidth=0.5, animated=True)
+        freqran = [int(s) * 0.5 + 2.9 for s in spwran.split('~')]
+        artists.append(ax.text(0.98, 0.01, '{0:.1f} - {1:.1f} GHz'.format(freqran[0], freqran[1]), color='w',
+                               transform=ax.transAxes, fontweight='bold', ha='right', animated=True))
+        ax.set_xlim([-1080, 1080])
+        ax.set_ylim([-1080, 1080])
+        ax.set_xticklabels([''])
+        ax.set_yticklabels([''])
+        axes.append((ax, im, artists))
+    timetext = fig.text(0.01, 0.98, '', color='w', fontweight='bold', fontsize=12, ha='left', animated=True)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    return {'fig': fig, 'canvas': canvas, 'axes': axes, 'timetext': timetext, 'background': background}
+
+
+def _plt_qlook_frames(args):
+    '''
+    render a chunk of quick look frames with one figure template. Only the image data, the limb, the grid and
+    the time label change between the frames, and the artists are blitted on the saved background.
+    The images are resampled to 256 x 256 pixels like Map.resample does in the sunpy map path.
+    '''
+    from astropy.io import fits
+    from PIL import Image
+    from sunpy.image.resample import resample
+    frames, spws, figdir, verbose = args
+    template = None
+    nfig = 0
+    for isot, images, suci in frames:
+        plttime = Time(isot)
+        if template is None:
+            template = _qlook_fig_template(plttime, spws)
+        canvas = template['canvas']
+        canvas.restore_region(template['background'])
+        rsun, gridx, gridy = _qlook_limb_grid(plttime)
+        for n, (ax, im, artists) in enumerate(template['axes']):
+            data, extent = None, None
+            if suci[n]:
+                try:
+                    with fits.open(images[n]) as hdul:
+                        data = np.squeeze(hdul[0].data)
+                        hdr = hdul[0].header
+                    data = resample(data.T, (256, 256), 'linear', center=True).T
+                    extent = [hdr['CRVAL1'] + (0.5 - hdr['CRPIX1']) * hdr['CDELT1'],
+                              hdr['CRVAL1'] + (hdr['NAXIS1'] + 0.5 - hdr['CRPIX1']) * hdr['CDELT1'],
+                              hdr['CRVAL2'] + (0.5 - hdr['CRPIX2']) * hdr['CDELT2'],
+                              hdr['CRVAL2'] + (hdr['NAXIS2'] + 0.5 - hdr['CRPIX2']) * hdr['CDELT2']]
+                except:
+                    data = None
+            if data is None:
+                # an empty map
+                data, extent = np.zeros((2, 2)), [-1280, 1280, -1280, 1280]
+            im.set_data(data)
+            im.set_extent(extent)
+            artists[1].set_radius(rsun)
+            artists[2].set_data(gridx, gridy)
+            for artist in artists:
+                ax.draw_artist(artist)
+        template['timetext'].set_text(plttime.iso[:19])
+        template['fig'].draw_artist(template['timetext'])
+        figname = 'eovsa_qlimg_' + plttime.isot.replace(':', '').replace('-', '')[:15] + '.png'
+        figdir_ = figdir + plttime.to_datetime().strftime("%Y/%m/%d/")
+        if not os.path.exists(figdir_):
+            try:
+                os.makedirs(figdir_)
+            except OSError:
+                pass
+        if verbose:
+            print 'Saving plot to :' + figdir_ + figname
+        Image.fromarray(np.asarray(canvas.buffer_rgba())[:, :, :3]).save(figdir_ + figname, compress_level=1)
+        nfig += 1
+    return nfig
+
+
+def plt_qlook_image(imres,figdir=None,verbose=True,ncpu=None): 
+    '''
+    plot the quick look images
+    :param imres: image results returned by mk_qlook_image
+    :param figdir: directory to save the figures
+    :param verbose:
+    :param ncpu: if None, plot the frames one by one with sunpy maps. Otherwise the frames are split into
+                contiguous chunks, and each of the ncpu worker processes renders its chunk with a reused
+                figure template.
+    :return:
+    '''
     from matplotlib import pyplot as plt
     from sunpy import map as smap
     from sunpy import sun
@@ -313,6 +442,34 @@ def plt_qlook_image(imres,figdir=None,verbose=True):
     spws_sort = spws[inds].reshape(ntime,nspw)
     if verbose:
         print '{0:d} figures to plot'.format(ntime)
+    if ncpu is not None:
+        import multiprocessing as mprocs
+        import time
+        frames = []
+        for i in range(ntime):
+            plttime = btimes_sort[i, 0]
+            tofd = plttime.mjd - np.fix(plttime.mjd)
+            if tofd < 16. / 24. or sum(suc_sort[i]) < nspw - 2:
+                continue
+            frames.append((plttime.isot, list(images_sort[i]), list(suc_sort[i])))
+        if not frames:
+            return
+        ncpu = max(1, min(ncpu, len(frames)))
+        nchunk = int(np.ceil(len(frames) / float(ncpu)))
+        args = [(frames[ll:ll + nchunk], list(spws_sort[0]), figdir, verbose) for ll in range(0, len(frames), nchunk)]
+        t0 = time.time()
+        if ncpu == 1:
+            nfig = sum(map(_plt_qlook_frames, args))
+        else:
+            pool = mprocs.Pool(ncpu)
+            nfig = sum(pool.map(_plt_qlook_frames, args))
+            pool.close()
+            pool.join()
+        if verbose:
+            tdur = time.time() - t0
+            print '{0:d} figures plotted in {1:.1f} s ({2:.2f} frames/s) with {3:d} processes'.format(
+                nfig, tdur, nfig / max(tdur, 1e-6), ncpu)
+        return
     plt.ioff()
     fig=plt.figure(figsize=(8,8))
     plt.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
@@ -408,8 +565,68 @@ def plt_qlook_image(imres,figdir=None,verbose=True):
         plt.savefig(figdir_+figname)
     plt.close(fig)
 
-def qlook_image_pipeline(date, twidth=10, ncpu=15, doimport=False, docalib=False):
+def _qlook_import_scan(scan, udbpath='', mspath='', doimport=False, doscaling=False):
+    '''
+    import stage of the quick look pipeline: import one UDB scan to a ms if it has not been imported
+    :return: path of the ms, or None if it is not available
+    '''
+    msfile = mspath + scan + '.ms'
+    if not os.path.exists(msfile) and doimport:
+        timporteovsa.importeovsa(idbfiles=[udbpath + scan], ncpu=1, timebin="0s", width=1,
+                                 visprefix=mspath, nocreatms=False, doconcat=False, modelms="", doscaling=doscaling,
+                                 keep_nsclms=False, udb_corr=True)
+    if os.path.exists(msfile):
+        return msfile
+    else:
+        return None
+
+
+def _qlook_calib_scan(scan, vis, docalib=False):
+    '''
+    calibration stage of the quick look pipeline
+    :return: path of the calibrated ms
+    '''
+    if not docalib:
+        return vis
+    vis = calibeovsa.calibeovsa([vis], caltype=['refpha', 'phacal'], interp='nearest',
+                                doflag=True, flagant='13~15', doimage=False, doconcat=False)
+    if vis:
+        return vis[0]
+    else:
+        return None
+
+
+def _qlook_image_scan(scan, vis, imagedirs=None, twidth=10, ncpu=1):
+    '''
+    imaging stage of the quick look pipeline
+    :param imagedirs: dict of {scan: image directory}. Default is the current directory
+    :return: imres of the scan
+    '''
+    imagedir = imagedirs[scan] if imagedirs else './'
+    return mk_qlook_image(vis, twidth=twidth, ncpu=ncpu, imagedir=imagedir, verbose=True)
+
+
+def _qlook_render_scan(scan, imres, figdir='./', ncpu=None):
+    '''
+    rendering stage of the quick look pipeline
+    :param ncpu: as pltncpu of qlook_image_pipeline, so that both paths use the same renderer
+    :return: True
+    '''
+    plt_qlook_image(imres, figdir=figdir, verbose=False, ncpu=ncpu)
+    return True
+
+
+def qlook_image_pipeline(date, twidth=10, ncpu=15, doimport=False, docalib=False, dag=False, stagelimits=None,
+                         pltncpu=None):
     ''' date: date string or Time object. e.g., '2017-07-15' or Time('2017-07-15')
+        ncpu: number of processes used for imaging
+        pltncpu: number of processes used for plotting the quick look images with the figure template renderer.
+             Default is None, which plots them one by one with sunpy maps
+        dag: if True, each scan flows through import -> calibrate -> image -> render on its own, instead of
+             running every stage for the whole day before the next one. The state of the tasks is kept in
+             qlook_state.sqlite under the quick look fits directory, so a rerun skips the finished tasks.
+        stagelimits: dict of the maximum number of concurrent tasks of each stage when dag is True.
+             e.g., {'import': 1, 'calibrate': 1, 'image': 2, 'render': 1}. ncpu is shared by the image tasks.
     '''
     import pytz
     from datetime import datetime
@@ -429,14 +646,58 @@ def qlook_image_pipeline(date, twidth=10, ncpu=15, doimport=False, docalib=False
         qlookfigdir='/common/webplots/qlookimg_10m/'
 
     imagedir=qlookfitsdir
+    if dag:
+        return qlook_image_dag(date, imagedir=imagedir, figdir=qlookfigdir, twidth=twidth, ncpu=ncpu,
+                               doimport=doimport, docalib=docalib, stagelimits=stagelimits, pltncpu=pltncpu)
     if docalib:
         vis=calib_pipeline(date,doimport=doimport)
     imres=mk_qlook_image(date, twidth=twidth, ncpu=ncpu, doimport=doimport, docalib=docalib, imagedir=imagedir,verbose=True)
     figdir=qlookfigdir
-    plt_qlook_image(imres,figdir=figdir,verbose=True)
+    plt_qlook_image(imres,figdir=figdir,verbose=True,ncpu=pltncpu)
     
 
 
 
 
     
+
+
+def qlook_image_dag(date, imagedir='./', figdir='./', twidth=10, ncpu=15, doimport=False, docalib=False,
+                    stagelimits=None, pltncpu=None, verbose=True):
+    '''
+    run the quick look pipeline of a day as a task graph. Each scan goes through import -> calibrate -> image
+    -> render as soon as its previous stage is finished, so the first quick look images are out long before
+    the whole day is imaged. The latency of the first task of each stage is recorded in the state store.
+    :param date: Time object of the date
+    :param stagelimits: dict of the maximum number of concurrent tasks of each stage
+    :param pltncpu: ncpu of plt_qlook_image in the render stage. Default is None, the sunpy map renderer
+    :return: a dict of {scan: (last finished stage, its result)}
+    '''
+    from functools import partial
+    from suncasa.eovsa import qlook_dag
+    mslist = trange2ms(trange=date, doimport=False)
+    scans = mslist['udbfile']
+    tsts = sorted([l.to_datetime() for l in mslist['tstlist']])
+    imagedirs = {}
+    for scan, tst in zip(scans, tsts):
+        imagedirs[scan] = imagedir + tst.strftime("%Y/%m/%d/")
+        if not os.path.exists(imagedirs[scan]):
+            os.makedirs(imagedirs[scan])
+    limits = {'import': 1, 'calibrate': 1, 'image': 2, 'render': 1}
+    if stagelimits:
+        limits.update(stagelimits)
+    stages = [('import', partial(_qlook_import_scan, udbpath=mslist['udbpath'], mspath=mslist['mspath'],
+                                 doimport=doimport)),
+              ('calibrate', partial(_qlook_calib_scan, docalib=docalib)),
+              ('image', partial(_qlook_image_scan, imagedirs=imagedirs, twidth=twidth,
+                                ncpu=max(1, ncpu / limits['image']))),
+              ('render', partial(_qlook_render_scan, figdir=figdir, ncpu=pltncpu))]
+    datestr = date.iso[:10]
+    store = qlook_dag.StateStore(imagedir + 'qlook_state.sqlite')
+    graph = qlook_dag.TaskGraph(stages, limits=limits, store=store, date=datestr, verbose=verbose)
+    results = graph.run(scans)
+    if verbose:
+        print 'task summary of {}: {}'.format(datestr, store.summary(datestr))
+        if 'render' in graph.first:
+            print 'first quick look image of {} rendered {:.1f} s after start'.format(datestr, graph.first['render'])
+    return results
@@ -0,0 +1,233 @@
+import os
+import time
+import pickle
+import sqlite3
+import multiprocessing as mprocs
+import threading
+import Queue
+
+
+class StateStore:
+    '''
+    A persistent record of the pipeline tasks, stored as a sqlite file. Each task is identified by
+    (date, scan, stage). Finished tasks keep their results so that a rerun of the pipeline skips them.
+    '''
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        dbdir = os.path.dirname(os.path.abspath(dbfile))
+        if not os.path.exists(dbdir):
+            os.makedirs(dbdir)
+        conn = self.connect()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS tasks (date TEXT, scan TEXT, stage TEXT, status TEXT, '
+                         'tstart REAL, tend REAL, result BLOB, error TEXT, PRIMARY KEY (date, scan, stage))')
+            conn.execute('CREATE TABLE IF NOT EXISTS metrics (date TEXT, name TEXT, value REAL, tstamp REAL)')
+        conn.close()
+
+    def connect(self):
+        return sqlite3.connect(self.dbfile, timeout=30)
+
+    def get(self, date, scan, stage):
+        '''
+        :return: a dict of the task record, or None if the task has never been run
+        '''
+        conn = self.connect()
+        res = conn.execute('SELECT status, tstart, tend, result, error FROM tasks WHERE date = ? AND scan = ? AND '
+                           'stage = ?', (date, scan, stage)).fetchone()
+        conn.close()
+        if res is None:
+            return None
+        return {'status': res[0], 'tstart': res[1], 'tend': res[2],
+                'result': pickle.loads(str(res[3])) if res[3] is not None else None, 'error': res[4]}
+
+    def set(self, date, scan, stage, status, tstart=None, tend=None, result=None, error=None):
+        conn = self.connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (date, scan, stage, status, tstart, tend,
+                          sqlite3.Binary(pickle.dumps(result, pickle.HIGHEST_PROTOCOL)) if result is not None else None,
+                          error))
+        conn.close()
+
+    def summary(self, date):
+        '''
+        :return: a dict of {stage: {status: number of tasks}}
+        '''
+        conn = self.connect()
+        res = conn.execute('SELECT stage, status, count(*) FROM tasks WHERE date = ? GROUP BY stage, status',
+                           (date,)).fetchall()
+        conn.close()
+        summary = {}
+        for stage, status, count in res:
+            summary.setdefault(stage, {})[status] = count
+        return summary
+
+    def add_metric(self, date, name, value):
+        conn = self.connect()
+        with conn:
+            conn.execute('INSERT INTO metrics VALUES (?, ?, ?, ?)', (date, name, value, time.time()))
+        conn.close()
+
+    def metrics(self, date, name=None):
+        '''
+        :return: a list of (name, value, tstamp) of the recorded metrics of the date
+        '''
+        conn = self.connect()
+        if name is None:
+            res = conn.execute('SELECT name, value, tstamp FROM metrics WHERE date = ? ORDER BY tstamp',
+                               (date,)).fetchall()
+        else:
+            res = conn.execute('SELECT name, value, tstamp FROM metrics WHERE date = ? AND name = ? ORDER BY tstamp',
+                               (date, name)).fetchall()
+        conn.close()
+        return res
+
+
+def _run_task(queue, key, func, args):
+    tstart = time.time()
+    try:
+        result = func(*args)
+        queue.put((key, 'done', result, None, tstart, time.time()))
+    except Exception as err:
+        queue.put((key, 'failed', None, '{}: {}'.format(type(err).__name__, err), tstart, time.time()))
+
+
+class TaskGraph:
+    '''
+    Run the pipeline of each scan as a chain of stages, e.g., import -> calibrate -> image -> render.
+    A scan moves on to its next stage as soon as its previous stage has finished, independently of the
+    other scans. The number of tasks that run at the same time is limited per stage.
+
+    Each task runs in its own process (non-daemonic, so that a stage may use multiprocessing itself,
+    e.g., ptclean), or in a thread if useprocess is False.
+    '''
+
+    def __init__(self, stages, limits=None, store=None, date='', useprocess=True, polltime=5., verbose=True):
+        '''
+        :param stages: ordered list of (stage name, func). func is called as func(scan, result of the previous stage),
+                    or as func(scan) for the first stage, and its return value is passed on to the next stage.
+                    If it returns None, the scan stops there.
+        :param limits: dict of {stage name: max number of concurrent tasks}. Default is 1 for every stage
+        :param store: a StateStore. Finished tasks found in the store are not run again
+        :param date: the date the tasks belong to, used as the key of the store
+        :param useprocess: if True, run the tasks in processes. Otherwise in threads
+        :param polltime: seconds to wait for a result, and how long a worker must have been dead before its task
+                         is failed
+        :param verbose:
+        '''
+        self.stages = stages
+        self.stagenames = [ll[0] for ll in stages]
+        self.limits = dict([(ll, 1) for ll in self.stagenames])
+        if limits:
+            self.limits.update(limits)
+        self.store = store
+        self.date = date
+        self.useprocess = useprocess
+        self.polltime = polltime
+        self.verbose = verbose
+        self.tstart = None
+        self.first = {}
+
+    def _start(self, queue, key, func, args):
+        if self.useprocess:
+            worker = mprocs.Process(target=_run_task, args=(queue, key, func, args))
+        else:
+            worker = threading.Thread(target=_run_task, args=(queue, key, func, args))
+            worker.daemon = True
+        worker.start()
+        return worker
+
+    def run(self, scans):
+        '''
+        :param scans: list of scan names
+        :return: a dict of {scan: (last finished stage, its result)}
+        '''
+        self.tstart = time.time()
+        queue = mprocs.Queue() if self.useprocess else Queue.Queue()
+        funcs = dict(self.stages)
+        # the stage to run next and the input of each scan
+        pending = [(scan, 0, None) for scan in scans]
+        running = dict([(ll, {}) for ll in self.stagenames])
+        results = {}
+        checked = set()
+        # workers found dead without a result, with the time they were found dead. They are failed once they
+        # have been dead for polltime, when their result can no longer be on its way through the queue
+        dead = {}
+        while pending or any(running.values()):
+            self._reap(running, dead)
+            waiting = []
+            for scan, sidx, inp in pending:
+                stage = self.stagenames[sidx]
+                record = None
+                if self.store and (scan, sidx) not in checked:
+                    checked.add((scan, sidx))
+                    record = self.store.get(self.date, scan, stage)
+                if record and record['status'] == 'done':
+                    self._finish(scan, sidx, record['result'], pending=waiting, results=results, cached=True)
+                elif len(running[stage]) < self.limits[stage]:
+                    if self.store:
+                        self.store.set(self.date, scan, stage, 'running', tstart=time.time())
+                    args = (scan, inp) if sidx > 0 else (scan,)
+                    running[stage][scan] = self._start(queue, (scan, sidx), funcs[stage], args)
+                    if self.verbose:
+                        print '{} {}: started'.format(scan, stage)
+                else:
+                    waiting.append((scan, sidx, inp))
+            pending = waiting
+            if not any(running.values()):
+                continue
+            try:
+                (scan, sidx), status, result, error, tstart, tend = queue.get(timeout=self.polltime)
+            except Queue.Empty:
+                continue
+            stage = self.stagenames[sidx]
+            if scan not in running[stage]:
+                # the task has already been failed by _reap
+                continue
+            worker = running[stage].pop(scan)
+            dead.pop((stage, scan), None)
+            worker.join()
+            if self.store:
+                self.store.set(self.date, scan, stage, status, tstart=tstart, tend=tend, result=result, error=error)
+            if self.verbose:
+                print '{} {}: {} in {:.1f} s'.format(scan, stage, status if not error else error, tend - tstart)
+            if status == 'done':
+                self._finish(scan, sidx, result, pending=pending, results=results)
+        return results
+
+    def _reap(self, running, dead):
+        '''
+        fail the tasks whose worker has exited without posting a result, e.g., killed by a segfault of CASA or
+        by the OOM killer, or with a result that could not be pickled, and free their slots.
+        It is called on every turn of the scheduling loop, so a crashed task does not hold its slot while the
+        other tasks keep posting results.
+        '''
+        now = time.time()
+        for stage in self.stagenames:
+            for scan, worker in running[stage].items():
+                if worker.is_alive():
+                    continue
+                if now - dead.setdefault((stage, scan), now) < self.polltime:
+                    continue
+                dead.pop((stage, scan))
+                running[stage].pop(scan)
+                worker.join()
+                error = 'worker exited with code {} without a result'.format(getattr(worker, 'exitcode', None))
+                if self.store:
+                    self.store.set(self.date, scan, stage, 'failed', tend=time.time(), error=error)
+                if self.verbose:
+                    print '{} {}: {}'.format(scan, stage, error)
+
+    def _finish(self, scan, sidx, result, pending, results, cached=False):
+        stage = self.stagenames[sidx]
+        if not cached and stage not in self.first:
+            # latency of the first finished task of each stage since the start of the run
+            self.first[stage] = time.time() - self.tstart
+            if self.store:
+                self.store.add_metric(self.date, 'first_' + stage + '_latency', self.first[stage])
+            if self.verbose:
+                print 'first {} finished {:.1f} s after start'.format(stage, self.first[stage])
+        results[scan] = (stage, result)
+        if result is not None and sidx + 1 < len(self.stagenames):
+            pending.append((scan, sidx + 1, result))
@@ -19,6 +19,7 @@ from eovsapy import stateframe as stf
 from eovsapy import dbutil as db
 from eovsapy import pipeline_cal as pc
 from importeovsa_cli import importeovsa_cli as importeovsa
+from suncasa.utils import spanlog
 
 # check if the calibration table directory is defined
 caltbdir = os.getenv('EOVSACAL')
@@ -29,6 +30,7 @@ if not caltbdir:
     print 'Use default path on pipeline ' + caltbdir
 
 
+@spanlog.spanned('calibeovsa')
 def calibeovsa(vis=None, caltype=None, interp=None, docalib=True, doflag=True, flagant=None, doimage=False, imagedir=None, antenna=None,
                timerange=None, spw=None, stokes=None, doconcat=False, msoutdir=None, keep_orig_ms=True):
     '''
@@ -292,8 +294,9 @@ def calibeovsa(vis=None, caltype=None, interp=None, docalib=True, doflag=True, f
                         gaintables.append(caltb_phambd_interp)
 
         if docalib:
-            clearcal(msfile)
-            applycal(vis=msfile, gaintable=gaintables, applymode='calflag', calwt=False)
+            with spanlog.span('calibeovsa.applycal', vis=msfile, ntable=len(gaintables)):
+                clearcal(msfile)
+                applycal(vis=msfile, gaintable=gaintables, applymode='calflag', calwt=False)
             # delete the interpolated phase calibration table
             try:
                 caltb_phambd_interp
@@ -303,13 +306,14 @@ def calibeovsa(vis=None, caltype=None, interp=None, docalib=True, doflag=True, f
                 if os.path.exists(caltb_phambd_interp):
                     shutil.rmtree(caltb_phambd_interp)
         if doflag:
-            # flag zeros and NaNs
-            flagdata(vis=msfile, mode='clip', clipzeros=True)
-            if flagant:
-                try:
-                    flagdata(vis=msfile, antenna=flagant)
-                except:
-                    print "Something wrong with flagant. Abort..."
+            with spanlog.span('calibeovsa.flag', vis=msfile):
+                # flag zeros and NaNs
+                flagdata(vis=msfile, mode='clip', clipzeros=True)
+                if flagant:
+                    try:
+                        flagdata(vis=msfile, antenna=flagant)
+                    except:
+                        print "Something wrong with flagant. Abort..."
 
         if doimage:
             from matplotlib import pyplot as plt
@@ -341,8 +345,9 @@ def calibeovsa(vis=None, caltype=None, interp=None, docalib=True, doflag=True, f
                 imname = imagedir + '/' + os.path.basename(msfile).replace('.ms', '.bd' + bdstr)
                 print 'Cleaning image: ' + imname
                 try:
-                    clean(vis=msfile, imagename=imname, antenna=antenna, spw=bd, timerange=timerange, imsize=[512], cell=['5.0arcsec'], stokes=stokes,
-                          niter=500)
+                    with spanlog.span('calibeovsa.clean', vis=msfile, spw=bd):
+                        clean(vis=msfile, imagename=imname, antenna=antenna, spw=bd, timerange=timerange, imsize=[512], cell=['5.0arcsec'], stokes=stokes,
+                              niter=500)
                 except:
                     print 'clean not successfull for band ' + str(bd)
                 else:
@@ -377,7 +382,8 @@ def calibeovsa(vis=None, caltype=None, interp=None, docalib=True, doflag=True, f
                 msoutdir = './'
             concatvis = os.path.basename(vis[0])
             concatvis = msoutdir + '/' + concatvis.split('.')[0] + '_concat.ms'
-            ce.concateovsa(vis, concatvis, datacolumn='corrected', keep_orig_ms=keep_orig_ms, cols2rm="model,corrected")
+            with spanlog.span('calibeovsa.concat', nvis=len(vis)):
+                ce.concateovsa(vis, concatvis, datacolumn='corrected', keep_orig_ms=keep_orig_ms, cols2rm="model,corrected")
             return [concatvis]
     else:
         return vis
@@ -7,8 +7,10 @@ import aipy
 from taskinit import tb, casalog
 from split_cli import split_cli as split
 from suncasa.eovsa import impteovsa as ipe
+from suncasa.utils import spanlog
 
 
+@spanlog.spanned('importeovsa.file')
 def importeovsa_iter(filelist, timebin, width, visprefix, nocreatms, modelms, doscaling, keep_nsclms, fileidx):
     from taskinit import tb, casalog
     filename = filelist[fileidx]
@@ -255,6 +257,7 @@ def importeovsa_iter(filelist, timebin, width, visprefix, nocreatms, modelms, do
         return [True, msfile, durtim]
 
 
+@spanlog.spanned('importeovsa')
 def importeovsa(idbfiles=None, ncpu=None, timebin=None, width=None, visprefix=None, udb_corr=True, nocreatms=None, doconcat=None, modelms=None,
                 doscaling=False, keep_nsclms=False):
     casalog.origin('importeovsa')
@@ -14,8 +14,10 @@ from time import time
 from taskinit import casalog
 import multiprocessing as mprocs
 from suncasa.utils import DButil
+from suncasa.utils import spanlog
 
 
+@spanlog.spanned('pimfit.image')
 def imfit_iter(imgfiles, doreg, tims, msinfofile, ephem, box, region, chans, stokes, mask, includepix, excludepix,
                residual, model, estimates, logfile, append, newestimates, complist,
                overwrite, dooff, offset, fixoffset, stretch, rms, noisefwhm, summary,
@@ -85,6 +87,7 @@ def imfit_iter(imgfiles, doreg, tims, msinfofile, ephem, box, region, chans, sto
         myia.done()
 
 
+@spanlog.spanned('pimfit')
 def pimfit(imagefiles, ncpu, doreg, timestamps, msinfofile, ephemfile, box, region, chans, stokes, mask, includepix,
            excludepix,
            residual, model, estimates, logfile, append, newestimates, complist,
@@ -4,6 +4,7 @@ import numpy as np
 #from suncasa.vla import vla_prep
 #from suncasa.eovsa import eovsa_prep as ep
 from suncasa.utils import helioimage2fits as hf
+from suncasa.utils import spanlog
 import shutil
 import multiprocessing as mprocs
 from functools import partial
@@ -11,6 +12,7 @@ from time import time
 import glob
 import pdb
 
+@spanlog.spanned('ptclean.slice')
 def clean_iter(tim, freq, vis, imageprefix, imagesuffix, 
                ncpu, twidth, doreg, usephacenter, reftime, ephem, msinfo, toTb, overwrite,
                outlierfile, field, spw, selectdata,
@@ -123,6 +125,7 @@ def clean_iter(tim, freq, vis, imageprefix, imagesuffix,
         else:
             return [False, btstr, etstr, '']
 
+@spanlog.spanned('ptclean')
 def ptclean(vis, imageprefix, imagesuffix, ncpu, twidth, doreg, usephacenter, reftime, toTb, overwrite,
             outlierfile, field, spw, selectdata, timerange,
             uvrange, antenna, scan, observation, intent, mode, resmooth, gridmode,
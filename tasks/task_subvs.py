@@ -8,7 +8,10 @@ import signalsmooth
 from taskinit import * 
 from callibrary import *
 import pdb
+from suncasa.utils import spanlog
 
+
+@spanlog.spanned('subvs')
 def subvs(vis=None,outputvis=None,timerange=None,spw=None,
           mode=None,subtime1=None,subtime2=None,
           smoothaxis=None,smoothtype=None,smoothwidth=None,
@@ -349,14 +349,17 @@ def img2html_movie(imgdir, outname='movie', img_fmt='png'):
 
 
 def my_timer(orig_func):
-    import time
+    '''
+    decorator to time a function. It runs the function in a span of suncasa.utils.spanlog (written to the
+    log of SUNCASA_SPANLOG, if set) and prints the elapsed time
+    '''
+    from suncasa.utils import spanlog
 
     @wraps(orig_func)
     def wrapper(*args, **kwargs):
-        t1 = time.time()
-        result = orig_func(*args, **kwargs)
-        t2 = time.time() - t1
-        print('{} ran in: {} sec'.format(orig_func.__name__, t2))
+        with spanlog.span(orig_func.__name__) as sp:
+            result = orig_func(*args, **kwargs)
+        print('{} ran in: {} sec'.format(orig_func.__name__, sp.record['wall']))
         return result
 
     return wrapper
@@ -890,7 +893,26 @@ def insertchar(source_str, insert_str, pos):
 #     '''
 
 
-def readsdofile(datadir=None, wavelength=None, jdtime=None, isexists=False, timtol=1):
+def globsdofile(datadir=None, wavelength=None, jdtime=None):
+    '''
+    scan the local database for sdo files in a time range without using the catalog
+    :param datadir:
+    :param wavelength:
+    :param jdtime: two elements list of timestamps in Julian days
+    :return: a list of tuples of (fullpath, jd) sorted by time
+    '''
+    from suncasa.utils import sdocatalog
+    sdofiles = []
+    for daydir in sdocatalog.sdodaydirs(jdtime):
+        for wave in str(wavelength).lower().split(','):
+            for ll in glob.glob(os.path.join(datadir, daydir, 'aia.lev1_*Z.{}.image_lev1.fits'.format(wave.strip()))):
+                info = sdocatalog.parse_sdofilename(ll)
+                if info and jdtime[0] < info[2] < jdtime[-1]:
+                    sdofiles.append((ll, info[2]))
+    return sorted(sdofiles, key=lambda x: x[1])
+
+
+def readsdofile(datadir=None, wavelength=None, jdtime=None, isexists=False, timtol=1, usecatalog=True):
     '''
     read sdo file from local database
     :param datadir:
@@ -898,12 +920,22 @@ def readsdofile(datadir=None, wavelength=None, jdtime=None, isexists=False, timt
     :param jdtime: the timestamp or timerange in Julian days. if is timerange, return a list of files in the timerange
     :param isexists: check if file exist. if files exist, return file name
     :param timtol: time difference tolerance in days for considering data as the same timestamp
+    :param usecatalog: if True, look up the files in the sqlite catalog of the local database (see sdocatalog),
+                    which is updated incrementally. Otherwise scan the directories on every call
     :return:
     '''
     from astropy.time import Time
     import sunpy.map
-    from datetime import date
-    from datetime import timedelta as td
+    import sqlite3
+    from suncasa.utils import sdocatalog
+
+    def getsdofiles(trange):
+        if usecatalog:
+            try:
+                return sdocatalog.SDOCatalog(datadir).query(wavelength, trange)
+            except (sqlite3.Error, OSError, IOError):
+                pass
+        return globsdofile(datadir=datadir, wavelength=wavelength, jdtime=trange)
 
     wavelength = str(wavelength)
     wavelength = wavelength.lower()
@@ -916,53 +948,27 @@ def readsdofile(datadir=None, wavelength=None, jdtime=None, isexists=False, timt
             if jdtime[1] < jdtime[0]:
                 raise ValueError('start time must be occur earlier than end time!')
             else:
-                sdofitspath = []
-                jdtimestr = [Time(ll, format='jd').iso for ll in jdtime]
-                ymd = [ll.split(' ')[0].split('-') for ll in jdtimestr]
-                d1 = date(int(ymd[0][0]), int(ymd[0][1]), int(ymd[0][2]))
-                d2 = date(int(ymd[1][0]), int(ymd[1][1]), int(ymd[1][2]))
-                delta = d2 - d1
-                for i in xrange(delta.days + 1):
-                    ymd = d1 + td(days=i)
-                    sdofitspathtmp = glob.glob(
-                        datadir + '/{:04d}/{:02d}/{:02d}/aia.lev1_*Z.{}.image_lev1.fits'.format(ymd.year, ymd.month,
-                                                                                                ymd.day, wavelength))
-                    if len(sdofitspathtmp) > 0:
-                        sdofitspath = sdofitspath + sdofitspathtmp
-                if len(sdofitspath) == 0:
+                sdofile = [ll[0] for ll in getsdofiles(jdtime)]
+                if len(sdofile) == 0:
                     if isexists:
-                        return sdofitspath
+                        return sdofile
                     else:
+                        jdtimestr = [Time(ll, format='jd').iso for ll in jdtime]
                         raise ValueError(
                             'No SDO file found under {} at the time range of {} to {}. Download the data with EvtBrowser first.'.format(
                                 datadir, jdtimestr[0], jdtimestr[1]))
-                sdofits = [os.path.basename(ll) for ll in sdofitspath]
-                sdotimeline = Time(
-                    [insertchar(insertchar(ll.split('.')[2].replace('T', ' ').replace('Z', ''), ':', -4), ':', -2) for
-                     ll in sdofits], format='iso', scale='utc')
-                sdofitspathnew = [x for (y, x) in sorted(zip(sdotimeline.jd, sdofitspath))]
-                sdofitsnew = [os.path.basename(ll) for ll in sdofitspathnew]
-                sdotimelinenew = Time(
-                    [insertchar(insertchar(ll.split('.')[2].replace('T', ' ').replace('Z', ''), ':', -4), ':', -2) for
-                     ll in sdofitsnew], format='iso', scale='utc')
-                sdofile = list(np.array(sdofitspathnew)[np.where(
-                    np.logical_and(jdtime[0] < sdotimelinenew.jd, sdotimelinenew.jd < jdtime[1]))[0]])
                 return sdofile
     else:
-        jdtimstr = Time(jdtime, format='jd').iso
-        ymd = jdtimstr.split(' ')[0].split('-')
-        sdofitspath = glob.glob(
-            datadir + '/{}/{}/{}/aia.lev1_*Z.{}.image_lev1.fits'.format(ymd[0], ymd[1], ymd[2], wavelength))
-        if len(sdofitspath) == 0:
+        daystart = sdocatalog.datetime2jd(
+            sdocatalog.jd2datetime(jdtime).replace(hour=0, minute=0, second=0, microsecond=0))
+        sdofiles = getsdofiles([daystart - 1e-8, daystart + 1])
+        if len(sdofiles) == 0:
             raise ValueError('No SDO file found under {}.'.format(datadir))
-        sdofits = [os.path.basename(ll) for ll in sdofitspath]
-        sdotimeline = Time(
-            [insertchar(insertchar(ll.split('.')[2].replace('T', ' ').replace('Z', ''), ':', -4), ':', -2) for ll in
-             sdofits], format='iso', scale='utc')
-        if timtol < np.min(np.abs(sdotimeline.jd - jdtime)):
+        sdotimeline = np.array([ll[1] for ll in sdofiles])
+        if timtol < np.min(np.abs(sdotimeline - jdtime)):
             raise ValueError('No SDO file found at the select timestamp. Download the data with EvtBrowser first.')
-        idxaia = np.argmin(np.abs(sdotimeline.jd - jdtime))
-        sdofile = sdofitspath[idxaia]
+        idxaia = np.argmin(np.abs(sdotimeline - jdtime))
+        sdofile = sdofiles[idxaia][0]
         if isexists:
             return sdofile
         else:
@@ -1058,6 +1064,92 @@ def improfile(z, xi, yi, interp='cubic'):
     return zi
 
 
+def improfileidx(xs0, ys0, xs1, ys1, shape):
+    '''
+    Precompute the sampling coordinates of the cross-sections of a slit, i.e., the same pixels
+    improfile samples along each line segment [xs0,ys0]-[xs1,ys1], so that a whole image cube
+    can be sampled at once with improfilecube
+    :param xs0, ys0, xs1, ys1: pixel coordinates of the endpoints of the cross-sections
+    :param shape: shape of the images, [ny, nx]
+    :return: a dictionary of the sampling coordinates (x, y), the nearest pixel indices (ix, iy),
+    and the start index and number of samples of each cross-section (start, count)
+    '''
+    xs0, ys0, xs1, ys1 = [np.asarray(ll, dtype=float).ravel() for ll in [xs0, ys0, xs1, ys1]]
+    ny, nx = shape[-2:]
+    for xx in [xs0, xs1]:
+        if not np.all((xx > 0) & (xx < nx)):
+            raise ValueError('xi out of range!')
+    for yy in [ys0, ys1]:
+        if not np.all((yy > 0) & (yy < ny)):
+            raise ValueError('yi out of range!')
+    count = np.hypot(xs1 - xs0, ys1 - ys0).astype(int)
+    start = np.concatenate(([0], np.cumsum(count)[:-1]))
+    seg = np.repeat(np.arange(len(count)), count)
+    k = np.arange(count.sum()) - start[seg]
+    frac = k / np.maximum(count[seg] - 1, 1).astype(float)
+    x = xs0[seg] + (xs1 - xs0)[seg] * frac
+    y = ys0[seg] + (ys1 - ys0)[seg] * frac
+    return {'x': x, 'y': y, 'ix': np.floor(x).astype(int), 'iy': np.floor(y).astype(int), 'start': start,
+            'count': count}
+
+
+def improfilecube(datacube, slitidx, interp='nearest', verbose=False):
+    '''
+    Mean pixel values across the slit(s) for all the frames of an image cube.
+    This is the batched version of averaging improfile over each cross-section of a slit frame by frame.
+    :param datacube: image cube in [nt,ny,nx], or a list of images in the same shape
+    :param slitidx: the output of improfileidx, or a list of them for multiple slits
+    :param interp: interpolation type to sampling, 'nearest' or 'cubic'
+    :param verbose: if True, print the throughput in slits*frames/s
+    :return: the slit intensity in [nt, npoints], or a list of them if slitidx is a list
+    '''
+    import time
+    import scipy.ndimage
+    t0 = time.time()
+    if isinstance(slitidx, dict):
+        slitidxs = [slitidx]
+    else:
+        slitidxs = slitidx
+    iscube = isinstance(datacube, np.ndarray) and datacube.ndim == 3
+    nt = len(datacube)
+    # concatenate the samples of all slits so the cube is sampled once
+    ix = np.concatenate([ll['ix'] for ll in slitidxs])
+    iy = np.concatenate([ll['iy'] for ll in slitidxs])
+    if interp == 'cubic':
+        x = np.concatenate([ll['x'] for ll in slitidxs])
+        y = np.concatenate([ll['y'] for ll in slitidxs])
+        if iscube:
+            coords = np.array([np.repeat(np.arange(nt), len(x)), np.tile(y, nt), np.tile(x, nt)])
+            samples = scipy.ndimage.map_coordinates(datacube, coords).reshape(nt, len(x))
+        else:
+            samples = np.array([scipy.ndimage.map_coordinates(ll, np.vstack((y, x))) for ll in datacube])
+    else:
+        if iscube:
+            samples = datacube[:, iy, ix]
+        else:
+            samples = np.array([ll[iy, ix] for ll in datacube])
+    samples = samples.astype(float)
+    intens = []
+    offset = 0
+    for ll in slitidxs:
+        count = ll['count']
+        inten = np.full((nt, len(count)), np.nan)
+        valid = count > 0
+        if np.any(valid):
+            inten[:, valid] = np.add.reduceat(samples[:, offset:offset + count.sum()], ll['start'][valid],
+                                              axis=1) / count[valid]
+        intens.append(inten)
+        offset += count.sum()
+    if verbose:
+        tdur = time.time() - t0
+        print('{} slit(s) x {} frames sampled in {:.3f} sec ({:.1f} slits*frames/s)'.format(len(slitidxs), nt, tdur,
+                                                                                         len(slitidxs) * nt / max(tdur, 1e-6)))
+    if isinstance(slitidx, dict):
+        return intens[0]
+    else:
+        return intens
+
+
 def canvaspix_to_data(smap, x, y):
     import astropy.units as u
     '''
@@ -1129,6 +1221,8 @@ def freqsfromfitsheader(header):
 def transfitdict2DF(datain, gaussfit=True, getcentroid=False):
     '''
     convert the results from pimfit or pmaxfit tasks to pandas DataFrame structure.
+    The components of all the timestamps are collected into flat lists in one pass,
+    and one DataFrame per polarisation is merged on (timestamp, freqstr, fits_local).
     :param datain: The component list from pimfit or pmaxfit tasks
     :param gaussfit: True if the results is from pimfit, otherwise False.
     :param getcentroid: If True returns the centroid
@@ -1137,100 +1231,62 @@ def transfitdict2DF(datain, gaussfit=True, getcentroid=False):
     import pandas as pd
 
     ra2arcsec = 180. * 3600. / np.pi
-    dspecDF0 = pd.DataFrame()
-    for ll in datain['timestamps']:
-        tidx = datain['timestamps'].index(ll)
-        if datain['succeeded'][tidx]:
-            pols = datain['outputs'][tidx].keys()
-            dspecDFlist = []
-            dspecDF = pd.DataFrame()
-            for ppit in pols:
-                dspecDFtmp = pd.DataFrame()
-                shape_latitude = []
-                shape_longitude = []
-                shape_latitude_err = []
-                shape_longitude_err = []
-                shape_majoraxis = []
-                shape_minoraxis = []
-                shape_positionangle = []
-                peak = []
-                beam_major = []
-                beam_minor = []
-                beam_positionangle = []
-                freqstrs = []
-                fits_local = []
-                for comp in datain['outputs'][tidx][ppit]['results'].keys():
-                    if comp.startswith('component'):
-                        if gaussfit:
-                            majoraxis = datain['outputs'][tidx][ppit]['results'][comp]['shape']['majoraxis']['value']
-                            minoraxis = datain['outputs'][tidx][ppit]['results'][comp]['shape']['minoraxis']['value']
-                            positionangle = datain['outputs'][tidx][ppit]['results'][comp]['shape']['positionangle'][
-                                'value']
-                            bmajor = datain['outputs'][tidx][ppit]['results'][comp]['beam']['beamarcsec']['major'][
-                                'value']
-                            bminor = datain['outputs'][tidx][ppit]['results'][comp]['beam']['beamarcsec']['minor'][
-                                'value']
-                            bpositionangle = \
-                                datain['outputs'][tidx][ppit]['results'][comp]['beam']['beamarcsec']['positionangle'][
-                                    'value']
-                            shape_majoraxis.append(majoraxis)
-                            shape_minoraxis.append(minoraxis)
-                            shape_positionangle.append(positionangle)
-                            beam_major.append(bmajor)
-                            beam_minor.append(bminor)
-                            beam_positionangle.append(bpositionangle)
-                            fluxpeak = datain['outputs'][tidx][ppit]['results'][comp]['peak']['value']
-                        else:
-                            fluxpeak = datain['outputs'][tidx][ppit]['results'][comp]['flux']['value'][0]
-                        if getcentroid:
-                            mkey = 'centroid'
-                        else:
-                            mkey = 'shape'
-                        longitude = datain['outputs'][tidx][ppit]['results'][comp][mkey]['direction']['m0'][
-                                        'value'] * ra2arcsec
-                        latitude = datain['outputs'][tidx][ppit]['results'][comp][mkey]['direction']['m1'][
-                                       'value'] * ra2arcsec
-                        longitude_err = \
-                            datain['outputs'][tidx][ppit]['results'][comp]['shape']['direction']['error']['longitude'][
-                                'value']
-                        latitude_err = \
-                            datain['outputs'][tidx][ppit]['results'][comp]['shape']['direction']['error']['latitude'][
-                                'value']
-                        shape_longitude.append(longitude)
-                        shape_latitude.append(latitude)
-                        shape_longitude_err.append(longitude_err)
-                        shape_latitude_err.append(latitude_err)
-                        peak.append(fluxpeak)
-                        freqstrs.append('{:.3f}'.format(
-                            datain['outputs'][tidx][ppit]['results'][comp]['spectrum']['frequency']['m0']['value']))
-                        fits_local.append(datain['imagenames'][tidx].split('/')[-1])
+    if getcentroid:
+        mkey = 'centroid'
+    else:
+        mkey = 'shape'
+    colnames = ['shape_latitude', 'shape_longitude', 'shape_latitude_err', 'shape_longitude_err', 'peak']
+    if gaussfit:
+        colnames += ['shape_majoraxis', 'shape_minoraxis', 'shape_positionangle', 'beam_major', 'beam_minor',
+                     'beam_positionangle']
+    keycols = ['freqstr', 'fits_local', 'tidx']
+    pols = []
+    records = {}
+    for tidx, ll in enumerate(datain['timestamps']):
+        if not datain['succeeded'][tidx]:
+            continue
+        fits_local = datain['imagenames'][tidx].split('/')[-1]
+        for ppit in datain['outputs'][tidx].keys():
+            if ppit not in records:
+                pols.append(ppit)
+                records[ppit] = dict((cc, []) for cc in colnames + keycols)
+            rec = records[ppit]
+            results = datain['outputs'][tidx][ppit]['results']
+            for comp in results.keys():
+                if not comp.startswith('component'):
+                    continue
+                res = results[comp]
                 if gaussfit:
-                    dspecDFtmp['shape_latitude{}'.format(ppit)] = pd.Series(shape_latitude)
-                    dspecDFtmp['shape_longitude{}'.format(ppit)] = pd.Series(shape_longitude)
-                    dspecDFtmp['shape_latitude_err{}'.format(ppit)] = pd.Series(shape_latitude_err)
-                    dspecDFtmp['shape_longitude_err{}'.format(ppit)] = pd.Series(shape_longitude_err)
-                    dspecDFtmp['peak{}'.format(ppit)] = pd.Series(peak)
-                    dspecDFtmp['shape_majoraxis{}'.format(ppit)] = pd.Series(shape_majoraxis)
-                    dspecDFtmp['shape_minoraxis{}'.format(ppit)] = pd.Series(shape_minoraxis)
-                    dspecDFtmp['shape_positionangle{}'.format(ppit)] = pd.Series(shape_positionangle)
-                    dspecDFtmp['beam_major{}'.format(ppit)] = pd.Series(beam_major)
-                    dspecDFtmp['beam_minor{}'.format(ppit)] = pd.Series(beam_minor)
-                    dspecDFtmp['beam_positionangle{}'.format(ppit)] = pd.Series(beam_positionangle)
-                else:
-                    dspecDFtmp['shape_latitude{}'.format(ppit)] = pd.Series(shape_latitude)
-                    dspecDFtmp['shape_longitude{}'.format(ppit)] = pd.Series(shape_longitude)
-                    dspecDFtmp['shape_latitude_err{}'.format(ppit)] = pd.Series(shape_latitude_err)
-                    dspecDFtmp['shape_longitude_err{}'.format(ppit)] = pd.Series(shape_longitude_err)
-                    dspecDFtmp['peak{}'.format(ppit)] = pd.Series(peak)
-                dspecDFtmp['freqstr'.format(ppit)] = pd.Series(freqstrs)
-                dspecDFtmp['fits_local'.format(ppit)] = pd.Series(fits_local)
-                dspecDFlist.append(dspecDFtmp)
-            for DFidx, DFit in enumerate(dspecDFlist):
-                if DFidx == 0:
-                    dspecDF = dspecDFlist[0]
+                    rec['shape_majoraxis'].append(res['shape']['majoraxis']['value'])
+                    rec['shape_minoraxis'].append(res['shape']['minoraxis']['value'])
+                    rec['shape_positionangle'].append(res['shape']['positionangle']['value'])
+                    rec['beam_major'].append(res['beam']['beamarcsec']['major']['value'])
+                    rec['beam_minor'].append(res['beam']['beamarcsec']['minor']['value'])
+                    rec['beam_positionangle'].append(res['beam']['beamarcsec']['positionangle']['value'])
+                    rec['peak'].append(res['peak']['value'])
                 else:
-                    dspecDF = pd.merge(dspecDF.copy(), DFit, how='outer', on=['freqstr', 'fits_local'])
-            dspecDF0 = dspecDF0.append(dspecDF, ignore_index=True)
+                    rec['peak'].append(res['flux']['value'][0])
+                rec['shape_longitude'].append(res[mkey]['direction']['m0']['value'] * ra2arcsec)
+                rec['shape_latitude'].append(res[mkey]['direction']['m1']['value'] * ra2arcsec)
+                rec['shape_longitude_err'].append(res['shape']['direction']['error']['longitude']['value'])
+                rec['shape_latitude_err'].append(res['shape']['direction']['error']['latitude']['value'])
+                rec['freqstr'].append('{:.3f}'.format(res['spectrum']['frequency']['m0']['value']))
+                rec['fits_local'].append(fits_local)
+                rec['tidx'].append(tidx)
+
+    dspecDF0 = None
+    for ppit in pols:
+        rec = records[ppit]
+        dspecDFtmp = pd.DataFrame(
+            dict([('{}{}'.format(cc, ppit), np.asarray(rec[cc], dtype=np.float64)) for cc in colnames] + [
+                (cc, rec[cc]) for cc in keycols]), columns=['{}{}'.format(cc, ppit) for cc in colnames] + keycols)
+        if dspecDF0 is None:
+            dspecDF0 = dspecDFtmp
+        else:
+            dspecDF0 = pd.merge(dspecDF0, dspecDFtmp, how='outer', on=keycols)
+    if dspecDF0 is None:
+        return pd.DataFrame()
+    dspecDF0 = dspecDF0.sort_values('tidx', kind='mergesort').drop('tidx', axis=1).reset_index(drop=True)
 
     return dspecDF0
 
@@ -1326,6 +1382,43 @@ def smapmeshgrid2(smap, angle=None, rescale=1.0, origin=1):
     return xnew, ynew
 
 
+def mkdiffcube(data, mode='rdiff', lag=1, out=None):
+    '''
+    running or base difference (or ratio) of an image cube along the time axis
+    :param data: [nt,ny,nx] array (can be memory-mapped), or a list of nt images of the same shape
+    :param mode: 'rdiff' (running difference), 'rratio' (running ratio), 'bdiff' (base difference)
+                or 'bratio' (base ratio)
+    :param lag: frame lag of the running difference/ratio. The frames earlier than lag are referenced to the first frame
+    :param out: output [nt,ny,nx] array, e.g., a memory-mapped array, or data itself to compute in place.
+                If None, a new array is allocated
+    :return: out
+    '''
+    if mode not in ['rdiff', 'rratio', 'bdiff', 'bratio']:
+        raise ValueError('mode must be one of rdiff, rratio, bdiff and bratio')
+    if lag < 0:
+        raise ValueError('lag must be non-negative')
+    nt = len(data)
+    ny, nx = data[0].shape
+    if out is None:
+        out = np.empty((nt, ny, nx), dtype=np.result_type(data[0].dtype, np.float32))
+    if mode.endswith('diff'):
+        op = np.subtract
+    else:
+        op = np.divide
+    if mode.startswith('r'):
+        n0 = min(int(lag), nt)
+    else:
+        n0 = nt
+    if isinstance(data, np.ndarray) and not np.may_share_memory(data, out):
+        op(data[:n0], data[0], out=out[:n0])
+        op(data[n0:], data[:nt - n0], out=out[n0:])
+    else:
+        # frame by frame from the last one, so that the reference frames are intact when out is data
+        for idx in xrange(nt - 1, -1, -1):
+            op(data[idx], data[idx - n0 if idx >= n0 else 0], out=out[idx])
+    return out
+
+
 def smapradialfilter(smap, grid=None):
     if grid:
         x, y = grid
@@ -1338,6 +1431,62 @@ def smapradialfilter(smap, grid=None):
     return smap
 
 
+_interpweights_cache = {}
+
+
+def interpweights(x, xnew):
+    '''
+    indices and weights of the linear interpolation from the grid x to xnew. The weights are cached
+    for reuse on the data with the same grids.
+    :param x: the points defining the regular grid, must be strictly ascending
+    :param xnew: the new points
+    :return: [idx0, idx1, w, outside]. The interpolated value at xnew is
+            values[idx0] * (1 - w) + values[idx1] * w, or nan where outside is True.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    xnew = np.asarray(xnew, dtype=np.float64)
+    key = (x.tobytes(), xnew.tobytes())
+    if key in _interpweights_cache:
+        return _interpweights_cache[key]
+    nx = len(x)
+    if nx > 1:
+        if np.any(np.diff(x) <= 0):
+            raise ValueError('The points of the grid must be strictly ascending')
+        idx0 = np.clip(np.searchsorted(x, xnew) - 1, 0, nx - 2)
+        idx1 = idx0 + 1
+        w = (xnew - x[idx0]) / (x[idx1] - x[idx0])
+    else:
+        idx0 = np.zeros(len(xnew), dtype=int)
+        idx1 = idx0
+        w = np.zeros(len(xnew))
+    outside = np.logical_or(xnew < x[0], xnew > x[-1])
+    if len(_interpweights_cache) >= 32:
+        _interpweights_cache.clear()
+    _interpweights_cache[key] = [idx0, idx1, w, outside]
+    return _interpweights_cache[key]
+
+
+def regridaxis(values, weights, axis=-1):
+    '''
+    linear interpolation of an array along one axis with the weights from interpweights
+    :param values: ndarray of float or complex
+    :param weights: output of interpweights
+    :param axis: the axis to interpolate
+    :return: re-gridded array
+    '''
+    idx0, idx1, w, outside = weights
+    axis = axis % values.ndim
+    shape = [1] * values.ndim
+    shape[axis] = len(w)
+    w = w.reshape(shape)
+    datanew = np.take(values, idx0, axis=axis) * (1 - w) + np.take(values, idx1, axis=axis) * w
+    if np.any(outside):
+        slc = [slice(None)] * values.ndim
+        slc[axis] = outside
+        datanew[tuple(slc)] = np.nan
+    return datanew
+
+
 def regridimage(values, x, y, grid=None, resize=[1.0, 1.0]):
     '''
     re-grid the data on a regular grid with uneven grid spacing to an uniform grid
@@ -1348,15 +1497,21 @@ def regridimage(values, x, y, grid=None, resize=[1.0, 1.0]):
     :param resize: list of re-size ratio factors of x and y. if resize is not [1.0,1.0], grid is neglected.
     :return: re-gridded image
     '''
-    from scipy.interpolate import RegularGridInterpolator
     ny, nx = values.shape
     if grid and resize == [1.0, 1.0]:
         gridx, gridy = grid
     else:
-        gridx, gridy = np.meshgrid(np.linspace(x[0], x[-1], nx * resize[0]), np.linspace(y[0], y[-1], ny * resize[1]))
+        gridx, gridy = np.meshgrid(np.linspace(x[0], x[-1], int(nx * resize[0])),
+                                   np.linspace(y[0], y[-1], int(ny * resize[1])))
     ny, nx = gridx.shape
-    rgi = RegularGridInterpolator(points=(y, x), values=values, bounds_error=False)
-    datanew = rgi(np.stack(np.stack((gridy.ravel(), gridx.ravel()), axis=-1))).reshape(ny, nx)
+    if np.all(gridx == gridx[:1, :]) and np.all(gridy == gridy[:, :1]):
+        # the new grid is rectilinear, interpolate along y and x separately
+        datanew = regridaxis(regridaxis(values, interpweights(y, gridy[:, 0]), axis=0),
+                             interpweights(x, gridx[0, :]), axis=1)
+    else:
+        from scipy.interpolate import RegularGridInterpolator
+        rgi = RegularGridInterpolator(points=(y, x), values=values, bounds_error=False)
+        datanew = rgi(np.stack(np.stack((gridy.ravel(), gridx.ravel()), axis=-1))).reshape(ny, nx)
     if grid:
         return datanew
     else:
@@ -1374,6 +1529,7 @@ def regridspec(spec, x, y, nxmax=None, nymax=None, interp=False):
     '''
 
     npol, nbl, nf, nt = spec.shape
+    xstep, ystep = 1, 1
     if interp:
         if nxmax:
             if nt > nxmax:
@@ -1381,15 +1537,11 @@ def regridspec(spec, x, y, nxmax=None, nymax=None, interp=False):
         if nymax:
             if nf > nymax:
                 nf = nymax
-        specnew = np.zeros((npol, nbl, nf, nt))
         tt = np.linspace(x[0], x[-1], nt)
         ff = np.linspace(y[0], y[-1], nf)
-        grid_x, grid_y = np.meshgrid(tt, ff)
-        for p in xrange(npol):
-            for b in xrange(nbl):
-                specnew[p, b, :, :] = regridimage(spec[p, b, :, :], x, y, grid=[grid_x, grid_y])
+        # the whole (npol,nbl) stack is interpolated at once with the cached weights
+        specnew = regridaxis(regridaxis(spec, interpweights(y, ff), axis=2), interpweights(x, tt), axis=3)
     else:
-        xstep, ystep = 1, 1
         if nxmax:
             if nt > nxmax:
                 import math
@@ -1401,46 +1553,152 @@ def regridspec(spec, x, y, nxmax=None, nymax=None, interp=False):
     return [specnew, xstep, ystep]
 
 
+# edges crossed by the contour line(s) in a cell for each of the 16 marching-squares cases.
+# The corners of a cell are numbered as 1 (upper left), 2 (upper right), 4 (lower right), 8 (lower left), and the
+# edges as 0 (top), 1 (right), 2 (bottom), 3 (left). The saddle cases 5 and 10 are resolved by the cell center value.
+_msq_segments = {1: [(3, 0)], 2: [(0, 1)], 3: [(3, 1)], 4: [(1, 2)], 6: [(0, 2)], 7: [(3, 2)], 8: [(3, 2)],
+                 9: [(0, 2)], 11: [(1, 2)], 12: [(3, 1)], 13: [(0, 1)], 14: [(3, 0)]}
+_msq_saddles = {5: ([(0, 1), (3, 2)], [(3, 0), (1, 2)]), 10: ([(3, 0), (1, 2)], [(0, 1), (3, 2)])}
+
+
+def marchingsquares(Z, level):
+    '''
+    Contour lines of an image at a given level by marching squares.
+    :param Z: 2D image. NaNs are treated as below any level
+    :param level: the contour level
+    :return: a list of the contour lines, each as a tuple of the (fractional) row and column pixel coordinates
+    '''
+    Z = np.asarray(Z, dtype=float)
+    ny, nx = Z.shape
+    with np.errstate(invalid='ignore'):
+        above = (Z >= level).view(np.uint8)
+    case = above[:-1, :-1] | (above[:-1, 1:] << 1) | (above[1:, 1:] << 2) | (above[1:, :-1] << 3)
+    nh = ny * (nx - 1)
+    # only the cells crossed by the contour are processed further
+    case = case.ravel()
+    cidx = np.flatnonzero((case - 1) < 14)
+    ccase = case[cidx]
+    segs = []
+    for cs in range(1, 15):
+        sel = ccase == cs
+        if not np.any(sel):
+            continue
+        ci, cj = np.divmod(cidx[sel], nx - 1)
+        # ids of the top, right, bottom and left edges of the cells
+        edges = [ci * (nx - 1) + cj, nh + ci * nx + cj + 1, (ci + 1) * (nx - 1) + cj, nh + ci * nx + cj]
+        if cs in _msq_saddles:
+            center = (Z[ci, cj] + Z[ci, cj + 1] + Z[ci + 1, cj] + Z[ci + 1, cj + 1]) / 4.0
+            high = center >= level
+            for sel, pairs in [(high, _msq_saddles[cs][0]), (~high, _msq_saddles[cs][1])]:
+                for e0, e1 in pairs:
+                    segs.append(np.vstack((edges[e0][sel], edges[e1][sel])))
+        else:
+            for e0, e1 in _msq_segments[cs]:
+                segs.append(np.vstack((edges[e0], edges[e1])))
+    if not segs:
+        return []
+    segs = np.hstack(segs).T
+    nodes, segs = np.unique(segs, return_inverse=True)
+    segs = segs.reshape(-1, 2)
+    # crossing points on the edges
+    ishor = nodes < nh
+    i0 = np.where(ishor, nodes // (nx - 1), (nodes - nh) // nx)
+    j0 = np.where(ishor, nodes % (nx - 1), (nodes - nh) % nx)
+    i1 = np.where(ishor, i0, i0 + 1)
+    j1 = np.where(ishor, j0 + 1, j0)
+    z0, z1 = Z[i0, j0], Z[i1, j1]
+    frac = (level - z0) / (z1 - z0)
+    frac[~np.isfinite(frac)] = 0.5
+    frac = np.clip(frac, 0, 1)
+    rows = i0 + (i1 - i0) * frac
+    cols = j0 + (j1 - j0) * frac
+    # each edge is shared by two cells at most, so the nodes have at most two neighbours
+    ends = np.concatenate((segs[:, 0], segs[:, 1]))
+    partners = np.concatenate((segs[:, 1], segs[:, 0]))
+    order = np.argsort(ends, kind='mergesort')
+    ends, partners = ends[order], partners[order]
+    first = np.searchsorted(ends, ends)
+    nbr = np.full((len(nodes), 2), -1, dtype=int)
+    nbr[ends, np.arange(len(ends)) - first] = partners
+    degree = (nbr >= 0).sum(axis=1)
+    nbr = nbr.tolist()
+    visited = np.zeros(len(nodes), dtype=bool)
+    lines = []
+    for start in np.concatenate((np.nonzero(degree == 1)[0], np.arange(len(nodes)))).tolist():
+        if visited[start]:
+            continue
+        path = [start]
+        visited[start] = True
+        prev, cur = -1, start
+        while True:
+            n0, n1 = nbr[cur]
+            nxt = n0 if n0 != prev and n0 >= 0 else n1
+            if nxt < 0 or nxt == prev:
+                break
+            if visited[nxt]:
+                if nxt == start:
+                    path.append(start)
+                break
+            path.append(nxt)
+            visited[nxt] = True
+            prev, cur = cur, nxt
+        lines.append((rows[path], cols[path]))
+    return lines
+
+
+def contourpaths(X, Y, Z, levels):
+    '''
+    Contour lines of an image, or of a stack of images, in the world coordinates
+    :param X: x coordinates of the pixels, a 2D array in the shape of the images or a 1D array of the columns
+    :param Y: y coordinates of the pixels, a 2D array in the shape of the images or a 1D array of the rows
+    :param Z: an image or a stack of images in [nimg,ny,nx]
+    :param levels: list of the absolute contour levels. For a stack, it can be a list of levels for each image.
+    :return: a dictionary of the multi-line xs, ys and the level of each line, or a list of them for a stack
+    '''
+    Z = np.asarray(Z)
+    if Z.ndim == 3:
+        if np.ndim(levels) == 2:
+            return [contourpaths(X, Y, zz, lev) for zz, lev in zip(Z, levels)]
+        return [contourpaths(X, Y, zz, levels) for zz in Z]
+    X, Y = np.asarray(X, dtype=float), np.asarray(Y, dtype=float)
+    if X.ndim == 1:
+        X, Y = np.meshgrid(X, Y)
+    xs, ys, lev = [], [], []
+    for level in levels:
+        for rows, cols in marchingsquares(Z, level):
+            # bilinear interpolation of the coordinates; the crossing points lie on the pixel edges
+            i0, j0 = np.minimum(rows.astype(int), Z.shape[0] - 2), np.minimum(cols.astype(int), Z.shape[1] - 2)
+            fr, fc = rows - i0, cols - j0
+            w00, w01, w10, w11 = (1 - fr) * (1 - fc), (1 - fr) * fc, fr * (1 - fc), fr * fc
+            xs.append(X[i0, j0] * w00 + X[i0, j0 + 1] * w01 + X[i0 + 1, j0] * w10 + X[i0 + 1, j0 + 1] * w11)
+            ys.append(Y[i0, j0] * w00 + Y[i0, j0 + 1] * w01 + Y[i0 + 1, j0] * w10 + Y[i0 + 1, j0 + 1] * w11)
+            lev.append(level)
+    return {'xs': xs, 'ys': ys, 'level': lev}
+
+
 def get_contour_data(X, Y, Z, levels=[0.5, 0.7, 0.9]):
-    import matplotlib.pyplot as plt
-    import matplotlib.cm as cm
+    '''
+    Contour lines of an image as the data source of a bokeh multi_line
+    :param X: x coordinates of the pixels
+    :param Y: y coordinates of the pixels
+    :param Z: an image, or a stack of images in [nimg,ny,nx]
+    :param levels: contour levels relative to the maximum of the image
+    :return: a ColumnDataSource, or a list of them for a stack of images
+    '''
     from bokeh.models import (ColumnDataSource)
+    Z = np.asarray(Z)
+    if Z.ndim == 3:
+        return [get_contour_data(X, Y, zz, levels=levels) for zz in Z]
     try:
-        cs = plt.contour(X, Y, Z, levels=(np.array(levels) * np.nanmax(Z)).tolist(), cmap=cm.Greys_r)
-        # dx = X[0,1]-X[0,0]
-        # dy = Y[1,0]-Y[0,0]
-        xs = []
-        ys = []
-        xt = []
-        yt = []
-        col = []
-        text = []
-        isolevelid = 0
-        for isolevel in cs.collections:
-            # isocol = isolevel.get_color()[0]
-            # thecol = 3 * [None]
-            theiso = '{:.0f}%'.format(cs.get_array()[isolevelid] / Z.max() * 100)
-            isolevelid += 1
-            # for i in xrange(3):
-            # thecol[i] = int(255 * isocol[i])
-            thecol = '#%02x%02x%02x' % (220, 220, 220)
-            # thecol = '#03FFF9'
-
-            for path in isolevel.get_paths():
-                v = path.vertices
-                # x = v[:, 0]+dx
-                # y = v[:, 1]+dy
-                x = v[:, 0]
-                y = v[:, 1]
-                xs.append(x.tolist())
-                ys.append(y.tolist())
-                xt.append(x[len(x) / 2])
-                yt.append(y[len(y) / 2])
-                text.append(theiso)
-                col.append(thecol)
-        for coll in cs.collections:
-            coll.remove()
-
+        zmax = np.nanmax(Z)
+        paths = contourpaths(X, Y, Z, (np.array(levels) * zmax).tolist())
+        thecol = '#%02x%02x%02x' % (220, 220, 220)
+        xs = [x.tolist() for x in paths['xs']]
+        ys = [y.tolist() for y in paths['ys']]
+        xt = [x[len(x) // 2] for x in paths['xs']]
+        yt = [y[len(y) // 2] for y in paths['ys']]
+        text = ['{:.0f}%'.format(lev / zmax * 100) for lev in paths['level']]
+        col = [thecol] * len(xs)
         source = ColumnDataSource(data={'xs': xs, 'ys': ys, 'line_color': col, 'xt': xt, 'yt': yt, 'text': text})
     except:
         source = ColumnDataSource(data={'xs': [], 'ys': [], 'line_color': [], 'xt': [], 'yt': [], 'text': []})
@@ -1464,15 +1722,108 @@ def c_correlate(a, v):
     return np.correlate(a, v, mode='same')
 
 
-def XCorrMap(z, x, y, doxscale=True):
+def nextfastlen(n):
+    '''
+    the smallest 5-smooth number (2**i * 3**j * 5**k) no less than n, for fast FFT
+    '''
+    best = 2 ** int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+_xcorr_spec = {}
+
+
+def _xcorr_init(spec):
+    _xcorr_spec.clear()
+    _xcorr_spec.update(spec)
+
+
+def _xcorr_tile(pairs):
+    '''
+    cross correlate a tile of (idx1, idx2) pairs of light curves with the spectra in _xcorr_spec
+    :return: the max of the cross correlation and the lag index of the peak
+    '''
+    from numpy.fft import irfft
+    idx1, idx2 = pairs
+    cc = irfft(_xcorr_spec['fa'][idx1] * _xcorr_spec['fv'][idx2], _xcorr_spec['nfft'], axis=1)[:,
+         _xcorr_spec['lagidx']]
+    return np.amax(cc, axis=1), np.argmax(cc, axis=1)
+
+
+def xcorrlag(z, ncpu=1, tilesize=None):
+    '''
+    FFT-based cross correlation of all pairs of the rows in z. For each pair (idx1, idx2), idx1 > idx2,
+    the result is identical to c_correlate(z[idx1], z[idx2]) reduced to its max and peak lag.
+    :param z: 2d array, light curves along the x axis
+    :param ncpu: number of processes to compute the tiles of pairs. 1 to run in the current process
+    :param tilesize: number of pairs cross-correlated in one vectorized call. Default to a tile of ~64 MB
+    :return: ccmax, ccpeak and the pair indices idx1, idx2
+    '''
+    from numpy.fft import rfft
+    ny, nx = z.shape
+    # only the lags within +-nx/2 are kept, so a circular correlation of length nx + nx / 2 is free of wrap-around
+    nfft = nextfastlen(nx + nx // 2 + 1)
+    zmean = np.mean(z, axis=1, keepdims=True)
+    zstd = np.std(z, axis=1, keepdims=True)
+    # the normalization in c_correlate
+    a = (z - zmean) / (zstd * nx)
+    v = (z - zmean) / zstd
+    # np.correlate(a, v, mode='same') picks the lags from -nx / 2 to (nx - 1) / 2 of the full
+    # cross correlation. negative lags wrap to the end of the circular cross correlation.
+    lagidx = (np.arange(nx) + (nx - 1) // 2 - (nx - 1)) % nfft
+    spec = {'fa': rfft(a, nfft, axis=1), 'fv': np.conj(rfft(v, nfft, axis=1)), 'nfft': nfft, 'lagidx': lagidx}
+    idx1, idx2 = np.tril_indices(ny, -1)
+    npair = len(idx1)
+    if not tilesize:
+        tilesize = max(1, 2 ** 23 // nfft)
+    tiles = [(idx1[i:i + tilesize], idx2[i:i + tilesize]) for i in xrange(0, npair, tilesize)]
+    if ncpu > 1 and len(tiles) > 1:
+        import multiprocessing as mp
+        pool = mp.Pool(ncpu, initializer=_xcorr_init, initargs=(spec,))
+        res = pool.map(_xcorr_tile, tiles)
+        pool.close()
+        pool.join()
+    else:
+        _xcorr_init(spec)
+        res = [_xcorr_tile(tile) for tile in tiles]
+    _xcorr_spec.clear()
+    if res:
+        ccmax = np.hstack([ll[0] for ll in res])
+        ccpeak = np.hstack([ll[1] for ll in res]) - (nx - 1) // 2
+    else:
+        ccmax = np.zeros(0)
+        ccpeak = np.zeros(0, dtype=int)
+    zerolc = np.sum(z, axis=1) == 0
+    zeropair = np.logical_or(zerolc[idx1], zerolc[idx2])
+    ccmax[zeropair] = 0
+    ccpeak[zeropair] = 0
+    return ccmax, ccpeak, idx1, idx2
+
+
+def XCorrMap(z, x, y, doxscale=True, ncpu=None, tilesize=None):
     '''
     get the cross correlation map along y axis
     :param z: data
     :param x: x axis
     :param y: y axis
+    :param ncpu: number of processes used by the cross correlation, see xcorrlag. Default is the number of CPUs
+    :param tilesize: number of frequency pairs cross-correlated in one vectorized call, see xcorrlag
     :return:
     '''
     from scipy.interpolate import splev, splrep
+    if ncpu is None:
+        import multiprocessing as mp
+        ncpu = mp.cpu_count()
     if doxscale:
         xfit = np.linspace(x[0], x[-1], 10 * len(x) + 1)
         zfit = np.zeros((len(y), len(xfit)))
@@ -1490,39 +1841,305 @@ def XCorrMap(z, x, y, doxscale=True):
     ccpeak = np.empty((ny - 1, ny - 1))
     ccpeak[:] = np.nan
     ccmax = ccpeak.copy()
-    ya = ccpeak.copy()
-    yv = ccpeak.copy()
-    yidxa = ccpeak.copy()
-    yidxv = ccpeak.copy()
-    for idx1 in xrange(1, ny):
-        for idx2 in xrange(0, idx1):
-            lightcurve1 = zfit[idx1, :]
-            lightcurve2 = zfit[idx2, :]
-            ccval = c_correlate(lightcurve1, lightcurve2)
-            if sum(lightcurve1) != 0 and sum(lightcurve2) != 0:
-                cmax = np.amax(ccval)
-                cpeak = np.argmax(ccval) - (nxfit - 1) / 2
-            else:
-                cmax = 0
-                cpeak = 0
-            ccmax[idx2, idx1 - 1] = cmax
-            ccpeak[idx2, idx1 - 1] = cpeak
-            ya[idx2, idx1 - 1] = y[idx1 - 1]
-            yv[idx2, idx1 - 1] = y[idx2]
-            yidxa[idx2, idx1 - 1] = idx1 - 1
-            yidxv[idx2, idx1 - 1] = idx2
-            if idx1 - 1 != idx2:
-                ccmax[idx1 - 1, idx2] = cmax
-                ccpeak[idx1 - 1, idx2] = cpeak
-                ya[idx1 - 1, idx2] = y[idx2]
-                yv[idx1 - 1, idx2] = y[idx1 - 1]
-                yidxa[idx1 - 1, idx2] = idx2
-                yidxv[idx1 - 1, idx2] = idx1 - 1
+    cmax, cpeak, idx1, idx2 = xcorrlag(zfit, ncpu=ncpu, tilesize=tilesize)
+    ccmax[idx2, idx1 - 1] = cmax
+    ccpeak[idx2, idx1 - 1] = cpeak
+    ccmax[idx1 - 1, idx2] = cmax
+    ccpeak[idx1 - 1, idx2] = cpeak
+    yidxv, yidxa = np.mgrid[0:ny - 1, 0:ny - 1].astype(float)
+    ya = np.asarray(y, dtype=float)[yidxa.astype(int)]
+    yv = np.asarray(y, dtype=float)[yidxv.astype(int)]
 
     return {'zfit': zfit, 'ccmax': ccmax, 'ccpeak': ccpeak, 'x': x, 'nx': len(x), 'xfit': xfit, 'nxfit': nxfit, 'y': y,
             'ny': ny, 'yv': yv, 'ya': ya, 'yidxv': yidxv, 'yidxa': yidxa}
 
 
+class LRUCache():
+    '''
+    A memory-bounded least-recently-used cache. The least recently used items are evicted
+    once the total size of the cached items exceeds maxbytes. Items put with their numpy arrays
+    are sized by the memory buffers behind the arrays, so a view (e.g., a submap) shared by
+    several items is counted once.
+    '''
+
+    def __init__(self, maxbytes=2 * 1024 ** 3):
+        from collections import OrderedDict
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        # id of a buffer: [number of items that use it, size, the buffer]
+        self._buffers = {}
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        '''
+        :param key:
+        :param default: returned if the key is not cached
+        :return: the cached value. The item becomes the most recently used one
+        '''
+        if key in self._items:
+            item = self._items.pop(key)
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+        else:
+            self.misses += 1
+            return default
+
+    def put(self, key, value, nbytes=None, arrays=None):
+        '''
+        :param key: a hashable key
+        :param value:
+        :param nbytes: size of the value in bytes. If None, use value.nbytes if available
+        :param arrays: list of the numpy arrays held by the value. If given, the value is sized by the buffers
+                    behind the arrays that are not already counted for other items, and nbytes is ignored
+        :return:
+        '''
+        if key in self._items:
+            self._release(self._items.pop(key))
+        if arrays is not None:
+            bases = {}
+            for arr in arrays:
+                base = arr
+                while isinstance(base.base, np.ndarray):
+                    base = base.base
+                bases[id(base)] = base
+            nbytes = sum([base.nbytes for bufid, base in bases.items() if bufid not in self._buffers])
+            if nbytes > self.maxbytes:
+                return
+            for bufid, base in bases.items():
+                if bufid in self._buffers:
+                    self._buffers[bufid][0] += 1
+                else:
+                    self._buffers[bufid] = [1, base.nbytes, base]
+            self._items[key] = (value, 0, list(bases.keys()))
+        else:
+            if nbytes is None:
+                nbytes = getattr(value, 'nbytes', 0)
+            if nbytes > self.maxbytes:
+                return
+            self._items[key] = (value, nbytes, [])
+        self.nbytes += nbytes
+        while self.nbytes > self.maxbytes:
+            self._release(self._items.popitem(last=False)[1])
+
+    def _release(self, item):
+        value, nbytes, bufids = item
+        self.nbytes -= nbytes
+        for bufid in bufids:
+            buf = self._buffers[bufid]
+            buf[0] -= 1
+            if buf[0] == 0:
+                self.nbytes -= buf[1]
+                del self._buffers[bufid]
+
+    def clear(self):
+        self._items.clear()
+        self._buffers.clear()
+        self.nbytes = 0
+
+    @property
+    def hitrate(self):
+        ntot = self.hits + self.misses
+        return float(self.hits) / ntot if ntot else 0.0
+
+    def info(self):
+        return '{} items, {:.1f}/{:.1f} MB, hit rate {:.0%}'.format(len(self._items), self.nbytes / 1024. ** 2,
+                                                                  self.maxbytes / 1024. ** 2, self.hitrate)
+
+
+class FramePrefetcher():
+    '''
+    Load frames (e.g., FITS images of time steps) by index through a LRU cache, and prefetch
+    the neighbouring frames in a background thread so that scrubbing through the frames does
+    not wait for the disk.
+    '''
+
+    def __init__(self, loader, maxbytes=1024 ** 3, nahead=3, nbehind=1, sizeof=None):
+        '''
+        :param loader: function that loads the frame of an index. It returns None if the frame is not available
+        :param maxbytes: memory limit of the frame cache
+        :param nahead: number of frames after the requested one to prefetch
+        :param nbehind: number of frames before the requested one to prefetch
+        :param sizeof: function that returns the size of a frame in bytes. If None, use frame.nbytes if available
+        '''
+        import threading
+        import Queue
+        self.loader = loader
+        self.sizeof = sizeof
+        self.nahead = nahead
+        self.nbehind = nbehind
+        self.cache = LRUCache(maxbytes=maxbytes)
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _load(self, idx):
+        with self._lock:
+            if idx in self.cache:
+                return
+        frame = self.loader(idx)
+        if frame is not None:
+            with self._lock:
+                self.cache.put(idx, frame, self.sizeof(frame) if self.sizeof else None)
+
+    def _worker(self):
+        while True:
+            indices = self._queue.get()
+            # skip the outdated requests if the user has moved on
+            while not self._queue.empty():
+                indices = self._queue.get()
+            for idx in indices:
+                try:
+                    self._load(idx)
+                except Exception as err:
+                    print('failed to prefetch frame {}: {}'.format(idx, err))
+
+    def get(self, idx, prefetch=True):
+        '''
+        :param idx: index of the frame
+        :param prefetch: if True, prefetch the neighbouring frames in the background
+        :return: the frame
+        '''
+        with self._lock:
+            frame = self.cache.get(idx)
+        if frame is None:
+            frame = self.loader(idx)
+            if frame is not None:
+                with self._lock:
+                    self.cache.put(idx, frame, self.sizeof(frame) if self.sizeof else None)
+        if prefetch:
+            self.prefetch(idx)
+        return frame
+
+    def prefetch(self, idx):
+        indices = range(idx + 1, idx + 1 + self.nahead) + range(idx - 1, idx - 1 - self.nbehind, -1)
+        self._queue.put([ll for ll in indices if ll >= 0])
+
+
+def _exportjob_init(func, args, common):
+    global _exportjob_func, _exportjob_args, _exportjob_common
+    _exportjob_func = func
+    _exportjob_args = args
+    _exportjob_common = common
+
+
+def _exportjob_run(task):
+    idx, (args, kwargs) = task
+    kw = dict(_exportjob_common)
+    kw.update(kwargs)
+    try:
+        _exportjob_func(*(tuple(args) + _exportjob_args), **kw)
+        return idx, None
+    except Exception as err:
+        return idx, '{}: {}'.format(type(err).__name__, err)
+
+
+class ExportJob():
+    '''
+    Run a batch of export tasks (e.g., rendering the frames of a movie) in a pool of worker processes
+    in the background. The caller polls the progress, e.g., from a periodic callback of the bokeh server,
+    and can cancel the job at any time.
+    '''
+
+    def __init__(self, func, tasks, args=(), common=None, ncpu=None):
+        '''
+        :param func: module level function called as func(*(task_args + args), **common_and_task_kwargs)
+                    in the worker processes
+        :param tasks: list of (task_args, task_kwargs) tuples, one for each task
+        :param args: positional arguments shared by all the tasks, appended after the positional arguments of the task
+        :param common: keyword arguments shared by all the tasks. args and common are passed to the workers once
+                    when the pool starts instead of with each task
+        :param ncpu: number of worker processes. Default is the number of cpus minus one
+        '''
+        import multiprocessing as mp
+        self.func = func
+        self.tasks = tasks
+        self.args = tuple(args)
+        self.common = common or {}
+        if ncpu is None:
+            ncpu = max(1, mp.cpu_count() - 1)
+        self.ncpu = max(1, min(ncpu, len(tasks)))
+        self.ntask = len(tasks)
+        self.ndone = 0
+        self.errors = {}
+        self.status = 'pending'
+        self.tstart = None
+        self.tend = None
+        self._cancel = False
+        self._thread = None
+
+    def start(self):
+        import threading
+        import time
+        self.tstart = time.time()
+        self.status = 'running'
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _worker(self):
+        import multiprocessing as mp
+        import time
+        pool = mp.Pool(self.ncpu, initializer=_exportjob_init, initargs=(self.func, self.args, self.common))
+        try:
+            results = pool.imap_unordered(_exportjob_run, enumerate(self.tasks))
+            while self.ndone < self.ntask:
+                if self._cancel:
+                    break
+                try:
+                    idx, err = results.next(timeout=0.2)
+                except mp.TimeoutError:
+                    continue
+                if err:
+                    self.errors[idx] = err
+                self.ndone += 1
+        except Exception as err:
+            self.errors[-1] = '{}: {}'.format(type(err).__name__, err)
+        if self._cancel:
+            pool.terminate()
+            self.status = 'cancelled'
+        else:
+            pool.close()
+            self.status = 'done'
+        pool.join()
+        self.tend = time.time()
+
+    def cancel(self):
+        '''
+        stop the job. The frames being rendered are abandoned.
+        '''
+        self._cancel = True
+
+    @property
+    def running(self):
+        return self.status in ['pending', 'running']
+
+    @property
+    def rate(self):
+        '''
+        :return: number of finished tasks per second
+        '''
+        import time
+        if self.tstart is None:
+            return 0.0
+        return self.ndone / max((self.tend or time.time()) - self.tstart, 1e-6)
+
+    def info(self):
+        return '{} {}/{} frames, {:.1f} frames/s, {} failed'.format(self.status, self.ndone, self.ntask, self.rate,
+                                                                    len(self.errors))
+
+
 class ButtonsPlayCTRL():
     '''
     Produce A play/stop button widget for bokeh plot
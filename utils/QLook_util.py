@@ -1,3 +1,4 @@
+import os
 import astropy.units as u
 import matplotlib.pyplot as plt
 import numpy as np
@@ -85,3 +86,282 @@ def twoD_Gaussian((x, y), amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
 #
 #     return popt
 
+
+
+def maxfit_grid(image):
+    '''
+    pixel coordinates and cold initial guess of the 2D Gaussian fit of an image, as in maxfit
+    :param image: sunpy map
+    :return: mapx, mapy, initial_guess
+    '''
+    data = image.data
+    nx, ny = data.shape
+    dx, dy = image.scale.x.value, image.scale.y.value
+    xc, yc = image.center.x.value, image.center.y.value
+    mapx, mapy = (np.linspace(0, nx - 1, nx) - image.reference_pixel.x.value + 1 + 0.5) * dx + xc, (
+        np.linspace(0, ny - 1, ny) - image.reference_pixel.y.value + 1 + 0.5) * dy + yc
+    mapx, mapy = np.meshgrid(mapx, mapy)
+    idxmax = np.where(data == np.amax(data))
+    idxhm = np.where(data >= np.amax(data) / 2)
+    hmfw = np.sqrt(len(idxhm[0]) / np.pi) * dx
+    xmax, ymax = mapx[idxmax[0][0], idxmax[1][0]], mapy[idxmax[0][0], idxmax[1][0]]
+    theta = np.arctan(
+        abs(idxhm[1] - image.reference_pixel.y.value).sum() / abs(idxhm[0] - image.reference_pixel.x.value).sum())
+    initial_guess = (np.amax(data), xmax, ymax, hmfw, hmfw, theta, data.std())
+    return mapx, mapy, initial_guess
+
+
+def gaussfit_leastsq(mapx, mapy, data, p0, maxfev=1600):
+    '''
+    2D Gaussian fit with a bounded number of function evaluations. This is the least squares
+    problem curve_fit solves, with the number of evaluations and the convergence flag returned.
+    The default maxfev is the one of curve_fit for the 7 parameters, 200 * (7 + 1).
+    :return: popt, nfev, converged
+    '''
+
+    def residual(params):
+        return twoD_Gaussian((mapx, mapy), *params) - data.ravel()
+
+    popt, cov, infodict, mesg, ier = opt.leastsq(residual, p0, full_output=True, maxfev=maxfev)
+    return popt, infodict['nfev'], ier in [1, 2, 3, 4]
+
+
+def _gaussfit_batch(args):
+    '''
+    fit the images of a batch of FITS files in order. Each fit is seeded with the solution of the
+    previous image, and falls back to a cold initial guess if the warm started fit does not converge.
+    '''
+    import sunpy.map
+    from astropy.io import fits
+    fitspath, files, maxfev = args
+    results = []
+    pwarm = None
+    for ll in files:
+        if not os.path.exists(fitspath + ll):
+            results.append((np.full(7, np.nan), False, 'nofile', 0))
+            continue
+        try:
+            hdulist = fits.open(fitspath + ll)
+            hdu = hdulist[0]
+            vlamap = sunpy.map.Map((hdu.data[0, 0, :, :], hdu.header))
+            hdulist.close()
+            data = vlamap.data
+            mapx, mapy, pcold = maxfit_grid(vlamap)
+            nfev = 0
+            converged = False
+            if pwarm is not None:
+                popt, nfev, converged = gaussfit_leastsq(mapx, mapy, data, pwarm, maxfev=maxfev)
+            if not converged:
+                popt, nfev_cold, converged = gaussfit_leastsq(mapx, mapy, data, pcold, maxfev=maxfev)
+                nfev += nfev_cold
+            if converged:
+                pwarm = popt
+                results.append((popt, True, 'ok', nfev))
+            else:
+                pwarm = None
+                results.append((np.full(7, np.nan), True, 'maxfev', nfev))
+        except Exception:
+            pwarm = None
+            results.append((np.full(7, np.nan), True, 'failed', 0))
+    return results
+
+
+def gaussfit_files(fitspath, files, rowlen=None, batchsize=64, maxfev=1600, ncpu=1):
+    '''
+    Fit a 2D Gaussian to the images of a list of FITS files across a pool of workers.
+    The files are split into batches of consecutive images (e.g., consecutive times of a frequency),
+    and the fit of each image is seeded with the solution of the previous one in the batch.
+    :param fitspath: directory of the FITS files
+    :param files: list of the FITS file names
+    :param rowlen: batches do not cross rows of rowlen files, e.g., rowlen=ntim for files ordered as [nfreq, ntim]
+    :param batchsize: number of files per batch
+    :param maxfev: maximum number of function evaluations per fit. Default is the one of curve_fit
+    :param ncpu: number of workers
+    :return: a dictionary of the fitted parameters [nfile, 7], the file existence, the fit status
+             ('ok', 'maxfev', 'failed' or 'nofile'), the number of function evaluations of each fit and
+             the fitting rate in fits/s
+    '''
+    import time
+    import multiprocessing as mp
+    t0 = time.time()
+    nfile = len(files)
+    if not rowlen:
+        rowlen = nfile
+    bounds = []
+    for rst in range(0, nfile, rowlen):
+        red = min(rst + rowlen, nfile)
+        bounds += [(ll, min(ll + batchsize, red)) for ll in range(rst, red, batchsize)]
+    tasks = [(fitspath, files[bst:bed], maxfev) for bst, bed in bounds]
+    if ncpu > 1:
+        pool = mp.Pool(processes=ncpu)
+        results = pool.map(_gaussfit_batch, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_gaussfit_batch, tasks)
+    results = [res for batch in results for res in batch]
+    tdur = time.time() - t0
+    status = [res[2] for res in results]
+    nfit = sum([ll != 'nofile' for ll in status])
+    fitrate = nfit / tdur if tdur > 0 else np.nan
+    print('{} fits in {:.1f} sec ({:.1f} fits/s), {} not converged, {} failed, {} files not found'.format(
+        nfit, tdur, fitrate, status.count('maxfev'), status.count('failed'), status.count('nofile')))
+    return {'params': np.array([res[0] for res in results]), 'fexist': [res[1] for res in results],
+            'status': status, 'nfev': [res[3] for res in results], 'fitrate': fitrate}
+
+
+def colormap_lut(cmap='jet', N=256):
+    '''
+    RGB lookup table of a matplotlib colormap
+    :return: [N, 3] uint8 array
+    '''
+    return (cm.get_cmap(cmap)(np.linspace(0, 1, N))[:, :3] * 255).astype(np.uint8)
+
+
+def render_thumbnail(data, lut, vmin=None, vmax=None, size=256):
+    '''
+    render an image to a RGB thumbnail through a colormap lookup table, with the origin at the lower left
+    :param data: 2D image
+    :param lut: colormap lookup table from colormap_lut
+    :param size: size of the thumbnail in pixels
+    :return: [size, size, 3] uint8 array
+    '''
+    if vmin is None:
+        vmin = np.nanmin(data)
+    if vmax is None:
+        vmax = np.nanmax(data)
+    N = len(lut)
+    scl = (N - 1) / float(vmax - vmin) if vmax > vmin else 0.0
+    idx = (np.nan_to_num(data) - vmin) * scl
+    idx = np.clip(idx, 0, N - 1).astype(np.intp)
+    ny, nx = data.shape
+    rows = (np.arange(size) * ny // size)[::-1]
+    cols = np.arange(size) * nx // size
+    return lut[idx[rows[:, None], cols[None, :]]]
+
+
+def draw_thumbnail_line(rgb, rows, cols, shape, color=(255, 255, 255)):
+    '''
+    draw a polyline given in the pixel coordinates of the image onto its thumbnail
+    '''
+    size = rgb.shape[0]
+    ny, nx = shape
+    y = (ny - 0.5 - np.asarray(rows, dtype=float)) * size / float(ny)
+    x = (np.asarray(cols, dtype=float) + 0.5) * size / float(nx)
+    if len(x) > 1:
+        dist = np.concatenate(([0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+        steps = np.arange(0, dist[-1] + 0.5, 0.5)
+        x, y = np.interp(steps, dist, x), np.interp(steps, dist, y)
+    x, y = x.astype(int), y.astype(int)
+    inside = (x >= 0) & (x < size) & (y >= 0) & (y < size)
+    rgb[y[inside], x[inside]] = color
+
+
+def filehash(fname, extra=''):
+    '''
+    md5 hash of the content of a file, and of any extra string (e.g., rendering parameters)
+    '''
+    import hashlib
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            md5.update(chunk)
+    md5.update(extra)
+    return md5.hexdigest()
+
+
+def _thumbnail_task(args):
+    '''
+    render the thumbnail of a FITS image, with the fitted source position and its contours if provided.
+    The thumbnail is skipped if the hash of the input is unchanged and the thumbnail exists.
+    '''
+    import sunpy.map
+    from astropy.io import fits
+    from PIL import Image
+    from suncasa.utils import DButil
+    fitsfile, outfile, popt, lut, size, oldhash = args
+    try:
+        newhash = filehash(fitsfile, extra='{}{}{}'.format(popt, size, lut.tostring()))
+        if newhash == oldhash and os.path.exists(outfile):
+            return outfile, newhash, 'skipped'
+        hdulist = fits.open(fitsfile)
+        hdu = hdulist[0]
+        vlamap = sunpy.map.Map((hdu.data[0, 0, :, :], hdu.header))
+        hdulist.close()
+        data = vlamap.data
+        rgb = render_thumbnail(data, lut, size=size)
+        if popt is not None:
+            mapx, mapy, pcold = maxfit_grid(vlamap)
+            dx, dy = mapx[0, 1] - mapx[0, 0], mapy[1, 0] - mapy[0, 0]
+            if popt[0] + popt[6] > 0:
+                data_fitted = twoD_Gaussian((mapx, mapy), *popt).reshape(data.shape)
+                for level in (np.arange(5, 10, 2) / 10.0 * (popt[0] + popt[6])).tolist():
+                    for rows, cols in DButil.marchingsquares(data_fitted, level):
+                        draw_thumbnail_line(rgb, rows, cols, data.shape)
+            prow, pcol = (popt[2] - mapy[0, 0]) / dy, (popt[1] - mapx[0, 0]) / dx
+            for drow, dcol in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
+                draw_thumbnail_line(rgb, [prow, prow + drow * 1.5], [pcol, pcol + dcol * 1.5], data.shape,
+                                    color=(255, 0, 0))
+        Image.fromarray(rgb).save(outfile, quality=90)
+        return outfile, newhash, 'rendered'
+    except Exception as err:
+        print('failed to render {}: {}'.format(outfile, err))
+        return outfile, None, 'failed'
+
+
+def make_thumbnails(fitsfiles, outfiles, params=None, cmap='jet', size=256, ncpu=1):
+    '''
+    Render the thumbnails of FITS images across a pool of workers, directly from the image arrays
+    through a colormap lookup table. The content hash of each input is kept in a manifest
+    (thumbnails.json) in the directory of the thumbnails, and unchanged inputs are skipped.
+    :param fitsfiles: list of FITS files
+    :param outfiles: list of the thumbnail files. The format follows the extension, e.g., jpg or png
+    :param params: list of the fitted 2D Gaussian parameters of the images (see maxfit), or None
+    :param cmap: matplotlib colormap
+    :param size: size of the thumbnails in pixels
+    :param ncpu: number of workers
+    :return: a dictionary of the number of rendered, skipped and failed thumbnails and the rate in images/s
+    '''
+    import json
+    import time
+    import multiprocessing as mp
+    t0 = time.time()
+    lut = colormap_lut(cmap)
+    if params is None:
+        params = [None] * len(fitsfiles)
+    manifests = {}
+    for ll in set([os.path.dirname(os.path.abspath(ll)) for ll in outfiles]):
+        manifest = os.path.join(ll, 'thumbnails.json')
+        if os.path.exists(manifest):
+            with open(manifest, 'r') as fp:
+                manifests[ll] = json.load(fp)
+        else:
+            manifests[ll] = {}
+    tasks = []
+    for fitsfile, outfile, popt in zip(fitsfiles, outfiles, params):
+        outdir, outname = os.path.split(os.path.abspath(outfile))
+        if popt is not None:
+            popt = [float(ll) for ll in popt]
+        tasks.append((fitsfile, outfile, popt, lut, size, manifests[outdir].get(outname)))
+    if ncpu > 1:
+        pool = mp.Pool(processes=ncpu)
+        results = pool.map(_thumbnail_task, tasks, chunksize=max(1, len(tasks) // (ncpu * 8)))
+        pool.close()
+        pool.join()
+    else:
+        results = map(_thumbnail_task, tasks)
+    for outfile, newhash, status in results:
+        outdir, outname = os.path.split(os.path.abspath(outfile))
+        if newhash:
+            manifests[outdir][outname] = newhash
+    for outdir, manifest in manifests.items():
+        with open(os.path.join(outdir, 'thumbnails.json'), 'w') as fp:
+            json.dump(manifest, fp)
+    tdur = time.time() - t0
+    status = [res[2] for res in results]
+    nrendered = status.count('rendered')
+    stats = {'rendered': nrendered, 'skipped': status.count('skipped'), 'failed': status.count('failed'),
+             'rate': nrendered / tdur if tdur > 0 else np.nan}
+    print('{} thumbnails rendered in {:.1f} sec ({:.1f} images/s), {} unchanged, {} failed'.format(
+        nrendered, tdur, stats['rate'], stats['skipped'], stats['failed']))
+    return stats
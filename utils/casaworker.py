@@ -0,0 +1,278 @@
+'''
+A persistent CASA process that runs jobs (dynamic spectrum, ptclean) sent over a local unix socket.
+Starting CASA takes tens of seconds, so the helpers in svplot send their jobs to one long-running
+worker instead of launching "casa --nologger -c script.py" for every call. The messages are pickled
+and prefixed with their length, and the arrays come back directly without an intermediate npz file.
+
+The worker outlives the session that started it and is shared by all the sessions of the user, so every
+request carries the working directory of its caller, and the job runs there. Relative paths (vis, imageprefix,
+specfile) resolve as they would in the caller.
+
+The socket lives in a directory that only the user can access, /tmp/suncasa_casaworker_<uid>/ by default, and
+both ends check that the process on the other end runs as the same user before they unpickle anything from it.
+The worker exits after idletimeout seconds without a request.
+
+The worker is started with
+    casa --nologger -c "from suncasa.utils import casaworker; casaworker.serve('<sockfile>', idletimeout=3600.)"
+which is done automatically by CASAWorker.start().
+'''
+import os
+import sys
+import stat
+import time
+import errno
+import pickle
+import socket
+import struct
+import subprocess
+import traceback
+
+__author__ = ["Sijie Yu"]
+__email__ = "sijie.yu@njit.edu"
+
+_hdr = struct.Struct('!Q')
+
+
+def sendmsg(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_hdr.pack(len(data)) + data)
+
+
+def _recvall(sock, nbytes):
+    chunks = []
+    while nbytes > 0:
+        chunk = sock.recv(min(nbytes, 1 << 20))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return ''.join(chunks)
+
+
+def recvmsg(sock):
+    nbytes, = _hdr.unpack(_recvall(sock, _hdr.size))
+    return pickle.loads(_recvall(sock, nbytes))
+
+
+def privatedir(path):
+    '''
+    create the directory with mode 0700 if needed, and check that only the current user can access it
+    :return: path
+    '''
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError('{} is not a directory private to user {}'.format(path, os.getuid()))
+    return path
+
+
+def peeruid(sock, sockfile=None):
+    '''
+    :return: uid of the process at the other end of a unix socket. Where SO_PEERCRED is not available
+             (python 2 does not define it, and mac has no such option), the owner of sockfile, or None
+    '''
+    if sys.platform.startswith('linux'):
+        creds = sock.getsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', 17), struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[1]
+    if sockfile is not None:
+        return os.stat(sockfile).st_uid
+    return None
+
+
+def _job_ping():
+    return os.getpid()
+
+
+def _job_dspec(**kwargs):
+    from suncasa.utils import dspec2 as ds
+    return ds.get_dspec(**kwargs)
+
+
+def _job_ptclean(**kwargs):
+    from ptclean_cli import ptclean_cli as ptclean
+    return ptclean(**kwargs)
+
+
+jobs = {'ping': _job_ping, 'dspec': _job_dspec, 'ptclean': _job_ptclean}
+
+
+def serve(sockfile, jobs=jobs, idletimeout=3600.):
+    '''
+    run the worker loop: accept one connection at a time and run its jobs in this process,
+    since the CASA tools are not thread safe.
+    :param sockfile: path of the unix socket. Its directory must be private to the user
+    :param jobs: dict of {job name: function}
+    :param idletimeout: seconds without a request after which a connection is closed, and the worker exits
+                        if no other connection is waiting
+    :return:
+    '''
+    privatedir(os.path.dirname(os.path.abspath(sockfile)))
+    if os.path.exists(sockfile):
+        os.remove(sockfile)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sockfile)
+    server.listen(8)
+    server.settimeout(idletimeout)
+    print 'CASA worker {} listening on {}'.format(os.getpid(), sockfile)
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                print 'CASA worker {} idle for {:.0f} s, exiting'.format(os.getpid(), idletimeout)
+                return
+            conn.settimeout(idletimeout)
+            try:
+                if peeruid(conn) not in [None, os.getuid()]:
+                    print 'CASA worker {} refused a connection of another user'.format(os.getpid())
+                    continue
+                while True:
+                    try:
+                        req = recvmsg(conn)
+                    except (EOFError, socket.timeout):
+                        break
+                    if req['job'] == 'shutdown':
+                        sendmsg(conn, {'status': 'ok', 'result': None})
+                        return
+                    t0 = time.time()
+                    try:
+                        if req.get('cwd'):
+                            os.chdir(req['cwd'])
+                        res = {'status': 'ok', 'result': jobs[req['job']](**req.get('kwargs', {}))}
+                    except Exception:
+                        res = {'status': 'error', 'error': traceback.format_exc()}
+                    res['runtime'] = time.time() - t0
+                    sendmsg(conn, res)
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(sockfile):
+            os.remove(sockfile)
+
+
+class CASAWorker():
+    '''
+    Client of a persistent CASA worker. The worker process is started on the first call if it is not
+    running yet, and it is reused by the following calls.
+    '''
+
+    def __init__(self, sockfile=None, casacmd='casa --nologger', starttimeout=300., logfile=None,
+                 idletimeout=3600.):
+        '''
+        :param sockfile: path of the unix socket, in a directory private to the user.
+                         Default is /tmp/suncasa_casaworker_<uid>/worker.sock
+        :param casacmd: command to start CASA
+        :param starttimeout: seconds to wait for the worker to come up
+        :param logfile: file to write the output of the worker. Default is sockfile + '.log'
+        :param idletimeout: seconds without a request after which the worker exits
+        '''
+        if sockfile is None:
+            sockfile = os.path.join('/tmp', 'suncasa_casaworker_{}'.format(os.getuid()), 'worker.sock')
+        self.sockfile = sockfile
+        self.casacmd = casacmd
+        self.starttimeout = starttimeout
+        self.idletimeout = idletimeout
+        self.tlast = 0.
+        self.logfile = logfile or sockfile + '.log'
+        self.proc = None
+        self.sock = None
+        self.ncall = 0
+        self.latency = []
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.sockfile)
+        uid = peeruid(sock, self.sockfile)
+        if uid != os.getuid():
+            sock.close()
+            raise RuntimeError('{} is served by user {}, not by {}'.format(self.sockfile, uid, os.getuid()))
+        self.tlast = time.time()
+        return sock
+
+    def start(self):
+        '''
+        connect to the worker, and start one if none is listening on the socket
+        :return: self
+        '''
+        if self.sock is not None and time.time() - self.tlast > self.idletimeout / 2.:
+            # the worker may have closed the idle connection, or exited
+            self.sock.close()
+            self.sock = None
+        if self.sock is not None:
+            return self
+        privatedir(os.path.dirname(os.path.abspath(self.sockfile)))
+        try:
+            self.sock = self._connect()
+            return self
+        except socket.error:
+            pass
+        cmd = self.casacmd.split() + ['-c', 'from suncasa.utils import casaworker; casaworker.serve("{}", '
+                                            'idletimeout={})'.format(self.sockfile, self.idletimeout)]
+        self.proc = subprocess.Popen(cmd, stdout=open(self.logfile, 'a'), stderr=subprocess.STDOUT)
+        t0 = time.time()
+        while time.time() - t0 < self.starttimeout:
+            if self.proc.poll() is not None:
+                raise RuntimeError('CASA worker exited with code {}. See {}'.format(self.proc.returncode, self.logfile))
+            try:
+                self.sock = self._connect()
+                print 'CASA worker started in {:.1f} s'.format(time.time() - t0)
+                return self
+            except socket.error:
+                time.sleep(0.5)
+        self.proc.kill()
+        raise RuntimeError('CASA worker did not start in {:.0f} s. See {}'.format(self.starttimeout, self.logfile))
+
+    def call(self, job, **kwargs):
+        '''
+        run a job in the worker, in the current working directory of this process
+        :param job: name of the job, e.g., 'dspec' or 'ptclean'
+        :param kwargs: keyword arguments of the job
+        :return: return value of the job
+        '''
+        self.start()
+        t0 = time.time()
+        try:
+            sendmsg(self.sock, {'job': job, 'kwargs': kwargs, 'cwd': os.getcwd()})
+            res = recvmsg(self.sock)
+        except (socket.error, EOFError):
+            # the worker has gone away. Drop the connection so that the next call starts a new one
+            self.sock = None
+            raise
+        self.tlast = time.time()
+        self.ncall += 1
+        self.latency.append(self.tlast - t0)
+        if res['status'] != 'ok':
+            raise RuntimeError('CASA worker job {} failed:\n{}'.format(job, res['error']))
+        return res['result']
+
+    def shutdown(self):
+        if self.sock is None:
+            return
+        try:
+            sendmsg(self.sock, {'job': 'shutdown'})
+            recvmsg(self.sock)
+        except (socket.error, EOFError):
+            pass
+        self.sock.close()
+        self.sock = None
+        if self.proc is not None:
+            self.proc.wait()
+            self.proc = None
+
+
+_worker = None
+
+
+def getworker(**kwargs):
+    '''
+    :return: the CASAWorker shared by the helpers of this python session
+    '''
+    global _worker
+    if _worker is None:
+        _worker = CASAWorker(**kwargs)
+    return _worker
@@ -442,13 +442,10 @@ def plt_dspec_old(mspath=None, specfile=None, pol='I', dmin=None, dmax=None, fig
         xticks = np.arange(ntim[0] / 1200) * 1200 + xstart
     elif ntim[0] > 12000:
         xticks = np.arange(ntim[0] / 6000 + 1) * 6000
-    nticks = xticks.shape
     xticktims = []
-    for i in range(nticks[0]):
-        # xticktim0=qa.time(qa.quantity(tim[xticks[i]],'s'))
-        tims = tim[xticks[i]]  # in seconds
-        tims_jd = jdutil.mjd_to_jd(tims / 3600. / 24.)  # to julian date
-        tims_dt = jdutil.jd_to_datetime(tims_jd)
+    tims = tim[xticks]  # in seconds
+    tims_jd = jdutil.mjd_to_jd(tims / 3600. / 24.)  # to julian date
+    for tims_dt in jdutil.jd_to_datetime_array(tims_jd):
         tims_dt2 = tims_dt + datetime.timedelta(seconds=round(tims_dt.microsecond / 1e6))
         tims_char = tims_dt2.strftime('%H:%M:%S')
         xticktims.append(tims_char)
@@ -471,6 +471,132 @@ def getbeam(imagefile=None, beamfile=None):
     return bmaj, bmin, bpa, beamunit, bpaunit
 
 
+def beamarea(bmaj, bmin, beamunit='arcsec'):
+    '''
+    area of the (per-plane) gaussian restoring beam(s) in steradian
+    :param bmaj: major axis (FWHM) of the beam, scalar or array of per-plane values
+    :param bmin: minor axis (FWHM) of the beam, scalar or array of per-plane values
+    :param beamunit: unit of bmaj and bmin, 'arcsec', 'arcmin', 'deg' or 'rad'
+    :return: beam area in sr
+    '''
+    ang2rad = {'arcsec': np.pi / 180. / 3600., 'arcmin': np.pi / 180. / 60., 'deg': np.pi / 180., 'rad': 1.}
+    if beamunit not in ang2rad:
+        raise ValueError, 'Unknown beam unit: ' + str(beamunit)
+    bmaj0 = np.asarray(bmaj, dtype=np.float64) * ang2rad[beamunit]
+    bmin0 = np.asarray(bmin, dtype=np.float64) * ang2rad[beamunit]
+    return bmaj0 * bmin0 * np.pi / (4. * log(2.))
+
+
+def jy2tbfactor(header, bmaj, bmin, beamunit='arcsec', scl100=False):
+    '''
+    per-channel scaling factors from Jy/beam to brightness temperature (K)
+    :param header: fits header of the image cube
+    :param bmaj: major axis of the beam. One value for a single beam or one value per channel
+    :param bmin: minor axis of the beam. One value for a single beam or one value per channel
+    :param beamunit: unit of bmaj and bmin
+    :param scl100: if True, scale the image values up by 100 (to compensate VLA 20 dB attenuator)
+    :return: faxis (the FITS axis number of frequency, as a string), factor (ndarray of length nfreq)
+    '''
+    keys = header.keys()
+    values = header.values()
+    # which axis is frequency?
+    faxis = keys[values.index('FREQ')][-1]
+    nfreq = header['NAXIS' + faxis]
+    fscl = {'hz': 1., 'khz': 1e3, 'mhz': 1e6, 'ghz': 1e9}
+    cunit = str(header.get('CUNIT' + faxis, 'Hz')).lower()
+    nu = (header['CRVAL' + faxis] + header['CDELT' + faxis] * (np.arange(nfreq) + 1 - header['CRPIX' + faxis])) * \
+         fscl.get(cunit, 1.)
+    bmaj = np.atleast_1d(bmaj)
+    bmin = np.atleast_1d(bmin)
+    if len(bmaj) > 1:  # multiple (per-plane) beams
+        bmaj = bmaj[:nfreq]
+        bmin = bmin[:nfreq]
+    else:  # one single beam
+        bmaj = bmaj[0]
+        bmin = bmin[0]
+    beam_area = beamarea(bmaj, bmin, beamunit=beamunit)
+    k_b = qa.constants('k')['value']
+    c_l = qa.constants('c')['value']
+    jy_to_si = 1e-26
+    factor2 = 1.
+    if scl100:
+        factor2 = 100.
+    factor = jy_to_si / beam_area / (2. * k_b * nu ** 2 / c_l ** 2) * factor2  # SI unit
+    return faxis, factor
+
+
+def imjy2tb(data, header, bmaj, bmin, beamunit='arcsec', scl100=False):
+    '''
+    convert an image cube from Jy/beam to brightness temperature (K) in place.
+    The scaling of all the channels is applied as one broadcast operation.
+    :param data: image data from the fits file, in the reversed (FITS) axis order
+    :param header: fits header of the image. BUNIT is updated to 'K' on return
+    :param bmaj: major axis of the beam. One value for a single beam or one value per channel
+    :param bmin: minor axis of the beam. One value for a single beam or one value per channel
+    :param beamunit: unit of bmaj and bmin
+    :param scl100: if True, scale the image values up by 100 (to compensate VLA 20 dB attenuator)
+    :return: data
+    '''
+    if header['BUNIT'].lower() != 'jy/beam':
+        return data
+    faxis, factor = jy2tbfactor(header, bmaj, bmin, beamunit=beamunit, scl100=scl100)
+    shape = [1] * data.ndim
+    shape[data.ndim - int(faxis)] = len(factor)
+    data *= factor.reshape(shape).astype(data.dtype)
+    header['BUNIT'] = 'K'
+    return data
+
+
+def fitsjy2tb(fitsfile=None, outfile=None, scl100=False, overwrite=True):
+    '''
+    convert already registered fits cubes from Jy/beam to brightness temperature (K).
+    Per-plane beams are read from the BEAMS table written by CASA, otherwise
+    the single beam is taken from BMAJ/BMIN in the primary header.
+    :param fitsfile: STRING or LIST. name of the input fits files
+    :param outfile: STRING or LIST. name of the output fits files. If not provided, update the input files in place
+    :param scl100: if True, scale the image values up by 100 (to compensate VLA 20 dB attenuator)
+    :param overwrite: overwrite the existing output files
+    :return: list of output fits files
+    '''
+    if not fitsfile:
+        raise ValueError, 'Please specify input fits file'
+    if type(fitsfile) == str:
+        fitsfile = [fitsfile]
+    if type(outfile) == str:
+        outfile = [outfile]
+    if outfile and len(outfile) != len(fitsfile):
+        raise ValueError, 'Number of input fits files does not equal to number of output fits files!'
+    outfiles = []
+    for n, fitsf in enumerate(fitsfile):
+        if outfile:
+            hdu = pyfits.open(fitsf)
+        else:
+            hdu = pyfits.open(fitsf, mode='update')
+        header = hdu[0].header
+        hdunames = [h.name for h in hdu]
+        if 'BEAMS' in hdunames:
+            beams = hdu[hdunames.index('BEAMS')].data
+            if 'POL' in beams.names:
+                beams = beams[beams['POL'] == beams['POL'].min()]
+            beams = beams[np.argsort(beams['CHAN'])]
+            bmaj, bmin, beamunit = beams['BMAJ'], beams['BMIN'], 'arcsec'
+        else:
+            bmaj, bmin, beamunit = header['BMAJ'], header['BMIN'], 'deg'
+        imjy2tb(hdu[0].data, header, bmaj=bmaj, bmin=bmin, beamunit=beamunit, scl100=scl100)
+        if outfile:
+            if os.path.exists(outfile[n]):
+                if not overwrite:
+                    raise ValueError, 'Specified fits file already exists and overwrite is set to False. Aborting...'
+                os.remove(outfile[n])
+            hdu.writeto(outfile[n])
+            outfiles.append(outfile[n])
+        else:
+            hdu.flush()
+            outfiles.append(fitsf)
+        hdu.close()
+    return outfiles
+
+
 def imreg(vis=None, ephem=None, msinfo=None, imagefile=None, timerange=None, reftime=None, fitsfile=None, beamfile=None, \
           offsetfile=None, toTb=None, scl100=None, verbose=False, p_ang=False, overwrite=True, usephacenter=True):
     ''' 
@@ -525,6 +651,7 @@ def imreg(vis=None, ephem=None, msinfo=None, imagefile=None, timerange=None, ref
     else:
         # use the supplied timerange to register the image
         helio = ephem_to_helio(vis, ephem=ephem, msinfo=msinfo, reftime=timerange, usephacenter=usephacenter)
+    beams = None
     for n, img in enumerate(imagefile):
         if verbose:
             print 'processing image #' + str(n)
@@ -629,59 +756,10 @@ def imreg(vis=None, ephem=None, msinfo=None, imagefile=None, timerange=None, ref
         # update intensity units, i.e. to brightness temperature?
         if toTb:
             # get restoring beam info
-            (bmajs, bmins, bpas, beamunits, bpaunits) = getbeam(imagefile=imagefile, beamfile=beamfile)
-            bmaj = bmajs[n]
-            bmin = bmins[n]
-            beamunit = beamunits[n]
-            data = hdu[0].data  # remember the data order is reversed due to the FITS convension
-            dim = data.ndim
-            sz = data.shape
-            keys = header.keys()
-            values = header.values()
-            # which axis is frequency?
-            faxis = keys[values.index('FREQ')][-1]
-            faxis_ind = dim - int(faxis)
-            if header['BUNIT'].lower() == 'jy/beam':
-                header['BUNIT'] = 'K'
-                for i in range(sz[faxis_ind]):
-                    nu = header['CRVAL' + faxis] + header['CDELT' + faxis] * (i + 1 - header['CRPIX' + faxis])
-                    if header['CUNIT' + faxis] == 'KHz':
-                        nu *= 1e3
-                    if header['CUNIT' + faxis] == 'MHz':
-                        nu *= 1e6
-                    if header['CUNIT' + faxis] == 'GHz':
-                        nu *= 1e9
-                    if len(bmaj) > 1:  # multiple (per-plane) beams
-                        bmajtmp = bmaj[i]
-                        bmintmp = bmin[i]
-                    else:  # one single beam
-                        bmajtmp = bmaj[0]
-                        bmintmp = bmin[0]
-                    if beamunit == 'arcsec':
-                        bmaj0 = np.radians(bmajtmp / 3600.)
-                        bmin0 = np.radians(bmajtmp / 3600.)
-                    if beamunit == 'arcmin':
-                        bmaj0 = np.radians(bmajtmp / 60.)
-                        bmin0 = np.radians(bmintmp / 60.)
-                    if beamunit == 'deg':
-                        bmaj0 = np.radians(bmajtmp)
-                        bmin0 = np.radians(bmintmp)
-                    if beamunit == 'rad':
-                        bmaj0 = bmajtmp
-                        bmin0 = bmintmp
-                    beam_area = bmaj0 * bmin0 * np.pi / (4. * log(2.))
-                    k_b = qa.constants('k')['value']
-                    c_l = qa.constants('c')['value']
-                    factor = 2. * k_b * nu ** 2 / c_l ** 2  # SI unit
-                    jy_to_si = 1e-26
-                    # print nu/1e9, beam_area, factor
-                    factor2 = 1.
-                    if scl100:
-                        factor2 = 100.
-                    if faxis == '3':
-                        data[:, i, :, :] *= jy_to_si / beam_area / factor * factor2
-                    if faxis == '4':
-                        data[i, :, :, :] *= jy_to_si / beam_area / factor * factor2
+            if beams is None:
+                beams = getbeam(imagefile=imagefile, beamfile=beamfile)
+            (bmajs, bmins, bpas, beamunits, bpaunits) = beams
+            imjy2tb(hdu[0].data, header, bmaj=bmajs[n], bmin=bmins[n], beamunit=beamunits[n], scl100=scl100)
 
         hdu.flush()
         hdu.close()
@@ -10,6 +10,7 @@ calendar in 1582. No support for proleptic Gregorian/Julian calendars.
 
 import math
 import datetime as dt
+import numpy as np
 
 # Note: The Python datetime module assumes an infinitely valid Gregorian calendar.
 #       The Gregorian calendar took effect after 10-15-1582 and the dates 10-05 through
@@ -356,6 +357,275 @@ def timedelta_to_days(td):
     return days
     
     
+def date_to_jd_array(year,month,day):
+    """
+    Convert arrays of dates to Julian Days. Array version of `date_to_jd`
+    with identical results.
+    
+    Parameters
+    ----------
+    year : array_like of int
+        Years. Years preceding 1 A.D. should be 0 or negative.
+    
+    month : array_like of int
+        Months, Jan = 1, Feb. = 2, etc.
+    
+    day : array_like of float
+        Days, may contain fractional part.
+    
+    Returns
+    -------
+    jd : ndarray of float
+        Julian Days
+        
+    Examples
+    --------
+    >>> date_to_jd_array([1985,2000],[2,1],[17.25,1.5])
+    array([ 2446113.75,  2451545.  ])
+    
+    """
+    year = np.asarray(year)
+    month = np.asarray(month)
+    day = np.asarray(day, dtype=float)
+    
+    janfeb = (month == 1) | (month == 2)
+    yearp = np.where(janfeb, year - 1, year)
+    monthp = np.where(janfeb, month + 12, month)
+    
+    # before or after October 15, 1582, the beginning of the Gregorian calendar
+    julian = ((year < 1582) |
+              ((year == 1582) & (month < 10)) |
+              ((year == 1582) & (month == 10) & (day < 15)))
+    A = np.trunc(yearp / 100.)
+    B = np.where(julian, 0., 2 - A + np.trunc(A / 4.))
+    
+    C = np.where(yearp < 0, np.trunc((365.25 * yearp) - 0.75), np.trunc(365.25 * yearp))
+    
+    D = np.trunc(30.6001 * (monthp + 1))
+    
+    return B + C + D + day + 1720994.5
+    
+    
+def jd_to_date_array(jd):
+    """
+    Convert an array of Julian Days to dates. Array version of `jd_to_date`
+    with identical results.
+    
+    Parameters
+    ----------
+    jd : array_like of float
+        Julian Days
+        
+    Returns
+    -------
+    year : ndarray of int
+    
+    month : ndarray of int
+    
+    day : ndarray of float
+        Days, may contain fractional part.
+        
+    Examples
+    --------
+    >>> jd_to_date_array([2446113.75])
+    (array([1985]), array([2]), array([ 17.25]))
+    
+    """
+    jd = np.asarray(jd, dtype=float) + 0.5
+    
+    F, I = np.modf(jd)
+    
+    A = np.trunc((I - 1867216.25) / 36524.25)
+    
+    B = np.where(I > 2299160, I + 1 + A - np.trunc(A / 4.), I)
+    
+    C = B + 1524
+    
+    D = np.trunc((C - 122.1) / 365.25)
+    
+    E = np.trunc(365.25 * D)
+    
+    G = np.trunc((C - E) / 30.6001)
+    
+    day = C - E + F - np.trunc(30.6001 * G)
+    
+    month = np.where(G < 13.5, G - 1, G - 13)
+    
+    year = np.where(month > 2.5, D - 4716, D - 4715)
+    
+    return year.astype(int), month.astype(int), day
+    
+    
+def days_to_hmsm_array(days):
+    """
+    Convert arrays of fractional days to hours, minutes, seconds, and microseconds.
+    Array version of `days_to_hmsm` with identical results.
+    
+    Parameters
+    ----------
+    days : array_like of float
+        Fractional numbers of days. Must be less than 1.
+        
+    Returns
+    -------
+    hour, min, sec, micro : ndarrays of int
+    
+    """
+    hours = np.asarray(days, dtype=float) * 24.
+    hours, hour = np.modf(hours)
+    
+    mins = hours * 60.
+    mins, min = np.modf(mins)
+    
+    secs = mins * 60.
+    secs, sec = np.modf(secs)
+    
+    # python's round() rounds half away from zero, np.round rounds half to even
+    micro = secs * 1.e6
+    micro = np.sign(micro) * np.floor(np.abs(micro) + 0.5)
+    
+    return hour.astype(int), min.astype(int), sec.astype(int), micro.astype(int)
+    
+    
+def datetime_to_jd_array(dates):
+    """
+    Convert a sequence of `datetime.datetime` objects, or a numpy datetime64 array,
+    to Julian Days. Array version of `datetime_to_jd` with identical results.
+    
+    Parameters
+    ----------
+    dates : sequence of `datetime.datetime` or datetime64 array
+    
+    Returns
+    -------
+    jd : ndarray of float
+        Julian Days
+    
+    """
+    dates = np.asarray(dates, dtype='datetime64[us]')
+    year = dates.astype('datetime64[Y]')
+    month = dates.astype('datetime64[M]')
+    day = dates.astype('datetime64[D]')
+    micro = (dates - day).astype(np.int64)
+    hour, micro = np.divmod(micro, 3600000000)
+    min, micro = np.divmod(micro, 60000000)
+    sec, micro = np.divmod(micro, 1000000)
+    days = (day - month).astype(int) + 1 + hmsm_to_days(hour, min, sec, micro)
+    
+    return date_to_jd_array(year.astype(int) + 1970, (month - year).astype(int) + 1, days)
+    
+    
+def jd_to_datetime64(jd):
+    """
+    Convert an array of Julian Days to a numpy datetime64[us] array. The dates
+    and times are the same as those of `jd_to_datetime`.
+    
+    Parameters
+    ----------
+    jd : array_like of float
+        Julian Days
+        
+    Returns
+    -------
+    dt : ndarray of datetime64[us]
+    
+    """
+    year, month, day = jd_to_date_array(jd)
+    
+    frac_days, day = np.modf(day)
+    
+    hour, min, sec, micro = days_to_hmsm_array(frac_days)
+    
+    months = (year - 1970) * 12 + month - 1
+    dates = months.astype('datetime64[M]').astype('datetime64[D]') + (day.astype(int) - 1)
+    micro = ((hour * 60 + min) * 60 + sec) * 1000000 + micro
+    
+    return dates.astype('datetime64[us]') + micro.astype('timedelta64[us]')
+    
+    
+def jd_to_datetime_array(jd):
+    """
+    Convert an array of Julian Days to an object array of `jdutil.datetime`.
+    Array version of `jd_to_datetime` with identical results.
+    
+    Parameters
+    ----------
+    jd : array_like of float
+        Julian Days
+        
+    Returns
+    -------
+    dt : ndarray of `jdutil.datetime` objects
+    
+    """
+    jd = np.asarray(jd, dtype=float)
+    year, month, day = jd_to_date_array(jd)
+    
+    frac_days, day = np.modf(day)
+    
+    hour, min, sec, micro = days_to_hmsm_array(frac_days)
+    
+    res = np.empty(jd.shape, dtype=object)
+    res.ravel()[:] = [datetime(*ll) for ll in zip(year.ravel(), month.ravel(), day.astype(int).ravel(),
+                                                   hour.ravel(), min.ravel(), sec.ravel(), micro.ravel())]
+    return res
+    
+    
+def benchmark(n=1000000):
+    """
+    Time the array functions against mapping the scalar ones over `n` timestamps,
+    and check that the results are identical.
+    
+    Returns
+    -------
+    res : dict
+        {name: (scalar seconds, array seconds)}
+    
+    """
+    import time
+    # timestamps at half seconds, clear of the microsecond rounding at the edge of a second,
+    # where jd_to_datetime would fail
+    jd = 2451545. + (np.round(np.random.RandomState(0).uniform(-20000, 20000, n) * 86400.) + 0.5) / 86400.
+    res = {}
+    
+    t0 = time.time()
+    dates = [jd_to_date(ll) for ll in jd]
+    t1 = time.time()
+    year, month, day = jd_to_date_array(jd)
+    t2 = time.time()
+    assert np.array_equal(np.array(dates), np.column_stack((year, month, day)))
+    res['jd_to_date'] = (t1 - t0, t2 - t1)
+    
+    t0 = time.time()
+    jd0 = [date_to_jd(*ll) for ll in dates]
+    t1 = time.time()
+    jd1 = date_to_jd_array(year, month, day)
+    t2 = time.time()
+    assert np.array_equal(jd0, jd1)
+    res['date_to_jd'] = (t1 - t0, t2 - t1)
+    
+    t0 = time.time()
+    dts = [jd_to_datetime(ll) for ll in jd]
+    t1 = time.time()
+    dt64 = jd_to_datetime64(jd)
+    t2 = time.time()
+    assert np.array_equal(np.array(dts, dtype='datetime64[us]'), dt64)
+    res['jd_to_datetime'] = (t1 - t0, t2 - t1)
+    
+    t0 = time.time()
+    jd0 = [datetime_to_jd(ll) for ll in dts]
+    t1 = time.time()
+    jd1 = datetime_to_jd_array(dt64)
+    t2 = time.time()
+    assert np.array_equal(jd0, jd1)
+    res['datetime_to_jd'] = (t1 - t0, t2 - t1)
+    
+    for key, (tscalar, tarray) in sorted(res.items()):
+        print('{:16s} {:d} timestamps: scalar {:.2f} s, array {:.3f} s, {:.0f}x'.format(
+            key, n, tscalar, tarray, tscalar / tarray))
+    return res
+    
+    
 class datetime(dt.datetime):
     """
     A subclass of `datetime.datetime` that performs math operations by first
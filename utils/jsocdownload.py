@@ -0,0 +1,282 @@
+import os
+import time
+import hashlib
+import threading
+import Queue
+import urllib2
+from datetime import datetime
+from suncasa.utils import sdocatalog
+
+__author__ = ["Sijie Yu"]
+__email__ = "sijie.yu@njit.edu"
+
+
+def sdofiledaydir(filename):
+    '''
+    return the day directory (YYYY/MM/DD/) of a JSOC exported file, e.g.,
+    aia.lev1_euv_12s.2014-11-01T191020Z.171.image_lev1.fits or hmi.M_45s.20141101_191000_TAI.2.magnetogram.fits
+    :param filename:
+    :return: the relative day directory, or '' if the time stamp is not recognized
+    '''
+    info = sdocatalog.parse_sdofilename(filename)
+    if info:
+        dt = sdocatalog.jd2datetime(info[2])
+    else:
+        fields = os.path.basename(filename).split('.')
+        try:
+            dt = datetime.strptime(fields[2][:8], '%Y%m%d')
+        except (IndexError, ValueError):
+            return ''
+    return dt.strftime('%Y/%m/%d/')
+
+
+def checkfits(filename):
+    '''
+    cheap integrity check of a FITS file: it starts with the SIMPLE keyword and consists of whole 2880 bytes blocks
+    '''
+    size = os.path.getsize(filename)
+    if size == 0 or size % 2880 != 0:
+        return False
+    with open(filename, 'rb') as fp:
+        return fp.read(6) == 'SIMPLE'
+
+
+def md5sum(filename, blocksize=1 << 20):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class DownloadManager():
+    '''
+    Download the files of a JSOC export with several concurrent transfers. Each file is written to
+    datadir/.partial/ first and is resumed from there with an HTTP range request after a failure.
+    Once its size (and checksum, if known) is verified, it is moved (atomically, within the same file system)
+    into datadir/YYYY/MM/DD/.
+    '''
+
+    def __init__(self, datadir, nthreads=4, retries=3, timeout=60, blocksize=1 << 20, verbose=True):
+        '''
+        :param datadir: root of the YYYY/MM/DD tree of the SDO files
+        :param nthreads: number of concurrent transfers
+        :param retries: number of retries of a file before giving up
+        :param timeout: socket timeout in seconds
+        :param blocksize: bytes to read at a time
+        '''
+        self.datadir = datadir
+        self.partdir = os.path.join(datadir, '.partial')
+        self.nthreads = nthreads
+        self.retries = retries
+        self.timeout = timeout
+        self.blocksize = blocksize
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.nbytes = 0
+        self.nfiles = 0
+        self.failed = {}
+        self.done = []
+        self.tstart = None
+        self.tend = None
+
+    def _fetch(self, url, partfile):
+        '''
+        download url to partfile, resuming from its current size
+        :return: total size of the file reported by the server, or None if unknown
+        '''
+        offset = os.path.getsize(partfile) if os.path.exists(partfile) else 0
+        req = urllib2.Request(url)
+        if offset:
+            req.add_header('Range', 'bytes={}-'.format(offset))
+        try:
+            resp = urllib2.urlopen(req, timeout=self.timeout)
+        except urllib2.HTTPError as err:
+            if err.code == 416:
+                # the partial file is already complete
+                return offset
+            raise
+        if offset and resp.getcode() == 206:
+            mode = 'ab'
+            total = resp.info().getheader('Content-Range', '').split('/')[-1]
+        else:
+            # the server does not support ranges, start over
+            mode = 'wb'
+            total = resp.info().getheader('Content-Length')
+        with open(partfile, mode) as fp:
+            while True:
+                block = resp.read(self.blocksize)
+                if not block:
+                    break
+                fp.write(block)
+                with self._lock:
+                    self.nbytes += len(block)
+        resp.close()
+        try:
+            return int(total)
+        except (TypeError, ValueError):
+            return None
+
+    def _get(self, url, filename, outdir, md5=None):
+        outfile = os.path.join(outdir, filename)
+        if os.path.exists(outfile):
+            return outfile
+        partfile = os.path.join(self.partdir, filename + '.part')
+        err = None
+        for ntry in range(self.retries + 1):
+            try:
+                total = self._fetch(url, partfile)
+            except Exception as err:
+                if self.verbose:
+                    print('{}: {}. retry {}/{}'.format(filename, err, ntry + 1, self.retries))
+                time.sleep(min(2 ** ntry, 30))
+                continue
+            size = os.path.getsize(partfile)
+            if total is not None and size != total:
+                err = 'size {} of {} bytes'.format(size, total)
+                if size > total:
+                    os.remove(partfile)
+                continue
+            if md5 is not None and md5sum(partfile) != md5:
+                err = 'checksum mismatch'
+                os.remove(partfile)
+                continue
+            if filename.endswith('.fits') and not checkfits(partfile):
+                err = 'not a valid FITS file'
+                os.remove(partfile)
+                continue
+            if not os.path.exists(outdir):
+                try:
+                    os.makedirs(outdir)
+                except OSError:
+                    pass
+            os.rename(partfile, outfile)
+            return outfile
+        raise IOError('failed to download {}: {}'.format(filename, err))
+
+    def _worker(self, queue):
+        while True:
+            try:
+                url, filename, outdir, md5 = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                outfile = self._get(url, filename, outdir, md5=md5)
+                with self._lock:
+                    self.nfiles += 1
+                    self.done.append(outfile)
+            except Exception as err:
+                with self._lock:
+                    self.failed[filename] = str(err)
+
+    def download(self, urls, filenames, md5s=None):
+        '''
+        :param urls: list of urls
+        :param filenames: list of the file names
+        :param md5s: list of the md5 checksums of the files, if known
+        :return: list of the downloaded files in the YYYY/MM/DD tree
+        '''
+        self.reset()
+        if not os.path.exists(self.partdir):
+            os.makedirs(self.partdir)
+        if md5s is None:
+            md5s = [None] * len(urls)
+        queue = Queue.Queue()
+        for url, filename, md5 in zip(urls, filenames, md5s):
+            # the day directories are parsed here, as strptime is not thread safe in python 2
+            queue.put((url, filename, os.path.join(self.datadir, sdofiledaydir(filename)), md5))
+        self.tstart = time.time()
+        threads = [threading.Thread(target=self._worker, args=(queue,)) for ll in range(self.nthreads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.tend = time.time()
+        if self.verbose:
+            print(self.info())
+        return sorted(self.done)
+
+    def info(self):
+        tdur = max((self.tend or time.time()) - (self.tstart or time.time()), 1e-6)
+        return '{} files ({:.1f} MB) in {:.1f} s, {:.2f} MB/s, {:.2f} files/s, {} failed'.format(
+            self.nfiles, self.nbytes / 1024. ** 2, tdur, self.nbytes / 1024. ** 2 / tdur, self.nfiles / tdur,
+            len(self.failed))
+
+
+class StandinExportServer():
+    '''
+    A local HTTP server that stands in for the JSOC export site in offline tests. It serves the files of a
+    directory with range requests, and can drop connections partway through to exercise the resume.
+    '''
+
+    def __init__(self, rootdir, port=0, dropfirst=0):
+        '''
+        :param rootdir: directory of the files to serve
+        :param port: port to listen on. 0 picks a free one
+        :param dropfirst: if > 0, the first request of each file is cut after this many bytes
+        '''
+        import BaseHTTPServer
+        import SocketServer
+
+        server = self
+        self.rootdir = rootdir
+        self.dropfirst = dropfirst
+        self.requested = set()
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = os.path.join(server.rootdir, os.path.basename(self.path))
+                if not os.path.isfile(path):
+                    self.send_error(404)
+                    return
+                size = os.path.getsize(path)
+                start = 0
+                rng = self.headers.getheader('Range')
+                if rng:
+                    start = int(rng.split('=')[1].split('-')[0])
+                    if start >= size:
+                        self.send_error(416)
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(size - start))
+                self.end_headers()
+                with open(path, 'rb') as fp:
+                    fp.seek(start)
+                    data = fp.read()
+                if server.dropfirst and path not in server.requested:
+                    server.requested.add(path)
+                    data = data[:server.dropfirst]
+                self.wfile.write(data)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(('127.0.0.1', port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def urls(self):
+        '''
+        :return: (urls, filenames) of the served files, like the url and filename columns of a drms export
+        '''
+        filenames = sorted(os.listdir(self.rootdir))
+        return ['http://127.0.0.1:{}/{}'.format(self.port, ll) for ll in filenames], filenames
@@ -1,3 +1,5 @@
+import time
+import warnings
 import astropy.units as u
 import matplotlib.cm as cm
 import matplotlib.colors as colors
@@ -19,6 +21,9 @@ __email__ = "sijie.yu@njit.edu"
 colormap_jet = cm.get_cmap("jet")  # choose any matplotlib colormap here
 bokehpalette_jet = [colors.rgb2hex(m) for m in colormap_jet(np.arange(colormap_jet.N))]
 
+# the PuffinMap whose tiles are shown by each tiled image renderer, keyed by the renderer id
+tiledmaps = {}
+
 
 def getAIApalette(wavelength):
     clmap = cm.get_cmap("sdoaia" + wavelength)  # choose any matplotlib colormap here
@@ -34,7 +39,8 @@ class PuffinMap:
     ----------
     map : Sunpy map
     """
-    __slots__ = ['smap', 'plot_height', 'plot_width', 'x', 'y', 'dw', 'dh', 'x_range', 'y_range']
+    __slots__ = ['smap', 'plot_height', 'plot_width', 'x', 'y', 'dw', 'dh', 'x_range', 'y_range', 'dx', 'dy',
+                 'pyramid', 'tilesize', 'tileinfo']
 
     def __init__(self, data=None, header=None, smap=None, plot_height=None, plot_width=None, *args,
                  **kwargs):
@@ -69,6 +75,9 @@ class PuffinMap:
         self.x_range = [x0, x1]
         # self.y_range = [y0, y0 + (y1 - y0) * float(self.plot_height) / float(self.plot_width)]
         self.y_range = [y0, y1]
+        self.pyramid = None
+        self.tilesize = 256
+        self.tileinfo = {}
 
     def meshgrid(self, rescale=1.0, *args, **kwargs):
         XX, YY = np.meshgrid(np.arange(self.smap.data.shape[1] * rescale), np.arange(self.smap.data.shape[0] * rescale))
@@ -94,6 +103,92 @@ class PuffinMap:
         # return {'data': [data], 'xx': [x], 'yy': [y]}
         return {'data': [data]}
 
+    def BuildPyramid(self, tilesize=256):
+        """precompute the image pyramid. Level 0 is the full resolution image (as in ImageSource), and each
+        level is downsampled by 2 from the previous one until the image fits in a single tile.
+        """
+        data = self.ImageSource()['data'][0].astype(np.float32)
+        pyramid = [data]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            while max(data.shape) > tilesize:
+                ny, nx = data.shape
+                # pad with NaNs to even sizes so that the levels share the same lower left corner
+                padded = np.full((ny + ny % 2, nx + nx % 2), np.nan, dtype=np.float32)
+                padded[:ny, :nx] = data
+                data = np.nanmean(padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2), axis=(1, 3))
+                pyramid.append(data)
+        self.pyramid = pyramid
+        self.tilesize = tilesize
+        return pyramid
+
+    def TileSource(self, x_range=None, y_range=None, *args, **kwargs):
+        """maps the tiles of the image pyramid visible in the x and y range to Bokeh DataSource.
+        The pyramid level is chosen so that the image resolution is close to the screen resolution,
+        and the visible tiles are merged into one image.
+        x_range and y_range are [start, end] lists or Bokeh Range objects.
+        """
+        t0 = time.time()
+        if self.pyramid is None:
+            self.BuildPyramid()
+        if hasattr(x_range, 'start'):
+            x_range = [x_range.start, x_range.end]
+        if hasattr(y_range, 'start'):
+            y_range = [y_range.start, y_range.end]
+        if x_range is None or None in x_range:
+            x_range = self.x_range
+        if y_range is None or None in y_range:
+            y_range = self.y_range
+        x0, y0 = self.x[0], self.y[0]
+        ny, nx = self.pyramid[0].shape
+        # number of full resolution pixels per screen pixel
+        npix = max(abs(x_range[1] - x_range[0]) / self.dx / float(self.plot_width),
+                   abs(y_range[1] - y_range[0]) / self.dy / float(self.plot_height))
+        level = int(np.clip(np.floor(np.log2(max(npix, 1.0))), 0, len(self.pyramid) - 1))
+        data = self.pyramid[level]
+        dx, dy = self.dx * 2 ** level, self.dy * 2 ** level
+        tile = self.tilesize
+        c0, c1 = [int(np.clip(ll, 0, data.shape[1])) for ll in
+                  [np.floor((min(x_range) - x0) / dx / tile) * tile, np.ceil((max(x_range) - x0) / dx / tile) * tile]]
+        r0, r1 = [int(np.clip(ll, 0, data.shape[0])) for ll in
+                  [np.floor((min(y_range) - y0) / dy / tile) * tile, np.ceil((max(y_range) - y0) / dy / tile) * tile]]
+        if c1 <= c0 or r1 <= r0:
+            c0, c1, r0, r1 = 0, 1, 0, 1
+        image = np.ascontiguousarray(data[r0:r1, c0:c1])
+        ntiles = int(np.ceil((r1 - r0) / float(tile)) * np.ceil((c1 - c0) / float(tile)))
+        self.tileinfo = {'level': level, 'ntiles': ntiles, 'nbytes': image.nbytes, 'time': time.time() - t0}
+        return {'image': [image], 'x': [x0 + c0 * dx], 'y': [y0 + r0 * dy], 'dw': [(c1 - c0) * dx],
+                'dh': [(r1 - r0) * dy]}
+
+    def LinkTiles(self, p_image, r_img):
+        """update the tiles of a map plotted with PlotMap(tiled=True) when the x or y range of the plot changes.
+        The bytes sent and the time spent are reported for each update. If the renderer is already linked,
+        its tiles are taken from this map from now on.
+        """
+        linked = r_img.id in tiledmaps
+        tiledmaps[r_img.id] = self
+        if linked:
+            return
+
+        def update_tiles(attrname, old, new):
+            t0 = time.time()
+            pfmap = tiledmaps[r_img.id]
+            r_img.data_source.data = pfmap.TileSource(x_range=p_image.x_range, y_range=p_image.y_range)
+            print('PuffinMap tiles: level {}, {} tiles, {:.2f} MB sent, {:.3f} sec'.format(
+                pfmap.tileinfo['level'], pfmap.tileinfo['ntiles'], pfmap.tileinfo['nbytes'] / 1024. ** 2,
+                time.time() - t0))
+
+        for rng in [p_image.x_range, p_image.y_range]:
+            rng.on_change('start', update_tiles)
+            rng.on_change('end', update_tiles)
+
+    def UpdateTiles(self, p_image, r_img):
+        """show this map in the renderer of a map plotted with PlotMap(tiled=True), e.g., after the map
+        has been resampled. Use it instead of replacing the image of the data source.
+        """
+        self.LinkTiles(p_image, r_img)
+        r_img.data_source.data = self.TileSource(x_range=p_image.x_range, y_range=p_image.y_range)
+
     def DrawGridSource(self, grid_spacing=15 * u.deg, *args, **kwargs):
         """maps the Longitude and Latitude grids to Bokeh DataSource
         """
@@ -149,12 +244,14 @@ class PuffinMap:
 
     def PlotMap(self, DrawLimb=True, DrawGrid=True, grid_spacing=15 * u.deg, ignore_coord=False, title=None, tools=None,
                 x_range=None, y_range=None,
-                palette=None, imagetype='image', *args,
+                palette=None, imagetype='image', tiled=False, *args,
                 **kwargs):
-        """Plot the map using the bokeh.plotting interface
+        """Plot the map using the bokeh.plotting interface.
+        If tiled is True, only the tiles of the image pyramid visible at the current zoom are sent to the browser,
+        and the tiles are updated as the plot is panned or zoomed.
         """
 
-        source_image = self.ImageSource()
+        source_image = self.ImageSource() if not tiled else None
         if not title:
             title = self.smap.name
 
@@ -211,7 +308,15 @@ class PuffinMap:
         p_image.yaxis.axis_label = p_yaxis_axislabel
         p_image.xaxis.visible = p_xaxis_visible
         p_image.yaxis.visible = p_yaxis_visible
-        r_img = p_image.image(image=source_image['data'], x=x0, y=y0, dw=dw, dh=dh, color_mapper=colormapper)
+        if tiled and not ignore_coord:
+            source_tile = ColumnDataSource(self.TileSource(x_range=x_range, y_range=y_range))
+            r_img = p_image.image(image='image', x='x', y='y', dw='dw', dh='dh', color_mapper=colormapper,
+                                  source=source_tile)
+            self.LinkTiles(p_image, r_img)
+        else:
+            if source_image is None:
+                source_image = self.ImageSource()
+            r_img = p_image.image(image=source_image['data'], x=x0, y=y0, dw=dw, dh=dh, color_mapper=colormapper)
         if DrawLimb:
             p_image.line(x='x', y='y', line_color='white', line_dash='solid', source=self.DrawLimbSource())
             if DrawGrid:
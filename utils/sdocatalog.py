@@ -0,0 +1,159 @@
+import os
+import glob
+import sqlite3
+from fnmatch import fnmatch
+from datetime import datetime, timedelta
+
+__author__ = ["Sijie Yu"]
+__email__ = "sijie.yu@njit.edu"
+
+_mjd0 = datetime(1858, 11, 17)
+
+
+def jd2datetime(jd):
+    return _mjd0 + timedelta(days=jd - 2400000.5)
+
+
+def datetime2jd(dt):
+    delta = dt - _mjd0
+    return delta.days + (delta.seconds + delta.microseconds / 1e6) / 86400. + 2400000.5
+
+
+def sdodaydirs(jdtime):
+    '''
+    return the relative day directories (YYYY/MM/DD) covering the time range
+    :param jdtime: two elements list of timestamps in Julian days
+    :return:
+    '''
+    d1 = jd2datetime(jdtime[0]).date()
+    d2 = jd2datetime(jdtime[-1]).date()
+    return ['{:04d}/{:02d}/{:02d}'.format(d.year, d.month, d.day) for d in
+            [d1 + timedelta(days=i) for i in range((d2 - d1).days + 1)]]
+
+
+def parse_sdofilename(filename):
+    '''
+    parse the instrument, wavelength and timestamp from the name of a JSOC exported AIA file,
+    e.g., aia.lev1_euv_12s.2014-11-01T191020Z.171.image_lev1.fits
+    :param filename:
+    :return: a tuple of (instrument, wavelength, jd). None if the file name is not recognized
+    '''
+    fields = os.path.basename(filename).split('.')
+    if len(fields) < 5 or not fields[2].endswith('Z'):
+        return None
+    try:
+        dt = datetime.strptime(fields[2], '%Y-%m-%dT%H%M%SZ')
+    except ValueError:
+        return None
+    return fields[0].lower(), fields[3].lower(), datetime2jd(dt)
+
+
+class SDOCatalog:
+    '''
+    A persistent index of the SDO files in the local database, stored as a sqlite file in the data directory.
+    The files are organized as datadir/YYYY/MM/DD/. A day directory is rescanned only
+    if its modification time has changed since it was last indexed. Only the AIA level 1 images are indexed,
+    not the other segments of an export (e.g., .spikes.fits) in the same directory.
+    '''
+    dbname = 'sdocatalog.sqlite'
+    pattern = 'aia.lev1_*Z.*.image_lev1.fits'
+    # bumped when the indexed files change, so that the catalogs of an older version are rebuilt
+    version = 1
+
+    def __init__(self, datadir):
+        self.datadir = datadir
+        self.dbfile = os.path.join(datadir, self.dbname)
+        if not os.path.exists(datadir):
+            os.makedirs(datadir)
+        conn = self.connect()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, daydir TEXT, instrument TEXT, '
+                         'wavelength TEXT, jd REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_files ON files (instrument, wavelength, jd)')
+            conn.execute('CREATE TABLE IF NOT EXISTS dirs (daydir TEXT PRIMARY KEY, mtime REAL)')
+            if conn.execute('PRAGMA user_version').fetchone()[0] < self.version:
+                conn.execute('DELETE FROM files')
+                conn.execute('DELETE FROM dirs')
+                conn.execute('PRAGMA user_version = {:d}'.format(self.version))
+        conn.close()
+
+    def connect(self):
+        return sqlite3.connect(self.dbfile, timeout=30)
+
+    def update(self, jdtime=None, force=False):
+        '''
+        rescan the day directories of which the contents have changed
+        :param jdtime: two elements list of timestamps in Julian days. If None, rescan all the day directories
+        :param force: if True, rescan the directories regardless of their modification time
+        :return: number of rescanned directories
+        '''
+        if jdtime is None:
+            daydirs = [os.path.relpath(ll, self.datadir) for ll in
+                       glob.glob(os.path.join(self.datadir, '[0-9]' * 4, '[0-9]' * 2, '[0-9]' * 2))]
+        else:
+            daydirs = sdodaydirs(jdtime)
+        conn = self.connect()
+        mtimes = dict(conn.execute('SELECT daydir, mtime FROM dirs').fetchall())
+        nscan = 0
+        with conn:
+            for daydir in daydirs:
+                fullpath = os.path.join(self.datadir, daydir)
+                if not os.path.isdir(fullpath):
+                    continue
+                mtime = os.path.getmtime(fullpath)
+                if not force and mtimes.get(daydir) == mtime:
+                    continue
+                conn.execute('DELETE FROM files WHERE daydir = ?', (daydir,))
+                conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                 self._records(glob.glob(os.path.join(fullpath, self.pattern)), daydir))
+                conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (daydir, mtime))
+                nscan += 1
+        conn.close()
+        return nscan
+
+    def add_files(self, filename):
+        '''
+        add newly downloaded files to the catalog without rescanning their directories
+        :param filename: file or a list of files already placed in the YYYY/MM/DD tree
+        :return:
+        '''
+        if type(filename) == str:
+            filename = [filename]
+        conn = self.connect()
+        with conn:
+            for ll in filename:
+                daydir = os.path.relpath(os.path.dirname(os.path.abspath(ll)), os.path.abspath(self.datadir))
+                conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', self._records([ll], daydir))
+                if os.path.isdir(os.path.dirname(ll)):
+                    conn.execute('UPDATE dirs SET mtime = ? WHERE daydir = ?',
+                                 (os.path.getmtime(os.path.dirname(ll)), daydir))
+        conn.close()
+
+    def query(self, wavelength, jdtime, instrument='aia', update=True):
+        '''
+        query the files in a time range
+        :param wavelength: wavelength of the files. Multiple wavelengths can be given as a comma separated string
+        :param jdtime: two elements list of timestamps in Julian days.
+        :param instrument:
+        :param update: if True, rescan the changed day directories in the time range before querying
+        :return: a list of tuples of (fullpath, jd) sorted by time
+        '''
+        if update:
+            self.update(jdtime)
+        waves = [ll.strip() for ll in str(wavelength).lower().split(',')]
+        conn = self.connect()
+        res = conn.execute('SELECT path, jd FROM files WHERE instrument = ? AND wavelength IN ({}) AND jd > ? AND jd < ? '
+                           'ORDER BY jd'.format(','.join('?' * len(waves))),
+                           [instrument] + waves + [jdtime[0], jdtime[-1]]).fetchall()
+        conn.close()
+        return [(os.path.join(self.datadir, ll[0]), ll[1]) for ll in res]
+
+    def _records(self, filename, daydir):
+        records = []
+        for ll in filename:
+            if not fnmatch(os.path.basename(ll), self.pattern):
+                continue
+            info = parse_sdofilename(ll)
+            if info:
+                records.append((os.path.join(daydir, os.path.basename(ll)), daydir) + info)
+        return records
@@ -0,0 +1,268 @@
+'''
+Hierarchical timing spans of the pipeline tasks, written as JSON lines.
+
+A span measures one stage of a task: wall time, CPU time of the process, peak resident memory and the bytes
+read from and written to storage. Spans opened inside another span record it as their parent, also in the
+worker processes that multiprocessing forks inside a span, so the slices of ptclean or the files of importeovsa
+show up below the task that started them. All processes append to the same log file, one line per span.
+
+The log is switched on with the environment variable SUNCASA_SPANLOG (path of the log file), or with
+configure(logfile). Without a log file the spans are still measured, at the cost of a few system calls, but
+nothing is written.
+
+    with spanlog.span('ptclean', ncpu=ncpu) as sp:
+        ...
+        sp.set(nimages=len(res))
+
+    @spanlog.spanned('ptclean.slice')
+    def clean_iter(...):
+
+    python -m suncasa.utils.spanlog spans.jsonl
+'''
+import os
+import sys
+import json
+import time
+import socket
+import threading
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__author__ = ["Sijie Yu"]
+__email__ = "sijie.yu@njit.edu"
+
+_state = {'logfile': os.environ.get('SUNCASA_SPANLOG') or None, 'counter': 0}
+_local = threading.local()
+_lock = threading.Lock()
+_host = socket.gethostname()
+
+
+def configure(logfile=None):
+    '''
+    :param logfile: JSON lines file to append the spans to. None stops writing. The setting is exported to
+                    the environment, so that the subprocesses started later (e.g., CASA) write to the same file.
+    '''
+    _state['logfile'] = logfile
+    if logfile:
+        os.environ['SUNCASA_SPANLOG'] = os.path.abspath(logfile)
+    else:
+        os.environ.pop('SUNCASA_SPANLOG', None)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _newid():
+    with _lock:
+        _state['counter'] += 1
+        return '{}-{}-{}'.format(_host, os.getpid(), _state['counter'])
+
+
+def _maxrss():
+    '''
+    :return: peak resident memory of this process and of its waited-for children in MB
+    '''
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kB on linux and in bytes on mac
+    scale = 1024. ** 2 if sys.platform == 'darwin' else 1024.
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def _iobytes():
+    '''
+    :return: bytes read from and written to storage by this process
+    '''
+    try:
+        with open('/proc/self/io') as fp:
+            io = dict([ll.split(':') for ll in fp.read().splitlines() if ':' in ll])
+        return int(io['read_bytes']), int(io['write_bytes'])
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    if resource is None:
+        return 0, 0
+    # blocks of 512 bytes where /proc is not available
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+class Span():
+    '''
+    One timed stage. Use it as a context manager through span(), or call start() and stop().
+    '''
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.record = None
+
+    def set(self, **attrs):
+        '''
+        attach attributes (e.g., the number of images made) to the span record
+        '''
+        self.attrs.update(attrs)
+
+    def start(self):
+        stack = _stack()
+        parent = stack[-1] if stack else None
+        self.id = _newid()
+        self.parent = parent.id if parent else None
+        self.root = parent.root if parent else self.id
+        self.depth = parent.depth + 1 if parent else 0
+        self.pid = os.getpid()
+        stack.append(self)
+        self._t0 = time.time()
+        self._cpu0 = os.times()
+        self._io0 = _iobytes()
+        return self
+
+    def stop(self, error=None):
+        twall = time.time() - self._t0
+        cpu = os.times()
+        io = _iobytes()
+        maxrss, maxrss_children = _maxrss()
+        stack = _stack()
+        if self in stack:
+            del stack[stack.index(self):]
+        self.record = {'name': self.name, 'id': self.id, 'parent': self.parent, 'root': self.root,
+                       'depth': self.depth, 'pid': self.pid, 'host': _host, 'tstart': self._t0, 'wall': twall,
+                       'cpu': cpu[0] + cpu[1] - self._cpu0[0] - self._cpu0[1],
+                       'cpu_children': cpu[2] + cpu[3] - self._cpu0[2] - self._cpu0[3],
+                       'maxrss_mb': maxrss, 'maxrss_children_mb': maxrss_children,
+                       'read_bytes': io[0] - self._io0[0], 'write_bytes': io[1] - self._io0[1],
+                       'status': 'failed' if error else 'ok'}
+        if error:
+            self.record['error'] = error
+        if self.attrs:
+            self.record['attrs'] = self.attrs
+        write(self.record)
+        return self.record
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop(error='{}: {}'.format(exc_type.__name__, exc_value) if exc_type else None)
+        return False
+
+
+def span(name, **attrs):
+    '''
+    :param name: name of the stage, e.g., 'ptclean' or 'ptclean.slice'
+    :param attrs: attributes of the span, e.g., ncpu
+    :return: a Span to be used in a with statement
+    '''
+    return Span(name, **attrs)
+
+
+def spanned(name=None):
+    '''
+    decorator to run a function in a span
+    :param name: name of the span. Default is the name of the function
+    '''
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name or func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def current():
+    '''
+    :return: the innermost open span of this thread, or None
+    '''
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def write(record, logfile=None):
+    logfile = logfile or _state['logfile']
+    if not logfile:
+        return
+    line = json.dumps(record, sort_keys=True) + '\n'
+    # a single write of a file opened with O_APPEND keeps the lines of concurrent processes intact
+    fd = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8') if not isinstance(line, bytes) else line)
+    finally:
+        os.close(fd)
+
+
+def read(logfile):
+    '''
+    :return: list of the span records in the log file
+    '''
+    records = []
+    with open(logfile) as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # a line cut short by a killed process
+                    pass
+    return records
+
+
+def aggregate(records):
+    '''
+    sum up the spans of the same name over all the processes
+    :param records: list of span records, or the log file
+    :return: dict of {name: {'n', 'npid', 'nfailed', 'wall', 'wall_max', 'cpu', 'maxrss_mb', 'read_bytes',
+                'write_bytes', 'depth'}}
+    '''
+    if not isinstance(records, list):
+        records = read(records)
+    summary = {}
+    for rec in records:
+        agg = summary.setdefault(rec['name'], {'n': 0, 'pids': set(), 'nfailed': 0, 'wall': 0., 'wall_max': 0.,
+                                               'cpu': 0., 'maxrss_mb': 0., 'read_bytes': 0, 'write_bytes': 0,
+                                               'depth': rec['depth']})
+        agg['n'] += 1
+        agg['pids'].add((rec['host'], rec['pid']))
+        agg['nfailed'] += rec['status'] != 'ok'
+        agg['wall'] += rec['wall']
+        agg['wall_max'] = max(agg['wall_max'], rec['wall'])
+        agg['cpu'] += rec['cpu']
+        agg['maxrss_mb'] = max(agg['maxrss_mb'], rec['maxrss_mb'] or 0.)
+        agg['read_bytes'] += rec['read_bytes']
+        agg['write_bytes'] += rec['write_bytes']
+        agg['depth'] = min(agg['depth'], rec['depth'])
+    for agg in summary.values():
+        agg['npid'] = len(agg.pop('pids'))
+    return summary
+
+
+def report(records):
+    '''
+    :param records: list of span records, or the log file
+    :return: a table of the aggregated spans, with the stages indented by their depth
+    '''
+    summary = aggregate(records)
+    lines = ['{:32s} {:>6s} {:>5s} {:>10s} {:>10s} {:>10s} {:>9s} {:>10s} {:>10s}'.format(
+        'span', 'n', 'npid', 'wall (s)', 'max (s)', 'cpu (s)', 'rss (MB)', 'read (MB)', 'write (MB)')]
+    for name, agg in sorted(summary.items(), key=lambda x: (x[1]['depth'], -x[1]['wall'])):
+        lines.append('{:32s} {:6d} {:5d} {:10.2f} {:10.2f} {:10.2f} {:9.1f} {:10.1f} {:10.1f}{}'.format(
+            '  ' * agg['depth'] + name, agg['n'], agg['npid'], agg['wall'], agg['wall_max'], agg['cpu'],
+            agg['maxrss_mb'], agg['read_bytes'] / 1024. ** 2, agg['write_bytes'] / 1024. ** 2,
+            ' ({} failed)'.format(agg['nfailed']) if agg['nfailed'] else ''))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    for logfile in sys.argv[1:]:
+        print(report(logfile))
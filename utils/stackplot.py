@@ -12,6 +12,7 @@ import matplotlib.cm as cm
 import sunpy.map
 import astropy.units as u
 import pickle
+import json
 import glob
 # from astropy import units as u
 # import sunpy.map as smap
@@ -63,12 +64,109 @@ def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
     return y
 
 
+def butter_bandpass_cube(datacube, lowcut, highcut, fs, order=3, axis=0, zerophase=True, tilesize=None, out=None):
+    '''
+    band-pass filter the time series of all the pixels of an image cube at once
+    :param datacube: image cube, e.g., [nt,ny,nx]. Can be memory-mapped
+    :param lowcut:
+    :param highcut:
+    :param fs: sampling frequency
+    :param order: order of the butterworth filter
+    :param axis: the time axis
+    :param zerophase: if True, filter forward and backward (sosfiltfilt), otherwise forward only (sosfilt)
+    :param tilesize: number of slices along the first spatial axis filtered at a time, to bound the memory
+                     of out-of-core data. If None, filter the whole cube in one call
+    :param out: output array with the shape of datacube, can be datacube itself. If None, a new array is allocated
+    :return: the filtered cube
+    '''
+    nyq = 0.5 * fs
+    sos = signal.butter(order, [lowcut / nyq, highcut / nyq], btype='band', output='sos')
+    if zerophase:
+        sfilter = signal.sosfiltfilt
+    else:
+        sfilter = signal.sosfilt
+    axis = axis % datacube.ndim
+    if out is None:
+        out = np.empty(datacube.shape, dtype=np.result_type(datacube.dtype, np.float32))
+    if tilesize is None:
+        out[...] = sfilter(sos, datacube, axis=axis)
+    else:
+        saxis = 1 if axis == 0 else 0
+        slc = [slice(None)] * datacube.ndim
+        for idx in xrange(0, datacube.shape[saxis], tilesize):
+            slc[saxis] = slice(idx, idx + tilesize)
+            out[tuple(slc)] = sfilter(sos, datacube[tuple(slc)], axis=axis)
+    return out
+
+
 def b_filter(data, lowcut, highcut, fs, ix):
     x = data[ix]
     y = butter_bandpass_filter(x, lowcut, highcut, fs, order=3)
     return {'idx': ix, 'y': y}
 
 
+def loadmapframe(fitsfile, fov=None, binpix=1):
+    '''
+    load a fits file as a map with the submap, resample and normalization steps of Stackplot.make_mapcube
+    :param fitsfile:
+    :param fov: [x0, x1, y0, y1] in arcsec
+    :param binpix:
+    :return: sunpy map
+    '''
+    maptmp = sunpy.map.Map(fitsfile)
+    if fov:
+        x0, x1, y0, y1 = fov
+        submaptmp = maptmp.submap(u.Quantity([x0 * u.arcsec, x1 * u.arcsec]),
+                                  u.Quantity([y0 * u.arcsec, y1 * u.arcsec]))
+    else:
+        submaptmp = maptmp
+    submaptmp = submaptmp.resample(u.Quantity(submaptmp.dimensions) / binpix)
+    if submaptmp.detector == 'HMI':
+        pass
+    else:
+        submaptmp = DButil.normalize_aiamap(submaptmp)
+    return submaptmp
+
+
+def loadmapframes(fitsfile, fov=None, binpix=1, ncpu=1, prefetch=None):
+    '''
+    load and preprocess fits files (see loadmapframe) across a pool of worker processes.
+    The maps are returned in the order of the input files.
+    :param fitsfile: list of fits files
+    :param fov:
+    :param binpix:
+    :param ncpu: number of worker processes. 1 to load the files serially
+    :param prefetch: maximum number of frames being loaded or waiting to be collected. Default to 2 * ncpu
+    :return: list of maps
+    '''
+    from collections import deque
+    t0 = time.time()
+    maplist = []
+    if ncpu > 1:
+        if not prefetch:
+            prefetch = 2 * ncpu
+        pool = mp.Pool(ncpu)
+        pending = deque()
+        pbar = tqdm(total=len(fitsfile))
+        for ll in fitsfile:
+            if len(pending) >= prefetch:
+                maplist.append(pending.popleft().get())
+                pbar.update(1)
+            pending.append(pool.apply_async(loadmapframe, (ll, fov, binpix)))
+        while pending:
+            maplist.append(pending.popleft().get())
+            pbar.update(1)
+        pbar.close()
+        pool.close()
+        pool.join()
+    else:
+        for ll in tqdm(fitsfile):
+            maplist.append(loadmapframe(ll, fov=fov, binpix=binpix))
+    dt = time.time() - t0
+    print('{} frames loaded in {:.1f} sec ({:.1f} frames/s)'.format(len(maplist), dt, len(maplist) / max(dt, 1e-6)))
+    return maplist
+
+
 def FitSlit(xx, yy, cutwidth, cutang, cutlength, s=None, method='Polyfit', ascending=True):
     if len(xx) <= 3 or method == 'Polyfit':
         '''polynomial fit'''
@@ -111,24 +209,45 @@ def MakeSlit(pointDF):
     return cutslitplt
 
 
+def getslitidx(cutslit, shape, xrange=None, yrange=None):
+    '''
+    precompute the pixel sampling coordinates of a slit for DButil.improfilecube
+    :param cutslit: slit in data coordinates if xrange and yrange are provided, otherwise in pixels
+    :param shape: shape of the images, [ny, nx]
+    :param xrange: x range of the images in data coordinates
+    :param yrange: y range of the images in data coordinates
+    :return:
+    '''
+    ndy, ndx = shape[-2:]
+    if xrange is not None and yrange is not None:
+        xs0 = (cutslit['xs0'] - xrange[0]) / (xrange[1] - xrange[0]) * ndx
+        xs1 = (cutslit['xs1'] - xrange[0]) / (xrange[1] - xrange[0]) * ndx
+        ys0 = (cutslit['ys0'] - yrange[0]) / (yrange[1] - yrange[0]) * ndy
+        ys1 = (cutslit['ys1'] - yrange[0]) / (yrange[1] - yrange[0]) * ndy
+    else:
+        xs0 = cutslit['xs0']
+        xs1 = cutslit['xs1']
+        ys0 = cutslit['ys0']
+        ys1 = cutslit['ys1']
+    return DButil.improfileidx(xs0, ys0, xs1, ys1, shape)
+
+
+def mapgeometry(meta):
+    '''
+    :param meta: header of a map
+    :return: a tuple of the header keywords that fix the pixel grid of the map in data coordinates.
+            Maps with the same geometry share their slit sampling coordinates
+    '''
+    meta = dict([(str(k).lower(), v) for k, v in meta.items()])
+    return tuple([round(float(meta[k]), 6) if meta.get(k) is not None else None for k in
+                  ['naxis1', 'naxis2', 'crval1', 'crval2', 'crpix1', 'crpix2', 'cdelt1', 'cdelt2']])
+
+
 def getimprofile(data, cutslit, xrange=None, yrange=None):
     num = len(cutslit['xcen'])
     if num > 1:
-        intens = np.zeros(num)
-        ndy, ndx = data.shape
-        if xrange is not None and yrange is not None:
-            xs0 = (cutslit['xs0'] - xrange[0]) / (xrange[1] - xrange[0]) * ndx
-            xs1 = (cutslit['xs1'] - xrange[0]) / (xrange[1] - xrange[0]) * ndx
-            ys0 = (cutslit['ys0'] - yrange[0]) / (yrange[1] - yrange[0]) * ndy
-            ys1 = (cutslit['ys1'] - yrange[0]) / (yrange[1] - yrange[0]) * ndy
-        else:
-            xs0 = cutslit['xs0']
-            xs1 = cutslit['xs1']
-            ys0 = cutslit['ys0']
-            ys1 = cutslit['ys1']
-        for ll in range(num):
-            inten = DButil.improfile(data, [xs0[ll], xs1[ll]], [ys0[ll], ys1[ll]], interp='nearest')
-            intens[ll] = np.mean(inten)
+        slitidx = getslitidx(cutslit, data.shape, xrange=xrange, yrange=yrange)
+        intens = DButil.improfilecube([data], slitidx)[0]
         intensdist = {'x': cutslit['dist'], 'y': intens}
         return intensdist
 
@@ -368,6 +487,119 @@ class CutslitBuilder:
         self.slitline1.figure.canvas.draw()
 
 
+def mapcube_tostore(mapcube, outdir, info=None):
+    '''
+    write a mapcube to a map cube store: a directory with the data of all frames in one
+    [nt,ny,nx] array (data.npy) and the per-frame headers in a json table (header.json).
+    The store can be opened lazily with LazyMapCube.
+    :param mapcube: sunpy mapcube. All the maps must have the same dimensions
+    :param outdir: the name of the store
+    :param info: a dictionary of extra information saved along with the headers
+    :return:
+    '''
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    nt = len(mapcube)
+    ny, nx = mapcube[0].data.shape
+    data = np.lib.format.open_memmap(os.path.join(outdir, 'data.npy'), mode='w+', dtype=mapcube[0].data.dtype,
+                                     shape=(nt, ny, nx))
+    headers = []
+    for idx, smap in enumerate(mapcube):
+        if smap.data.shape != (ny, nx):
+            raise ValueError('All the maps in the mapcube must have the same dimensions')
+        data[idx] = smap.data
+        headers.append(dict(smap.meta))
+    data.flush()
+    del data
+    if info is None:
+        info = {}
+    info['headers'] = headers
+    with open(os.path.join(outdir, 'header.json'), 'w') as sf:
+        json.dump(info, sf, default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o))
+
+
+class LazyMapCube(sunpy.map.mapcube.MapCube):
+    '''
+    A mapcube opened from a map cube store (see mapcube_tostore), or made of a [nt,ny,nx] data array
+    and a list of headers. The data array of a store is memory-mapped and a map is only made when its
+    frame is accessed, so opening the store is fast and the memory footprint is bounded by the frames
+    in use. Changes to the data of a store are copy-on-write and are never written back to the store.
+    '''
+
+    def __init__(self, store=None, index=None, data=None, headers=None, info=None):
+        self.store = store
+        self._derotate = False
+        if store:
+            with open(os.path.join(store, 'header.json'), 'r') as sf:
+                self.info = json.load(sf)
+            self.headers = self.info.pop('headers')
+            self.data = np.load(os.path.join(store, 'data.npy'), mmap_mode='c')
+        else:
+            if data is None or headers is None:
+                raise ValueError('Either a map cube store or the data and headers must be provided')
+            self.info = info if info is not None else {}
+            self.headers = headers
+            self.data = data
+        if index is None:
+            index = np.arange(len(self.headers))
+        self.index = np.asarray(index)
+        self._frames = {}
+
+    @property
+    def maps(self):
+        return [self[idx] for idx in xrange(len(self))]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            fidx = self.index[key]
+            if fidx not in self._frames:
+                self._frames[fidx] = sunpy.map.Map((self.data[fidx], self.headers[fidx]))
+            return self._frames[fidx]
+        else:
+            return self._view(self.index[key])
+
+    def __deepcopy__(self, memo):
+        if self.store:
+            return self._view(self.index.copy())
+        return LazyMapCube(index=self.index.copy(), data=self.data.copy(), headers=self.headers,
+                           info=dict(self.info))
+
+    def _view(self, index):
+        if self.store:
+            return LazyMapCube(self.store, index=index)
+        return LazyMapCube(index=index, data=self.data, headers=self.headers, info=self.info)
+
+    def as_array(self):
+        '''
+        :return: the data in the [ny,nx,nt] order of sunpy MapCube.as_array. The array is memory-mapped
+                 (or a view of the in-memory data array) unless the frames are not evenly spaced.
+        '''
+        if self.store:
+            data = np.load(os.path.join(self.store, 'data.npy'), mmap_mode='c')
+        else:
+            data = self.data
+        steps = np.unique(np.diff(self.index))
+        if len(self.index) == 1 or (len(steps) == 1 and steps[0] > 0):
+            step = steps[0] if len(self.index) > 1 else 1
+            data = data[self.index[0]:self.index[-1] + 1:step]
+        else:
+            data = data[self.index]
+        return np.rollaxis(data, 0, 3)
+
+    def all_maps_same_shape(self):
+        return True
+
+    def all_meta(self):
+        return [self.headers[idx] for idx in self.index]
+
+
 class Stackplot:
     instrum_meta = {'SDO/AIA': {'scale': 0.6 * u.arcsec / u.pix}}
     suncasadb = os.getenv('SUNCASADB')
@@ -398,7 +630,7 @@ class Stackplot:
                 self.mapcube_fromfile(infile)
 
     def make_mapcube(self, trange, outfile=None, fov=None, wavelength='171', binpix=1, dt_data=1, derotate=False,
-                     tosave=True):
+                     tosave=True, store=False, ncpu=1, prefetch=None):
         if isinstance(trange, list):
             if isinstance(trange[0], Time):
                 trange = Time([trange[0], trange[-1]])
@@ -411,22 +643,8 @@ class Stackplot:
             print(
                 'Input trange format not recognized. trange can either be a file list or a timerange of astropy Time object')
 
-        maplist = []
         print 'Loading fits files....'
-        for ll in tqdm(fitsfile[::dt_data]):
-            maptmp = sunpy.map.Map(ll)
-            if fov:
-                x0, x1, y0, y1 = fov
-                submaptmp = maptmp.submap(u.Quantity([x0 * u.arcsec, x1 * u.arcsec]),
-                                          u.Quantity([y0 * u.arcsec, y1 * u.arcsec]))
-            else:
-                submaptmp = maptmp
-            submaptmp = submaptmp.resample(u.Quantity(submaptmp.dimensions) / binpix)
-            if submaptmp.detector == 'HMI':
-                pass
-            else:
-                submaptmp = DButil.normalize_aiamap(submaptmp)
-            maplist.append(submaptmp)
+        maplist = loadmapframes(fitsfile[::dt_data], fov=fov, binpix=binpix, ncpu=ncpu, prefetch=prefetch)
         if derotate:
             mapcube = mapcube_solar_derotate(sunpy.map.Map(maplist, cube=True))
         else:
@@ -443,10 +661,17 @@ class Stackplot:
                                                                         trange[0].isot[:-4].replace(':', ''),
                                                                         trange[1].isot[:-4].replace(':', ''), binpix,
                                                                         dt_data)
-            self.mapcube_tofile(outfile)
+            self.mapcube_tofile(outfile, store=store)
         gc.collect()
 
     def mapcube_fromfile(self, infile):
+        if os.path.isdir(infile):
+            print('Loading mapcube....')
+            self.mapcube = LazyMapCube(infile)
+            self.dt_data = self.mapcube.info.get('dt_data')
+            self.fitsfile = self.mapcube.info.get('fitsfile')
+            self.mapcube_info()
+            return
         with open(infile, 'rb') as sf:
             print('Loading mapcube....')
             tmp = pickle.load(sf)
@@ -464,7 +689,16 @@ class Stackplot:
                 self.mapcube = tmp
             self.mapcube_info()
 
-    def mapcube_tofile(self, outfile=None, mapcube=None):
+    def mapcube_tofile(self, outfile=None, mapcube=None, store=False):
+        '''
+        save the mapcube to file
+        :param outfile:
+        :param mapcube:
+        :param store: if True, save to a map cube store (see mapcube_tostore) which can be opened lazily
+                      with mapcube_fromfile. Otherwise pickle the mapcube. Output file names ending with
+                      .mcube are always saved as a map cube store.
+        :return:
+        '''
         if not mapcube:
             mapcube = self.mapcube
         mp_info = self.mapcube_info(mapcube)
@@ -472,6 +706,15 @@ class Stackplot:
             outfile = 'mapcube_{0}_{1}_{2}'.format(mapcube[0].meta['wavelnth'],
                                                    self.trange[0].isot[:-4].replace(':', ''),
                                                    self.trange[1].isot[:-4].replace(':', ''))
+        if store or outfile.endswith('.mcube'):
+            if not outfile.endswith('.mcube'):
+                outfile = outfile + '.mcube'
+            print('Saving mapcube to {}'.format(outfile))
+            mapcube_tostore(mapcube, outfile,
+                            info={'trange': list(mp_info['trange'].isot), 'fov': list(mp_info['fov']),
+                                  'binpix': mp_info['binpix'], 'dt_data': self.dt_data,
+                                  'fitsfile': self.fitsfile})
+            return
         with open(outfile, 'wb') as sf:
             print('Saving mapcube to {}'.format(outfile))
             pickle.dump({'mp': mapcube, 'trange': mp_info['trange'], 'fov': mp_info['fov'], 'binpix': mp_info['binpix'],
@@ -490,49 +733,33 @@ class Stackplot:
         self.binpix *= binpix
 
     def mapcube_mkdiff(self, mode=0, dt_frm=3, medfilt=None, bfilter=False, lowcut=0.1, highcut=50, outfile=None,
-                       tosave=False):
+                       tosave=False, store=False):
         modes = {0: 'rdiff', 1: 'rratio', 2: 'bdiff', 3: 'bratio'}
-        maplist = []
-        datacube = self.mapcube.as_array()
+        mapcube = self.mapcube
         if medfilt:
             print 'median filtering map.....'
-            for idx, ll in enumerate(tqdm(self.mapcube)):
-                datacube[:, :, idx] = signal.medfilt(datacube[:, :, idx], medfilt)
+            datacube = np.array([signal.medfilt(ll.data, medfilt) for ll in tqdm(mapcube)])
+        elif isinstance(mapcube, LazyMapCube):
+            datacube = np.rollaxis(mapcube.as_array(), 2)
+        else:
+            datacube = [ll.data for ll in mapcube]
         print 'making the running diff mapcube.....'
-        for idx, ll in enumerate(tqdm(self.mapcube)):
-            maplist.append(deepcopy(ll))
-            if idx - dt_frm < 0:
-                sidx = 0
-            else:
-                sidx = idx - dt_frm
-            if modes[mode] == 'rdiff':
-                maplist[idx].data = datacube[:, :, idx] - datacube[:, :, sidx]
-            elif modes[mode] == 'rratio':
-                maplist[idx].data = datacube[:, :, idx] / datacube[:, :, sidx]
-            elif modes[mode] == 'bdiff':
-                maplist[idx].data = datacube[:, :, idx] - datacube[:, :, 0]
-            elif modes[mode] == 'bratio':
-                maplist[idx].data = datacube[:, :, idx] / datacube[:, :, 0]
-        mapcube_diff = sunpy.map.Map(maplist, cube=True)
+        # the diff frames go into one [nt,ny,nx] array (in place of the median filtered one, if any)
+        # and share the headers of the original mapcube
+        datacube_diff = DButil.mkdiffcube(datacube, mode=modes[mode], lag=dt_frm,
+                                          out=datacube if medfilt else None)
+        if isinstance(mapcube, LazyMapCube):
+            headers = mapcube.all_meta()
+        else:
+            headers = [ll.meta for ll in mapcube]
+        mapcube_diff = LazyMapCube(data=datacube_diff, headers=headers)
 
         if bfilter:
-            datacube = mapcube_diff.as_array()
-            datacube_ft = np.zeros_like(datacube)
-            ny, nx, nt = datacube_ft.shape
             fs = len(mapcube_diff)
-            ncpu = mp.cpu_count() - 1
+            nt, ny, nx = datacube_diff.shape
             print 'filtering the mapcube in time domain.....'
-            for ly in tqdm(xrange(ny)):
-                b_filter_partial = partial(b_filter, datacube[ly], lowcut, highcut, fs)
-                pool = mp.Pool(ncpu)
-                res = pool.map(b_filter_partial, xrange(nx))
-                pool.close()
-                pool.join()
-                for lx in xrange(nx):
-                    datacube_ft[ly, lx] = res[lx]['y']
-
-            for idx, ll in enumerate(tqdm(mapcube_diff)):
-                mapcube_diff[idx].data = datacube_ft[:, :, idx]
+            butter_bandpass_cube(datacube_diff, lowcut, highcut, fs, order=3, axis=0,
+                                 tilesize=max(1, 2 ** 24 // (nt * nx)), out=datacube_diff)
 
         if tosave:
             if not outfile:
@@ -540,7 +767,7 @@ class Stackplot:
                                                                             self.trange[0].isot[:-4].replace(':', ''),
                                                                             self.trange[1].isot[:-4].replace(':', ''),
                                                                             self.binpix, self.dt_data, modes[mode])
-            self.mapcube_tofile(outfile=outfile, mapcube=mapcube_diff)
+            self.mapcube_tofile(outfile=outfile, mapcube=mapcube_diff, store=store)
         self.mapcube_diff = mapcube_diff
         return mapcube_diff
 
@@ -731,14 +958,27 @@ class Stackplot:
             pickle.dump(cutslit, sf)
 
     def make_stackplot(self, mapcube):
-        stackplt = []
         print 'making the stack plot...'
-        for idx, smap in enumerate(tqdm(mapcube)):
-            intens = getimprofile(smap.data, self.cutslitbd.cutslitplt, xrange=smap.xrange.value,
-                                  yrange=smap.yrange.value)
-            stackplt.append(intens['y'])
+        cutslit = self.cutslitbd.cutslitplt
+        if isinstance(mapcube, LazyMapCube):
+            headers = [mapcube.headers[ll] for ll in mapcube.index]
+        else:
+            headers = [ll.meta for ll in mapcube.maps]
+        if len(set([mapgeometry(hdr) for hdr in headers])) == 1:
+            # all the frames share the pixel grid, so the slit coordinates are computed once
+            # and all frames are sampled in one pass
+            smap = mapcube[0]
+            slitidx = getslitidx(cutslit, smap.data.shape, xrange=smap.xrange.value, yrange=smap.yrange.value)
+            if isinstance(mapcube, LazyMapCube):
+                datacube = np.rollaxis(mapcube.as_array(), 2)
+            else:
+                datacube = [ll.data for ll in mapcube.maps]
+            stackplt = DButil.improfilecube(datacube, slitidx, verbose=True)
+        else:
+            print('The frames differ in shape or field of view. Sample the slit frame by frame.')
+            stackplt = np.vstack([getimprofile(smap.data, cutslit, xrange=smap.xrange.value,
+                                               yrange=smap.yrange.value)['y'] for smap in mapcube])
         if len(stackplt) > 1:
-            stackplt = np.vstack(stackplt)
             self.stackplt = stackplt.transpose()
         else:
             print('Too few timestamps. Failed to make a stack plot map.')
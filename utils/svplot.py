@@ -1,6 +1,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import os, sys
+import socket
 # from config import get_and_create_download_dir
 import shutil
 from astropy.io import fits
@@ -30,6 +31,7 @@ import matplotlib.patches as patches
 from matplotlib import gridspec
 import glob
 from suncasa.utils import DButil
+from suncasa.utils import casaworker
 import copy
 from pkg_resources import parse_version
 import pdb
@@ -46,7 +48,12 @@ def uniq(lst):
 
 
 def mk_qlook_image(vis, ncpu=10, twidth=12, stokes='I,V', antenna='', imagedir=None, spws=[], toTb=True, overwrite=True, doslfcal=False,
-                   phasecenter='', c_external=True):
+                   phasecenter='', c_external=True, useworker=True):
+    '''
+    :param c_external: if True, run ptclean in an external CASA
+    :param useworker: if True (and c_external), send the ptclean jobs to the persistent CASA worker (see casaworker)
+                    instead of starting a new CASA for every spw. Fall back to a CASA script if the worker fails to start.
+    '''
     vis = [vis]
     subdir = ['/']
 
@@ -119,14 +126,27 @@ def mk_qlook_image(vis, ncpu=10, twidth=12, stokes='I,V', antenna='', imagedir=N
         # if cfreq > 10.:
         #     antenna = antenna + ';!0&1;!0&2'  # deselect the shortest baselines
         sto = stokes.replace(',', '')
-        if c_external:
+        inpdict = {'vis': msfile, 'imageprefix': imdir, 'imagesuffix': imagesuffix, 'twidth': twidth, 'uvrange': uvrange, 'spw': spw,
+                   'ncpu': ncpu, 'niter': 1000, 'gain': 0.05, 'antenna': antenna, 'imsize': imsize, 'cell': cell, 'stokes': sto, 'doreg': True,
+                   'overwrite': overwrite, 'toTb': toTb, 'restoringbeam': restoringbeam, 'uvtaper': True, 'outertaper': ['30arcsec'],
+                   'phasecenter': phasecenter}
+        res = None
+        if c_external and useworker:
+            try:
+                worker = casaworker.getworker().start()
+            except (RuntimeError, OSError) as err:
+                print('CASA worker not available: {}. Use an external CASA script instead.'.format(err))
+                useworker = False
+            else:
+                try:
+                    res = worker.call('ptclean', **inpdict)
+                except (socket.error, EOFError) as err:
+                    print('CASA worker lost: {}. Use an external CASA script instead.'.format(err))
+                    useworker = False
+        if c_external and not useworker:
             cleanscript = os.path.join(imdir, 'ptclean_external.py')
             resfile = os.path.join(imdir, os.path.basename(msfile) + '.res.npz')
             os.system('rm -rf {}'.format(cleanscript))
-            inpdict = {'vis': msfile, 'imageprefix': imdir, 'imagesuffix': imagesuffix, 'twidth': twidth, 'uvrange': uvrange, 'spw': spw,
-                       'ncpu': ncpu, 'niter': 1000, 'gain': 0.05, 'antenna': antenna, 'imsize': imsize, 'cell': cell, 'stokes': sto, 'doreg': True,
-                       'overwrite': overwrite, 'toTb': toTb, 'restoringbeam': restoringbeam, 'uvtaper': True, 'outertaper': ['30arcsec'],
-                       'phasecenter': phasecenter}
             for key, val in inpdict.items():
                 if type(val) is str:
                     inpdict[key] = '"{}"'.format(val)
@@ -142,7 +162,7 @@ def mk_qlook_image(vis, ncpu=10, twidth=12, stokes='I,V', antenna='', imagedir=N
             os.system('casa --nologger -c {}'.format(cleanscript))
             res = np.load(resfile)
             res = res['res'].item()
-        else:
+        elif not c_external:
             res = ptclean(vis=msfile, imageprefix=imdir, imagesuffix=imagesuffix, twidth=twidth, uvrange=uvrange, spw=spw, ncpu=ncpu, niter=1000,
                           gain=0.05, antenna=antenna, imsize=imsize, cell=cell, stokes=sto, doreg=True, overwrite=overwrite, toTb=toTb,
                           restoringbeam=restoringbeam, uvtaper=True, outertaper=['30arcsec'], phasecenter=phasecenter)
@@ -430,10 +450,26 @@ def plt_qlook_image(imres, figdir=None, specdata=None, verbose=True, stokes='I,V
     DButil.img2html_movie(figdir_)
 
 
-def dspec_external(vis, workdir='./', specfile=None):
-    dspecscript = os.path.join(workdir, 'dspec.py')
+def dspec_external(vis, workdir='./', specfile=None, useworker=True):
+    '''
+    generate the dynamic spectrum of vis in an external CASA and save it to specfile
+    :param useworker: if True, run it in the persistent CASA worker (see casaworker) and return the dynamic spectrum.
+                    Fall back to a CASA script if the worker fails to start or goes away.
+    :return: the dynamic spectrum dict if it is generated by the worker, otherwise None
+    '''
     if not specfile:
         specfile = os.path.join(workdir, os.path.basename(vis) + '.dspec.npz')
+    if useworker:
+        try:
+            worker = casaworker.getworker().start()
+        except (RuntimeError, OSError) as err:
+            print('CASA worker not available: {}. Use an external CASA script instead.'.format(err))
+        else:
+            try:
+                return worker.call('dspec', vis=vis, specfile=specfile, domedian=True, verbose=True, savespec=True)
+            except (socket.error, EOFError) as err:
+                print('CASA worker lost: {}. Use an external CASA script instead.'.format(err))
+    dspecscript = os.path.join(workdir, 'dspec.py')
     os.system('rm -rf {}'.format(dspecscript))
     fi = open(dspecscript, 'wb')
     fi.write('from suncasa.utils import dspec2 as ds \n')
@@ -512,14 +548,16 @@ def svplot(vis, timerange=None, spw='', workdir='./', specfile=None, bl=None, uv
         except:
             print('Provided dynamic spectrum file not numpy npz. Generating one from the visibility data')
             specfile = os.path.join(workdir, os.path.basename(vis) + '.dspec.npz')
-            dspec_external(vis, workdir=workdir, specfile=specfile)
-            specdata = np.load(specfile)  # specdata = ds.get_dspec(vis, domedian=True, verbose=True)
+            specdata = dspec_external(vis, workdir=workdir, specfile=specfile)
+            if specdata is None:
+                specdata = np.load(specfile)  # specdata = ds.get_dspec(vis, domedian=True, verbose=True)
     else:
         print('Dynamic spectrum file not provided; Generating one from the visibility data')
         # specdata = ds.get_dspec(vis, domedian=True, verbose=True)
         specfile = os.path.join(workdir, os.path.basename(vis) + '.dspec.npz')
-        dspec_external(vis, workdir=workdir, specfile=specfile)
-        specdata = np.load(specfile)
+        specdata = dspec_external(vis, workdir=workdir, specfile=specfile)
+        if specdata is None:
+            specdata = np.load(specfile)
 
     tb.open(vis)
     starttim = Time(tb.getcell('TIME', 0) / 24. / 3600., format='mjd')